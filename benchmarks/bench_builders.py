@@ -0,0 +1,239 @@
+"""End-to-end benchmarks for the mets_dnx builders on synthetic SIPs.
+
+For each file count, a synthetic SIP is generated (see synthetic.py) and
+every case below is run in a fresh process, so that its peak RSS can be
+measured on its own:
+
+    build_mets              reference: serial hashing, in-memory tree
+    build_mets/workers      fixity_workers=4
+    build_mets/stream       output= streaming
+    build_mets_from_json    reference JSON build, in-memory tree
+    json/stream             output= streaming
+    check_structmaps/BOTH   _check_structmaps() on a nested DEFAULT build
+
+Each case reports its total time, files/s, MiB/s hashed, peak RSS, the
+time spent in each phase of the build as reported to its BuildHooks (see
+mets_dnx.factory.PhaseTimings), plus 'tostring' for serializing an
+in-memory tree, and the median and 99th percentile time taken to hash a
+file. The canonical XML of every optimized case is checked against its
+reference, and the run fails if any of them differ.
+With --profile DIR, each case also writes a cProfile of its build to
+DIR/<case>-<files>.prof.
+
+Usage:
+
+    python benchmarks/bench_builders.py --files 100,1000,10000
+        [--sizes fixed:4096] [--depth 2] [--reps 1] [--dir /scratch]
+        [--cases build_mets,build_mets/stream] [--json results.json]
+        [--profile DIR]
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lxml import etree as ET
+
+from mets_dnx import factory as mdf
+import synthetic
+
+
+IE = {'ie_dmd_dict': {'dc:title': 'synthetic SIP'},
+      'generalIECharacteristics': [{'submissionReason': 'bornDigitalContent',
+                                    'IEEntityType': 'periodicIE'}]}
+
+REFERENCES = {
+    'build_mets': 'build_mets',
+    'build_mets/workers': 'build_mets',
+    'build_mets/stream': 'build_mets',
+    'build_mets_from_json': 'build_mets_from_json',
+    'json/stream': 'build_mets_from_json',
+    'check_structmaps/BOTH': None,
+}
+
+
+def _dir_kwargs(sip):
+    kwargs = dict(IE, input_dir=sip['sip_dir'])
+    for rep, key in (('pm', 'pres_master_dir'), ('mm', 'modified_master_dir'),
+                     ('ad', 'access_derivative_dir')):
+        if rep + '_dir' in sip:
+            kwargs[key] = sip[rep + '_dir']
+    return kwargs
+
+
+def _json_kwargs(sip):
+    kwargs = dict(IE, input_dir=sip['sip_dir'])
+    for rep, key in (('pm', 'pres_master_json'), ('mm', 'modified_master_json'),
+                     ('ad', 'access_derivative_json')):
+        if rep + '_json' in sip:
+            with open(sip[rep + '_json']) as f:
+                kwargs[key] = f.read()
+    return kwargs
+
+
+def _canonical_digest(xml):
+    """sha256 of the C14N form of a document, given as bytes or a tree."""
+    if isinstance(xml, bytes):
+        xml = ET.fromstring(xml, ET.XMLParser(huge_tree=True))
+    return hashlib.sha256(ET.tostring(xml, method='c14n')).hexdigest()
+
+
+def _build(builder, profile, **kwargs):
+    if profile:
+        return mdf.profile_build(profile, builder, **kwargs)
+    return builder(**kwargs)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_case(case, sip, queue, profile=None):
+    """Run one benchmark case; executed in its own process."""
+    timings = mdf.PhaseTimings()
+    phases = timings.phases
+    start = time.perf_counter()
+    if case in ('build_mets', 'build_mets/workers', 'build_mets_from_json'):
+        if case == 'build_mets_from_json':
+            mets = _build(mdf.build_mets_from_json, profile, hooks=timings,
+                          **_json_kwargs(sip))
+        elif case == 'build_mets/workers':
+            mets = _build(mdf.build_mets, profile, fixity_workers=4,
+                          hooks=timings, **_dir_kwargs(sip))
+        else:
+            mets = _build(mdf.build_mets, profile, hooks=timings,
+                          **_dir_kwargs(sip))
+        mark = time.perf_counter()
+        xml = ET.tostring(mets, xml_declaration=True, encoding='UTF-8')
+        phases['tostring'] = time.perf_counter() - mark
+    elif case in ('build_mets/stream', 'json/stream'):
+        stream = io.BytesIO()
+        if case == 'json/stream':
+            _build(mdf.build_mets_from_json, profile, output=stream,
+                   hooks=timings, **_json_kwargs(sip))
+        else:
+            _build(mdf.build_mets, profile, output=stream, hooks=timings,
+                   **_dir_kwargs(sip))
+        xml = stream.getvalue()
+    elif case == 'check_structmaps/BOTH':
+        mets = mdf.build_mets_from_json(**_json_kwargs(sip))
+        timings = mdf.PhaseTimings()
+        phases = timings.phases
+        with mdf._phase(timings, 'structmaps'):
+            mdf._check_structmaps(mets, 'BOTH')
+        xml = None
+    else:
+        raise ValueError("unknown case {!r}".format(case))
+    elapsed = time.perf_counter() - start
+    latencies = [seconds for _, seconds in timings.hash_latencies]
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    digest = _canonical_digest(xml) if xml is not None else None
+    queue.put({'case': case, 'elapsed': elapsed, 'phases': phases,
+               'hash_p50': _percentile(latencies, 0.5),
+               'hash_p99': _percentile(latencies, 0.99),
+               'peak_rss': peak_rss, 'digest': digest})
+
+
+def run_isolated(case, sip, profile=None):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case,
+                              args=(case, sip, queue, profile))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', default='100,1000,10000',
+                        help="comma-separated file counts per rep")
+    parser.add_argument('--sizes', default='fixed:4096')
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--reps', type=int, default=1, choices=(1, 2, 3))
+    parser.add_argument('--cases', default=','.join(REFERENCES))
+    parser.add_argument('--dir', default=None,
+                        help="where to generate the synthetic SIPs")
+    parser.add_argument('--json', default=None,
+                        help="also write the results to this JSON file")
+    parser.add_argument('--profile', default=None,
+                        help="write a cProfile of each case to this folder")
+    args = parser.parse_args(argv)
+    cases = args.cases.split(',')
+    if args.dir:
+        os.makedirs(args.dir, exist_ok=True)
+
+    all_results = []
+    mismatches = []
+    for files in (int(value) for value in args.files.split(',')):
+        sip_dir = tempfile.mkdtemp(dir=args.dir)
+        try:
+            sip = synthetic.generate_sip(sip_dir, files, args.sizes,
+                                         args.depth, args.files_per_dir,
+                                         args.reps)
+            print("{} files x {} reps, {:.1f} MiB".format(
+                files, args.reps, sip['bytes'] / 2**20))
+            digests = {}
+            for case in cases:
+                profile = None
+                if args.profile:
+                    os.makedirs(args.profile, exist_ok=True)
+                    profile = os.path.join(args.profile, '{}-{}.prof'.format(
+                        case.replace('/', '_'), files))
+                result = run_isolated(case, sip, profile)
+                result.update(files=sip['files'], bytes=sip['bytes'])
+                all_results.append(result)
+                digests[case] = result['digest']
+                reference = REFERENCES[case]
+                same = ''
+                if reference and reference != case and reference in digests:
+                    if digests[reference] == result['digest']:
+                        same = 'same XML'
+                    else:
+                        same = 'XML DIFFERS'
+                        mismatches.append((files, case))
+                print("    {:<22} {:8.3f} s {:10.0f} files/s {:8.1f} MiB/s "
+                      "{:8.1f} MiB RSS  {}  {}".format(
+                          case, result['elapsed'],
+                          sip['files'] / result['elapsed'],
+                          sip['bytes'] / 2**20 / result['elapsed'],
+                          result['peak_rss'] / 2**20,
+                          ' '.join('{}={:.3f}s'.format(name, seconds)
+                                   for name, seconds
+                                   in result['phases'].items()),
+                          same))
+                if result['hash_p50'] is not None:
+                    print("    {:<22} hash latency p50 {:.2f} ms, p99 {:.2f} "
+                          "ms".format('', result['hash_p50'] * 1000,
+                                      result['hash_p99'] * 1000))
+        finally:
+            shutil.rmtree(sip_dir)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results, f, indent=2)
+    if mismatches:
+        print("optimized output differs from the reference for: {}".format(
+            mismatches))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
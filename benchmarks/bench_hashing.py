@@ -0,0 +1,120 @@
+"""Compare the fixity hashing engines used by mets_dnx.factory.
+
+Three engines are timed over the same set of files:
+
+    read      the original implementation, allocating a new bytes object
+              for every f.read() call
+    readinto  generate_checksums() reading into a reused buffer
+    mmap      generate_checksums() memory mapping every non-empty file
+
+Usage:
+
+    python benchmarks/bench_hashing.py [--small-files 2000]
+        [--small-size 65536] [--large-files 2] [--large-size 268435456]
+        [--repeat 3] [--dir /path/on/the/storage/to/test]
+
+Each engine is run --repeat times and the best time is reported, so the
+figures mostly reflect hashing and allocator cost on a warm page cache.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mets_dnx import factory as mdf
+
+
+def legacy_md5(filepath, block_size=2**20):
+    m = hashlib.md5()
+    with open(filepath, "rb") as f:
+        while True:
+            buf = f.read(block_size)
+            if not buf:
+                break
+            m.update(buf)
+    return m.hexdigest()
+
+
+ENGINES = {
+    'read': legacy_md5,
+    'readinto': lambda filepath: mdf.generate_checksums(
+        filepath, mmap_threshold=None)['MD5'],
+    'mmap': lambda filepath: mdf.generate_checksums(
+        filepath, mmap_threshold=1)['MD5'],
+}
+
+
+def make_files(directory, count, size, prefix):
+    filepaths = []
+    chunk = os.urandom(min(size, 2**20)) if size else b''
+    for i in range(count):
+        filepath = os.path.join(directory, "{}{:06d}.bin".format(prefix, i))
+        with open(filepath, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def run(filepaths, repeat):
+    results = {}
+    reference = None
+    for name, engine in ENGINES.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            digests = [engine(filepath) for filepath in filepaths]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if reference is None:
+            reference = digests
+        elif digests != reference:
+            raise AssertionError("{} digests differ from read".format(name))
+        results[name] = best
+    return results
+
+
+def report(label, filepaths, results):
+    total_bytes = sum(os.path.getsize(filepath) for filepath in filepaths)
+    print("{}: {} files, {:.1f} MiB".format(
+        label, len(filepaths), total_bytes / 2**20))
+    for name, elapsed in results.items():
+        print("    {:<9} {:8.3f} s  {:9.1f} MiB/s  {:9.0f} files/s".format(
+            name, elapsed, total_bytes / 2**20 / elapsed,
+            len(filepaths) / elapsed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--small-files', type=int, default=2000)
+    parser.add_argument('--small-size', type=int, default=2**16)
+    parser.add_argument('--large-files', type=int, default=2)
+    parser.add_argument('--large-size', type=int, default=2**28)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dir', default=None,
+                        help="where to write the test files")
+    args = parser.parse_args(argv)
+
+    if args.dir:
+        os.makedirs(args.dir, exist_ok=True)
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        small = make_files(directory, args.small_files, args.small_size, 's')
+        large = make_files(directory, args.large_files, args.large_size, 'l')
+        if small:
+            report('small files', small, run(small, args.repeat))
+        if large:
+            report('large files', large, run(large, args.repeat))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
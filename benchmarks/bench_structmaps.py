@@ -0,0 +1,170 @@
+"""Compare the old and new PHYSICAL/BOTH structMap flattening in
+mets_dnx.factory._check_structmaps().
+
+    legacy   the original implementation: a descendant findall for the FILE
+             divs, then a deepcopy of each one into the flat structMap
+    current  _check_structmaps(): a single traversal, moving the file divs
+             out of the nested map (PHYSICAL) or out of one whole copy of
+             it (BOTH)
+
+The structMaps come from build_mets_from_json() on a generated manifest
+laid out as a nested tree (see synthetic.directory_tree()), so no files
+are written to disk and 10**5 files or more are quick to set up. Each
+implementation and structmap type is run in a fresh process, which reports
+the time spent flattening and the growth in RSS it caused. The
+canonical XML of both implementations is compared, and the run fails if it
+differs.
+
+Usage:
+
+    python benchmarks/bench_structmaps.py [--files 10000,100000]
+        [--depth 3] [--files-per-dir 100]
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lxml import etree as ET
+from pymets import mets_model as mm
+
+from mets_dnx import factory as mdf
+import synthetic
+
+
+def legacy_check_structmaps(mets, structmap_type):
+    structmaps = mets.findall("{http://www.loc.gov/METS/}structMap")
+    for structmap in structmaps:
+        top_div_label = None
+        top_div = structmap.find("./{http://www.loc.gov/METS/}div")
+        if 'LABEL' in top_div.attrib:
+            top_div_label = top_div.attrib['LABEL']
+        double_divs = structmap.findall(
+            "{http://www.loc.gov/METS/}div/{http://www.loc.gov/METS/}div")
+        if len(double_divs) > 0:
+            if structmap_type.upper() not in ['PHYSICAL', 'BOTH']:
+                structmap.attrib['TYPE'] = 'LOGICAL'
+            elif structmap_type.upper() in ['PHYSICAL', 'BOTH']:
+                new_sm = mm.StructMap(ID=structmap.attrib['ID'],
+                                      TYPE="PHYSICAL")
+                div_1 = mm.Div(LABEL=top_div_label)
+                new_sm.append(div_1)
+                div_2 = mm.Div(LABEL="Table of Contents")
+                div_1.append(div_2)
+                file_divs = structmap.findall(
+                    './/{http://www.loc.gov/METS/}div[@TYPE="FILE"]')
+                for file_div in file_divs:
+                    div_2.append(deepcopy(file_div))
+                mets.append(new_sm)
+                if structmap_type.upper() == 'PHYSICAL':
+                    mets.remove(structmap)
+                else:
+                    structmap.attrib['TYPE'] = 'LOGICAL'
+    return mets
+
+
+IMPLEMENTATIONS = {
+    'legacy': legacy_check_structmaps,
+    'current': mdf._check_structmaps,
+}
+
+
+def manifest(files, depth, files_per_dir):
+    leaves = synthetic.directory_tree(files, depth, files_per_dir)
+    for file_no in range(files):
+        leaf = leaves[file_no * len(leaves) // files]
+        name = 'img{:07d}.tif'.format(file_no)
+        yield {'fileOriginalName': name,
+               'fileOriginalPath': os.path.join('pm', leaf, name),
+               'MD5': 'd41d8cd98f00b204e9800998ecf8427e'}
+
+
+def _rss():
+    # the current RSS where /proc is available, as the build leaves the
+    # peak RSS above anything flattening adds; otherwise the peak RSS
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if sys.platform == 'darwin':
+            peak_rss //= 1024
+        return peak_rss
+
+
+def run_case(implementation, structmap_type, args, queue):
+    """Flatten the structMaps of one document; executed in its own
+    process."""
+    mets = mdf.build_mets_from_json(
+        ie_dmd_dict={'dc:title': 'synthetic SIP'},
+        pres_master_json=manifest(args.files, args.depth, args.files_per_dir),
+        input_dir='.')
+    # only the structMaps are flattened, so leave the rest of the document
+    # out of the comparison (and out of the RSS figures)
+    for child in list(mets):
+        if child.tag != '{http://www.loc.gov/METS/}structMap':
+            mets.remove(child)
+    rss_before = _rss()
+    start = time.perf_counter()
+    IMPLEMENTATIONS[implementation](mets, structmap_type)
+    elapsed = time.perf_counter() - start
+    queue.put({'elapsed': elapsed,
+               'rss_growth': _rss() - rss_before,
+               'digest': hashlib.sha256(
+                   ET.tostring(mets, method='c14n')).hexdigest()})
+
+
+def run_isolated(implementation, structmap_type, args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_case,
+                              args=(implementation, structmap_type, args,
+                                    queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', default='10000,100000',
+                        help="comma-separated file counts")
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    args = parser.parse_args(argv)
+
+    mismatches = []
+    for files in (int(value) for value in args.files.split(',')):
+        print("{} files, depth {}".format(files, args.depth))
+        for structmap_type in ('PHYSICAL', 'BOTH'):
+            digests = set()
+            for implementation in IMPLEMENTATIONS:
+                case_args = argparse.Namespace(
+                    files=files, depth=args.depth,
+                    files_per_dir=args.files_per_dir)
+                result = run_isolated(implementation, structmap_type,
+                                      case_args)
+                digests.add(result['digest'])
+                print("    {:<9} {:<8} {:8.3f} s {:8.1f} MiB RSS "
+                      "growth".format(structmap_type, implementation,
+                                      result['elapsed'],
+                                      result['rss_growth'] / 2**20))
+            if len(digests) > 1:
+                mismatches.append((files, structmap_type))
+    if mismatches:
+        print("current output differs from legacy for: {}".format(mismatches))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
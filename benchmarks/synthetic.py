@@ -0,0 +1,133 @@
+"""Generate synthetic SIPs for benchmarking mets_dnx.
+
+A SIP is written as one folder per rep (pm, mm and ad), each holding the
+same tree of nested directories and files, together with a JSON manifest
+per rep (pm.json, mm.json, ad.json) describing the same files for
+build_mets_from_json. This is also the layout that `mets-dnx batch`
+understands.
+
+Usage:
+
+    python benchmarks/synthetic.py OUTPUT_DIR --files 10000
+        [--sizes lognormal:10:2] [--depth 3] [--files-per-dir 100]
+        [--reps 1] [--seed 0]
+
+--files is the number of files per rep (10**2 to 10**6 are sensible).
+--sizes is a file size distribution, in bytes:
+
+    fixed:N           every file is N bytes (fixed:0 for metadata-only runs)
+    uniform:LOW:HIGH  sizes drawn uniformly from LOW to HIGH
+    lognormal:MU:SIGMA  sizes drawn from exp(normal(MU, SIGMA)), which is
+                      close to the long-tailed mix of real collections
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+
+
+REPS = ('pm', 'mm', 'ad')
+
+# the file contents are slices of this block, so that generating large
+# SIPs is bounded by disk speed rather than by the random number generator
+_POOL_SIZE = 2**22
+
+
+def size_sampler(spec, rng):
+    """Return a function producing file sizes for a distribution spec."""
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(':') if value]
+    if kind == 'fixed':
+        return lambda: int(values[0])
+    if kind == 'uniform':
+        return lambda: rng.randint(int(values[0]), int(values[1]))
+    if kind == 'lognormal':
+        return lambda: int(rng.lognormvariate(values[0], values[1]))
+    raise ValueError("unknown size distribution {!r}".format(spec))
+
+
+def directory_tree(files, depth, files_per_dir):
+    """Relative paths of the leaf directories for a tree of the given depth
+    with enough leaves to hold files at files_per_dir each."""
+    leaves = max(1, int(math.ceil(files / float(files_per_dir))))
+    if depth == 0:
+        return ['']
+    fanout = max(1, int(math.ceil(leaves ** (1.0 / depth))))
+    paths = ['']
+    for level in range(depth):
+        paths = [os.path.join(path, 'dir{:03d}'.format(i))
+                 for path in paths for i in range(fanout)]
+        if len(paths) >= leaves:
+            break
+    return paths[:leaves]
+
+
+def _write(filepath, size, pool, rng):
+    with open(filepath, 'wb') as f:
+        offset = rng.randrange(_POOL_SIZE)
+        while size > 0:
+            chunk = pool[offset:offset + size]
+            f.write(chunk)
+            size -= len(chunk)
+            offset = 0
+
+
+def generate_sip(sip_dir, files=1000, sizes='lognormal:10:2', depth=2,
+                 files_per_dir=100, reps=1, seed=0):
+    """Write a synthetic SIP to sip_dir. Returns a dict with the rep
+    directories, the manifest paths and the totals written."""
+    rng = random.Random(seed)
+    pool = bytes(bytearray(rng.getrandbits(8) for _ in range(256))) * (
+        _POOL_SIZE // 256)
+    sample_size = size_sampler(sizes, rng)
+    leaves = directory_tree(files, depth, files_per_dir)
+    summary = {'sip_dir': sip_dir, 'files': 0, 'bytes': 0}
+    for rep in REPS[:reps]:
+        rep_dir = os.path.join(sip_dir, rep)
+        manifest = []
+        for file_no in range(files):
+            leaf = leaves[file_no * len(leaves) // files]
+            directory = os.path.join(rep_dir, leaf)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            name = 'img{:07d}.tif'.format(file_no)
+            size = sample_size()
+            _write(os.path.join(directory, name), size, pool, rng)
+            original_path = os.path.join(rep, leaf, name).replace(os.sep, '/')
+            manifest.append({
+                'fileOriginalName': name,
+                'fileOriginalPath': original_path,
+                'fileSizeBytes': str(size),
+                'MD5': hashlib.md5(original_path.encode('utf-8')).hexdigest(),
+                'label': os.path.splitext(name)[0]})
+            summary['files'] += 1
+            summary['bytes'] += size
+        manifest_path = os.path.join(sip_dir, rep + '.json')
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        summary[rep + '_dir'] = rep_dir
+        summary[rep + '_json'] = manifest_path
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('output_dir')
+    parser.add_argument('--files', type=int, default=1000,
+                        help="files per rep")
+    parser.add_argument('--sizes', default='lognormal:10:2')
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--files-per-dir', type=int, default=100)
+    parser.add_argument('--reps', type=int, default=1, choices=(1, 2, 3))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    summary = generate_sip(args.output_dir, args.files, args.sizes,
+                           args.depth, args.files_per_dir, args.reps,
+                           args.seed)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
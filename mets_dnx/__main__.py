@@ -0,0 +1,6 @@
+import sys
+
+from mets_dnx.cli import main
+
+
+sys.exit(main())
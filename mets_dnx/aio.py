@@ -0,0 +1,254 @@
+"""asyncio variants of the METS builders, for use from an event loop.
+
+Every blocking call (listing a folder, stat'ing or hashing a file, opening
+a fixity cache, building and writing the document) is run in an executor,
+so the event loop is never blocked. On high-latency storage the time goes
+on round trips rather than on the CPU, so the builders keep up to
+concurrency folder listings, and then stat-and-hash operations, in flight
+at once instead of one after another.
+"""
+import asyncio
+import functools
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mets_dnx import factory
+from mets_dnx.model import IERecord, RepRecord
+
+
+async def _bounded_map(run, func, items, concurrency):
+    """Run func(item) for each of items through run(), with at most
+    concurrency calls in flight at a time; returns the results in the
+    order of items. A fixed set of workers takes the items in turn, so a
+    large list does not become one task per item."""
+    results = [None] * len(items)
+    positions = iter(range(len(items)))
+
+    async def worker():
+        for position in positions:
+            results[position] = await run(func, items[position])
+
+    workers = [asyncio.ensure_future(worker())
+               for _ in range(min(concurrency, len(items)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for task in workers:
+            task.cancel()
+        raise
+    return results
+
+
+async def scan_directory_async(directory, run, concurrency=16):
+    """The ScannedFiles of every file beneath directory, in the same order
+    as factory.scan_directory(). The folders of each level of the tree are
+    listed concurrently, then the files are stat'd concurrently; run(func,
+    *args) is a coroutine function calling func in an executor."""
+    listings = {}
+    level = [(directory, ())]
+    while level:
+        folder_listings = await _bounded_map(
+            run, factory._list_folder, [folder for folder, _ in level],
+            concurrency)
+        next_level = []
+        for (_, folders), (files, subfolders) in zip(level,
+                                                     folder_listings):
+            listings[folders] = (files, subfolders)
+            next_level.extend((entry.path, folders + (entry.name,))
+                              for entry in subfolders)
+        level = next_level
+
+    # put the files in scan_directory()'s order: folder by folder,
+    # depth first
+    ordered = []
+    stack = [()]
+    while stack:
+        folders = stack.pop()
+        files, subfolders = listings.pop(folders)
+        ordered.extend((entry, folders) for entry in files)
+        stack.extend(folders + (entry.name,)
+                     for entry in reversed(subfolders))
+    return await _bounded_map(
+        run, lambda item: factory._scanned_entry(*item), ordered,
+        concurrency)
+
+
+def loop_progress(progress, loop=None):
+    """A ProgressTracker calling the callback of progress (a callback or
+    ProgressTracker) on the event loop's thread, via call_soon_threadsafe(),
+    rather than on the thread doing the hashing, so that it is free to use
+    asyncio objects (e.g. to put the reports on an asyncio.Queue)."""
+    if progress is None:
+        return None
+    loop = loop or asyncio.get_running_loop()
+    tracker = factory._progress_tracker(progress)
+    return factory.ProgressTracker(
+        functools.partial(loop.call_soon_threadsafe, tracker.callback),
+        tracker.interval)
+
+
+def _executor_runner(executor):
+    loop = asyncio.get_running_loop()
+
+    async def run(func, *args):
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args))
+    return run
+
+
+async def build_mets_async(ie_dmd_dict=None,
+                pres_master_dir=None,
+                modified_master_dir=None,
+                access_derivative_dir=None,
+                cms=None,
+                webHarvesting=None,
+                generalIECharacteristics=None,
+                objectIdentifier=None,
+                accessRightsPolicy=None,
+                eventList=None,
+                input_dir=None,
+                digital_original=False,
+                structmap_type='DEFAULT',
+                algorithms=('MD5',),
+                fixity_cache=None,
+                checksum_manifest=None,
+                verify_manifest=None,
+                id_map=None,
+                output=None,
+                hooks=None,
+                progress=None,
+                concurrency=16,
+                executor=None,
+                exclude=None):
+    """A coroutine building the same METS as factory.build_mets() (see
+    there for the arguments), without blocking the event loop.
+
+    The rep directories are scanned with scan_directory_async(), then every
+    file is hashed, with up to concurrency stat or hash operations in
+    flight at a time. The document is then built (and, if output is given,
+    streamed to it) in the executor. A progress callback is called on the
+    event loop's thread; see loop_progress().
+
+    executor is the concurrent.futures executor to run the blocking calls
+    in; by default a thread pool of concurrency threads is created for the
+    build and shut down after it. A shared executor should have at least
+    concurrency workers, or fewer operations will be in flight.
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+    run = _executor_runner(executor)
+    try:
+        algorithms = factory._normalise_algorithms(algorithms)
+        fixity_cache = await run(factory._fixity_cache, fixity_cache)
+        hooks = hooks or factory._NO_HOOKS
+
+        ie = IERecord(
+            ie_dmd_dict=ie_dmd_dict,
+            generalIECharacteristics=generalIECharacteristics,
+            cms=cms,
+            webHarvesting=webHarvesting,
+            objectIdentifier=objectIdentifier,
+            accessRightsPolicy=accessRightsPolicy,
+            eventList=eventList,
+            digital_original=digital_original,
+            input_dir=input_dir)
+        with factory._phase(hooks, 'scan'):
+            for rep_dir, pres_type, rep_label in factory._reps(
+                    pres_master_dir, modified_master_dir,
+                    access_derivative_dir):
+                if not await run(os.listdir, rep_dir):
+                    raise ValueError(
+                        "rep directory {} is empty".format(rep_dir))
+                ie.reps.append(RepRecord(pres_type, rep_label, 'VIEW', [
+                    factory._scanned_record(
+                        scanned, factory._sip_href(input_dir, scanned.path))
+                    for scanned in factory._excluding(
+                        await scan_directory_async(rep_dir, run, concurrency),
+                        exclude)]))
+        factory._report_inventory(hooks, ie)
+
+        records = list(ie.files())
+        locations = [factory._file_original_location(input_dir, record.href)
+                     for record in records]
+        progress = loop_progress(progress)
+        if progress is not None:
+            progress.start(len(records),
+                           sum(record.size for record in records))
+        checksums = {}
+        with factory._phase(hooks, 'hash'):
+            if checksum_manifest is not None:
+                checksums, verify = await run(
+                    factory._manifest_checksums, checksum_manifest,
+                    input_dir, locations, algorithms, verify_manifest)
+                if progress is not None:
+                    verify_set = set(verify)
+                    for location in checksums:
+                        if location not in verify_set:
+                            progress.file_done(location)
+                factory._check_manifest_checksums(checksums, dict(zip(
+                    verify, await _bounded_map(
+                        run, functools.partial(factory._timed_checksums,
+                                               hooks, algorithms=algorithms,
+                                               progress=progress),
+                        verify, concurrency))))
+            unhashed = [location for location in locations
+                        if location not in checksums]
+            checksums.update(zip(unhashed, await _bounded_map(
+                run, functools.partial(factory._timed_checksums, hooks,
+                                       algorithms=algorithms,
+                                       cache=fixity_cache,
+                                       progress=progress),
+                unhashed, concurrency)))
+        for record, location in zip(records, locations):
+            record.checksums = checksums[location]
+        del records, locations, unhashed, checksums
+        if progress is not None:
+            progress.finish()
+
+        return await run(factory.render_mets, ie, structmap_type,
+                         algorithms, fixity_cache,
+                         {} if id_map is None else id_map, output, hooks)
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+async def build_single_file_mets_async(ie_dmd_dict=None,
+                filepath=None,
+                cms=None,
+                webHarvesting=None,
+                generalIECharacteristics=None,
+                objectIdentifier=None,
+                accessRightsPolicy=None,
+                eventList=None,
+                digital_original=False,
+                algorithms=('MD5',),
+                fixity_cache=None,
+                output=None,
+                hooks=None,
+                progress=None,
+                executor=None):
+    """A coroutine building the same METS as
+    factory.build_single_file_mets(), in executor (by default the event
+    loop's default executor). There is only the one file to stat and hash,
+    so the whole build is a single executor call. A progress callback is
+    called on the event loop's thread; see loop_progress()."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(
+        factory.build_single_file_mets,
+        ie_dmd_dict=ie_dmd_dict,
+        filepath=filepath,
+        cms=cms,
+        webHarvesting=webHarvesting,
+        generalIECharacteristics=generalIECharacteristics,
+        objectIdentifier=objectIdentifier,
+        accessRightsPolicy=accessRightsPolicy,
+        eventList=eventList,
+        digital_original=digital_original,
+        algorithms=algorithms,
+        fixity_cache=fixity_cache,
+        output=output,
+        hooks=hooks,
+        progress=loop_progress(progress, loop)))
@@ -0,0 +1,180 @@
+import os
+import pickle
+import time
+import traceback
+
+from collections import namedtuple
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                wait)
+from concurrent.futures.process import BrokenProcessPool
+
+from mets_dnx import factory
+from mets_dnx import spill
+
+
+BUILDERS = {
+    'directory': factory.build_mets,
+    'out_of_core': spill.build_mets_out_of_core,
+    'json': factory.build_mets_from_json,
+    'single_file': factory.build_single_file_mets,
+}
+
+
+JobResult = namedtuple('JobResult',
+    ['index', 'output', 'status', 'elapsed', 'error', 'traceback',
+     'files', 'bytes'])
+JobResult.__doc__ = """Outcome of one job in a batch.
+
+index: position of the job in the batch
+output: filepath the METS was written to
+status: 'ok' or 'failed'
+elapsed: seconds spent on the job in its worker
+error: the exception raised by the job, or None
+traceback: the formatted traceback of that exception, or None
+files: number of files in the SIP (None if the job failed)
+bytes: total size of those files (None if the job failed)
+"""
+JobResult.__new__.__defaults__ = (None, None)
+
+
+def _builder_name(job):
+    if 'builder' in job:
+        return job['builder']
+    if any(key.endswith('_json') for key in job):
+        return 'json'
+    if 'filepath' in job:
+        return 'single_file'
+    return 'directory'
+
+
+class _JobTotals(factory.BuildHooks):
+    """BuildHooks that note the number and size of the files a build
+    covers, for reporting throughput, and pass everything on to the job's
+    own hooks."""
+
+    def __init__(self, hooks=None):
+        self.hooks = hooks or factory._NO_HOOKS
+        self.files = None
+        self.size = None
+
+    def phase(self, name, seconds):
+        self.hooks.phase(name, seconds)
+
+    def file_hashed(self, filepath, seconds):
+        self.hooks.file_hashed(filepath, seconds)
+
+    def inventory(self, files, size):
+        self.files = files
+        self.size = size
+        self.hooks.inventory(files, size)
+
+
+def _picklable(error):
+    # exceptions travel back to the parent by pickling, so make sure that
+    # an exotic exception cannot take the whole batch down with it
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(repr(error))
+
+
+def run_job(index, job):
+    """Build and write the METS for a single job spec, returning a
+    JobResult rather than raising. The spec is a dict of keyword arguments
+    for the builder, plus 'output' (the filepath to write the METS to) and
+    optionally 'builder' ('directory', 'out_of_core', 'json' or
+    'single_file'; by default it is worked out from the other keys)."""
+    start = time.perf_counter()
+    job = dict(job)
+    output = job.pop('output', None)
+    try:
+        if not output:
+            raise ValueError("job {} has no output path".format(index))
+        builder_name = _builder_name(job)
+        builder = BUILDERS[builder_name]
+        job.pop('builder', None)
+        output_dir = os.path.dirname(os.path.abspath(output))
+        os.makedirs(output_dir, exist_ok=True)
+        totals = _JobTotals(job.pop('hooks', None))
+        builder(output=output, hooks=totals, **job)
+    except Exception as e:
+        return JobResult(index, output, 'failed',
+                         time.perf_counter() - start, _picklable(e),
+                         traceback.format_exc())
+    return JobResult(index, output, 'ok', time.perf_counter() - start,
+                     None, None, totals.files, totals.size)
+
+
+def build_batch(jobs, workers=None, defaults=None):
+    """Build a METS document for every job spec in jobs (see run_job()),
+    spread across a pool of worker processes.
+
+    Each worker streams its METS straight to the job's output path, so no
+    documents are passed back to the parent process. A job that fails is
+    recorded as such and does not stop the rest of the batch; if a worker
+    process dies outright, its jobs are marked as failed and a new pool is
+    started for the remainder.
+
+    defaults is an optional dict of builder keyword arguments applied to
+    every job (e.g. {'fixity_cache': path, 'algorithms': ('MD5',)}), which
+    the job specs themselves can override. With workers set to 1 the jobs
+    are run one after another in the current process.
+
+    Returns a list of JobResults, in the same order as jobs.
+    """
+    defaults = defaults or {}
+    specs = ((index, dict(defaults, **job)) for index, job in enumerate(jobs))
+    results = []
+    if workers == 1:
+        for index, job in specs:
+            results.append(run_job(index, job))
+        return results
+
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers)
+    # only a few jobs per worker are submitted at a time, so that a long
+    # iterator of job specs is not drained into memory up front
+    max_in_flight = workers * 2
+    in_flight = {}
+    try:
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    index, job = next(specs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(run_job, index, job)] = (index, job)
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                index, job = in_flight.pop(future)
+                try:
+                    results.append(future.result())
+                except BrokenProcessPool as e:
+                    broken = True
+                    results.append(JobResult(index, job.get('output'),
+                        'failed', None, e, traceback.format_exc()))
+                except Exception as e:
+                    # e.g. a job spec that could not be pickled to send
+                    # to the worker
+                    results.append(JobResult(index, job.get('output'),
+                        'failed', None, _picklable(e),
+                        traceback.format_exc()))
+            if broken:
+                # the futures still in flight belong to the dead pool too
+                for future, (index, job) in in_flight.items():
+                    results.append(JobResult(index, job.get('output'),
+                        'failed', None,
+                        BrokenProcessPool("worker process died"), None))
+                in_flight = {}
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=workers)
+    finally:
+        executor.shutdown()
+    results.sort(key=lambda result: result.index)
+    return results
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from lxml import etree as ET
+
+from mets_dnx import __version__
+
+
+class BuildCache(object):
+    """On-disk cache of whole METS documents, stored as files in a folder
+    and addressed by a digest of everything that goes into them.
+
+    The key (see key()) covers the IE-level builder arguments, every rep
+    and the name, path, size and modification and change times of every
+    file, the other options that shape the document, and the library
+    version. So a SIP that has not changed since its METS was built gets
+    the same document back without its files being hashed again, while any
+    change to a file's stat details, or to the arguments, builds it afresh.
+    As with FixityCache, a file rewritten in place with the same size and
+    times is taken to be unchanged.
+
+    Entries are written to a temporary file and renamed into place, so the
+    folder can be shared by concurrent workers. Nothing is ever evicted;
+    entries can be deleted at any time. Instances can be pickled, e.g. to
+    hand them to a process pool.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.directory)
+
+    def key(self, ie, **options):
+        """The hex digest keying the document rendered from an IERecord
+        (see mets_dnx.model), with options (e.g. structmap_type and
+        algorithms) as JSON-encodable keyword arguments."""
+        digest = hashlib.sha256()
+
+        def add(value):
+            digest.update(json.dumps(value, default=str).encode('utf-8'))
+            digest.update(b'\n')
+
+        add([__version__, sorted(options.items())])
+        add([ie.ie_dmd_dict, ie.generalIECharacteristics, ie.cms,
+             ie.webHarvesting, ie.objectIdentifier, ie.accessRightsPolicy,
+             ie.eventList, ie.digital_original])
+        for rep in ie.reps:
+            add([rep.preservation_type, rep.label, rep.use])
+            for record in rep.files:
+                add([record.folders, record.name, record.href, record.label,
+                     record.size, record.mtime_ns, record.ctime_ns,
+                     record.checksums, record.characteristics,
+                     record.events])
+        return digest.hexdigest()
+
+    def path(self, key):
+        """Where the document for key is stored."""
+        return os.path.join(self.directory, key[:2], key[2:] + '.xml')
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path(key))
+
+    def load(self, key, output=None):
+        """Copy the cached document for key to output (a filepath or
+        writable binary stream) and return None, or, without an output,
+        return it parsed."""
+        path = self.path(key)
+        if output is None:
+            return ET.parse(path, ET.XMLParser(huge_tree=True)).getroot()
+        _copy(path, output)
+
+    def store(self, key, render, output=None):
+        """Cache the document that render(output) builds, and deliver it as
+        load() does: with an output, render() is given a temporary file in
+        the cache to stream to, which is then copied to output; without
+        one, the tree render(None) returns is serialized into the cache.
+        Either way the document is then load()ed, so that a build gives the
+        same result whether the cache had it or not: a tree parsed from the
+        cached bytes, with the DNX elements in the DNX namespace."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = _temporary_file(path)
+        try:
+            if output is None:
+                mets = render(None)
+                with open(tmp_path, 'wb') as f:
+                    f.write(ET.tostring(mets, xml_declaration=True,
+                                        encoding='UTF-8'))
+            else:
+                render(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self.load(key, output)
+
+
+def _temporary_file(path):
+    # unique to the thread as well as the process, as threads may build
+    # the same document at once
+    return "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+
+def _copy(path, output):
+    if isinstance(output, (str, os.PathLike)):
+        tmp_path = _temporary_file(os.fspath(output))
+        try:
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    else:
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, output)
@@ -0,0 +1,407 @@
+"""Command-line interface for building Rosetta METS documents.
+
+    mets-dnx dir SIP_DIR -o mets.xml
+    mets-dnx json SIP_DIR --pm-json pm.jsonl -o mets.xml
+    mets-dnx batch PARENT_DIR --output-dir OUT --workers 8
+    mets-dnx verify mets.xml --input-dir SIP_DIR --workers 16
+
+Every command prints a JSON summary (files, bytes, throughput and
+failures) on stdout, and exits with status 1 if any SIP failed (or, for
+verify, if any file is missing, does not match its recorded size or
+fixity, or cannot be checked).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from pathlib import PurePath
+
+from mets_dnx import batch
+from mets_dnx import factory
+from mets_dnx import verify
+
+
+REP_DIRS = (('pm', 'pres_master_dir'),
+            ('mm', 'modified_master_dir'),
+            ('ad', 'access_derivative_dir'))
+
+REP_MANIFESTS = (('pm', 'pres_master_json'),
+                 ('mm', 'modified_master_json'),
+                 ('ad', 'access_derivative_json'))
+
+# manifest file extensions, in order of preference
+MANIFEST_EXTENSIONS = ('.json', '.jsonl', '.ndjson')
+
+IE_KEYS = ('ie_dmd_dict', 'generalIECharacteristics', 'cms',
+           'webHarvesting', 'objectIdentifier', 'accessRightsPolicy',
+           'eventList', 'digital_original')
+
+
+def _load_ie(path, sip_dir):
+    """IE-level builder arguments, from an ie.json in the SIP folder if
+    there is one, otherwise from the file given on the command line."""
+    sip_ie = os.path.join(sip_dir, 'ie.json')
+    if os.path.isfile(sip_ie):
+        path = sip_ie
+    ie = {}
+    if path:
+        with open(path) as f:
+            ie = json.load(f)
+        unknown = set(ie) - set(IE_KEYS)
+        if unknown:
+            raise ValueError("{} contains unsupported keys: {}".format(
+                path, sorted(unknown)))
+    ie.setdefault('ie_dmd_dict',
+                  {'dc:title': os.path.basename(os.path.normpath(sip_dir))})
+    return ie
+
+
+def _find_manifest(sip_dir, name):
+    for extension in MANIFEST_EXTENSIONS:
+        path = os.path.join(sip_dir, name + extension)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _metadata_files(sip_dir, args):
+    """The files in sip_dir that describe the SIP rather than belong to it:
+    its ie.json, the --ie-json and --checksum-manifest files, and any
+    pm/mm/ad manifests."""
+    paths = [os.path.join(sip_dir, 'ie.json')]
+    paths.extend(os.path.join(sip_dir, name + extension)
+                 for name, _ in REP_MANIFESTS
+                 for extension in MANIFEST_EXTENSIONS)
+    if args.ie_json:
+        paths.append(args.ie_json)
+    if args.checksum_manifest:
+        paths.append(os.path.join(sip_dir, args.checksum_manifest))
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def _bag(path):
+    """path, if it is a BagIt bag (a folder with a bagit.txt and a data
+    folder), otherwise None."""
+    if (os.path.isfile(os.path.join(path, 'bagit.txt')) and
+            os.path.isdir(os.path.join(path, 'data'))):
+        return path
+    return None
+
+
+def directory_job(sip_dir, output, args, pres_master_dir=None,
+                  modified_master_dir=None, access_derivative_dir=None):
+    """Job spec for a SIP laid out as directories. Unless the rep
+    directories are given, the pm, mm and ad subdirectories of sip_dir are
+    used if they exist. Otherwise, if sip_dir is a BagIt bag, or the
+    --checksum-manifest is a bag or one of its manifests, the bag's data
+    folder is the preservation master, with file paths relative to the
+    bag; failing that, sip_dir itself is the preservation master, less the
+    files that describe it (see _metadata_files())."""
+    job = _load_ie(args.ie_json, sip_dir)
+    manifest = None
+    if args.checksum_manifest:
+        manifest = os.path.join(sip_dir, args.checksum_manifest)
+        if not os.path.exists(manifest):
+            manifest = None
+    input_dir = sip_dir
+    reps = {'pres_master_dir': pres_master_dir,
+            'modified_master_dir': modified_master_dir,
+            'access_derivative_dir': access_derivative_dir}
+    if not any(reps.values()):
+        for name, key in REP_DIRS:
+            if os.path.isdir(os.path.join(sip_dir, name)):
+                reps[key] = os.path.join(sip_dir, name)
+    if not any(reps.values()):
+        bag = _bag(sip_dir)
+        if bag is None and manifest is not None:
+            bag = _bag(manifest if os.path.isdir(manifest)
+                       else os.path.dirname(manifest))
+        if bag is not None:
+            reps['pres_master_dir'] = os.path.join(bag, 'data')
+            input_dir = bag
+        else:
+            reps['pres_master_dir'] = sip_dir
+            exclude = _metadata_files(sip_dir, args)
+            if exclude:
+                job['exclude'] = exclude
+    job.update((key, value) for key, value in reps.items() if value)
+    job.update(output=output,
+               builder='directory',
+               input_dir=input_dir,
+               structmap_type=args.structmap_type,
+               algorithms=args.algorithms,
+               fixity_workers=args.fixity_workers,
+               fixity_cache=args.fixity_cache)
+    if args.build_cache:
+        job['build_cache'] = args.build_cache
+    if args.memory_limit:
+        job.update(builder='out_of_core',
+                   memory_limit=args.memory_limit * 2**20,
+                   spill_dir=args.spill_dir)
+    elif manifest is not None:
+        job.update(checksum_manifest=manifest,
+                   verify_manifest=args.verify_manifest)
+    if args.digital_original:
+        job['digital_original'] = True
+    return job
+
+
+def json_job(sip_dir, output, args, manifests):
+    """Job spec for a SIP described by JSON manifests, given as a dict of
+    builder argument name -> manifest filepath. The manifests are passed to
+    the builder as paths, so that each is read (a record at a time, for
+    JSON Lines) by the process building its METS."""
+    job = _load_ie(args.ie_json, sip_dir)
+    job.update((key, PurePath(path)) for key, path in manifests.items()
+               if path)
+    job.update(output=output,
+               builder='json',
+               input_dir=sip_dir,
+               structmap_type=args.structmap_type)
+    if args.build_cache:
+        job['build_cache'] = args.build_cache
+    if args.digital_original:
+        job['digital_original'] = True
+    return job
+
+
+def _make_job(rejected, make_job, sip_dir, output, *args):
+    """A list of the job spec make_job(sip_dir, output, *args) returns, or,
+    if that raises (e.g. for a malformed ie.json), an empty list, with
+    (sip_dir, output, exception) appended to rejected."""
+    try:
+        return [make_job(sip_dir, output, *args)]
+    except Exception as e:
+        rejected.append((sip_dir, output, e))
+        return []
+
+
+def sip_jobs(parent_dir, output_dir, args, rejected):
+    """Job specs for every SIP folder directly inside parent_dir. Folders
+    holding a pm.json or pm.jsonl (and optionally mm and ad manifests) are
+    built from those manifests, the rest from their directories. Each METS is written
+    to OUTPUT_DIR/<sip folder name>/mets.xml. SIPs whose job spec cannot be
+    made are left out, and listed in rejected (see _make_job())."""
+    for name in sorted(os.listdir(parent_dir)):
+        sip_dir = os.path.join(parent_dir, name)
+        if not os.path.isdir(sip_dir):
+            continue
+        output = os.path.join(output_dir, name, 'mets.xml')
+        manifests = {key: _find_manifest(sip_dir, manifest)
+                     for manifest, key in REP_MANIFESTS}
+        if any(manifests.values()):
+            jobs = _make_job(rejected, json_job, sip_dir, output, args,
+                             manifests)
+        else:
+            jobs = _make_job(rejected, directory_job, sip_dir, output, args)
+        for job in jobs:
+            yield job
+
+
+def summarise(input_dirs, results, elapsed, rejected=()):
+    """Summary of the JobResults of a batch, with input_dirs the input
+    folder of each job and rejected the (input folder, output, exception)
+    of each SIP that no job could be made for."""
+    files = sum(result.files or 0 for result in results)
+    size = sum(result.bytes or 0 for result in results)
+    failures = [{'input_dir': input_dirs[result.index],
+                 'output': result.output,
+                 'error': repr(result.error)}
+                for result in results if result.status != 'ok']
+    failures.extend({'input_dir': input_dir,
+                     'output': output,
+                     'error': repr(error)}
+                    for input_dir, output, error in rejected)
+    failures.sort(key=lambda failure: failure['input_dir'])
+    sips = len(results) + len(rejected)
+    return {
+        'sips': sips,
+        'succeeded': sips - len(failures),
+        'failed': len(failures),
+        'files': files,
+        'bytes': size,
+        'elapsed': round(elapsed, 3),
+        'files_per_second': round(files / elapsed, 1) if elapsed else None,
+        'bytes_per_second': round(size / elapsed, 1) if elapsed else None,
+        'failures': failures,
+    }
+
+
+def verify_summary(checks, start):
+    """Summary of the FileChecks from verify.verify_mets(), in the same
+    form as summarise()'s, timed from start (a time.perf_counter() value)
+    to when the last check is done."""
+    files = 0
+    size = 0
+    failures = []
+    for check in checks:
+        files += 1
+        size += check.size or 0
+        if check.status != 'ok':
+            failures.append({'file_id': check.file_id,
+                             'path': check.path,
+                             'status': check.status,
+                             'expected': check.expected,
+                             'actual': check.actual})
+    elapsed = time.perf_counter() - start
+    return {
+        'files': files,
+        'succeeded': files - len(failures),
+        'failed': len(failures),
+        'bytes': size,
+        'elapsed': round(elapsed, 3),
+        'files_per_second': round(files / elapsed, 1) if elapsed else None,
+        'bytes_per_second': round(size / elapsed, 1) if elapsed else None,
+        'failures': failures,
+    }
+
+
+def _algorithms(value):
+    return tuple(algorithm.strip() for algorithm in value.split(','))
+
+
+def _verification(value):
+    return value if value == 'full' else int(value)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='mets-dnx',
+        description="Build Rosetta METS/DNX documents.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--ie-json',
+        help="JSON file of IE-level builder arguments (ie_dmd_dict, "
+             "generalIECharacteristics, cms, ...); an ie.json inside a "
+             "SIP folder takes precedence")
+    common.add_argument('--digital-original', action='store_true')
+    common.add_argument('--structmap-type', default='DEFAULT',
+                        choices=('DEFAULT', 'PHYSICAL', 'BOTH'))
+    common.add_argument('--algorithms', type=_algorithms, default=('MD5',),
+                        help="comma-separated fixity algorithms, "
+                             "e.g. MD5,SHA256")
+    common.add_argument('--fixity-workers', type=int, default=None,
+                        help="threads hashing files within each SIP")
+    common.add_argument('--fixity-cache',
+                        help="SQLite fixity cache database")
+    common.add_argument('--checksum-manifest',
+        help="checksums to use instead of hashing: a BagIt "
+             "manifest-<algorithm>.txt or bag folder, relative to each SIP "
+             "folder (e.g. manifest-md5.txt); ignored where it does not "
+             "exist. Only a bag's data folder is taken as content")
+    common.add_argument('--verify-manifest', type=_verification,
+        help="check the checksum manifest against the files first: 'full', "
+             "or the number of files to check at random")
+    common.add_argument('--build-cache',
+        help="folder of METS documents already built: an unchanged SIP "
+             "built with the same options is copied from it rather than "
+             "built again")
+    common.add_argument('--memory-limit', type=int, default=None,
+        help="build directory SIPs out of core, spilling their file records "
+             "to a temporary database and keeping the memory they use "
+             "within this many MiB (not with --checksum-manifest or "
+             "--build-cache)")
+    common.add_argument('--spill-dir',
+        help="folder for the temporary databases of --memory-limit "
+             "(default: the system's temporary folder)")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    dir_parser = subparsers.add_parser('dir', parents=[common],
+        help="build a METS for a SIP laid out as directories")
+    dir_parser.add_argument('sip_dir')
+    dir_parser.add_argument('-o', '--output', required=True)
+    dir_parser.add_argument('--pm', help="preservation master directory")
+    dir_parser.add_argument('--mm', help="modified master directory")
+    dir_parser.add_argument('--ad', help="access derivative directory")
+    dir_parser.add_argument('--profile',
+        help="write a cProfile of the build to this file, for pstats")
+
+    json_parser = subparsers.add_parser('json', parents=[common],
+        help="build a METS for a SIP described by JSON manifests")
+    json_parser.add_argument('sip_dir')
+    json_parser.add_argument('-o', '--output', required=True)
+    json_parser.add_argument('--pm-json', required=True,
+        help="preservation master manifest: a JSON list of file records, "
+             "or a JSON Lines file (.jsonl, .ndjson) of one per line")
+    json_parser.add_argument('--mm-json')
+    json_parser.add_argument('--ad-json')
+    json_parser.add_argument('--profile',
+        help="write a cProfile of the build to this file, for pstats")
+
+    batch_parser = subparsers.add_parser('batch', parents=[common],
+        help="build a METS for every SIP folder in a parent folder")
+    batch_parser.add_argument('parent_dir')
+    batch_parser.add_argument('--output-dir', required=True)
+    batch_parser.add_argument('--workers', type=int, default=None,
+                              help="SIPs built in parallel (default: one "
+                                   "per CPU)")
+
+    verify_parser = subparsers.add_parser('verify',
+        help="check the files a METS describes against their recorded "
+             "size and fixity")
+    verify_parser.add_argument('mets')
+    verify_parser.add_argument('--input-dir', default=None,
+        help="the folder the fileOriginalPaths are relative to (default: "
+             "the folder holding the METS)")
+    verify_parser.add_argument('--workers', type=int, default=None,
+                               help="threads hashing files")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'memory_limit', None) and (args.checksum_manifest or
+                                                args.build_cache):
+        parser.error("--memory-limit cannot be used with --checksum-manifest "
+                     "or --build-cache")
+    if args.command == 'verify':
+        input_dir = args.input_dir
+        if input_dir is None:
+            input_dir = os.path.dirname(os.path.abspath(args.mets))
+        start = time.perf_counter()
+        checks = verify.verify_mets(args.mets, input_dir, args.workers)
+        summary = verify_summary(checks, start)
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 1 if summary['failed'] else 0
+    workers = 1
+    rejected = []
+    if args.command == 'dir':
+        jobs = _make_job(rejected, directory_job, args.sip_dir, args.output,
+                         args, args.pm, args.mm, args.ad)
+    elif args.command == 'json':
+        jobs = _make_job(rejected, json_job, args.sip_dir, args.output, args,
+                         {'pres_master_json': args.pm_json,
+                          'modified_master_json': args.mm_json,
+                          'access_derivative_json': args.ad_json})
+    else:
+        jobs = sip_jobs(args.parent_dir, args.output_dir, args, rejected)
+        workers = args.workers
+    # job specs are generated lazily, so that manifests are only read as
+    # their SIPs are submitted; keep the input dirs for the summary
+    input_dirs = []
+
+    def tracked(jobs):
+        for job in jobs:
+            input_dirs.append(job['input_dir'])
+            yield job
+
+    start = time.perf_counter()
+    if getattr(args, 'profile', None):
+        # a single SIP, built in this process
+        results = factory.profile_build(args.profile, batch.build_batch,
+                                        tracked(jobs), workers=workers)
+    else:
+        results = batch.build_batch(tracked(jobs), workers=workers)
+    summary = summarise(input_dirs, results, time.perf_counter() - start,
+                        rejected)
+    json.dump(summary, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,15 @@
+import cProfile
 import hashlib
 import json
+import mmap
 import os
-import re
+import random
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from contextlib import contextmanager
 from copy import deepcopy
 
 from lxml import etree as ET
@@ -15,76 +21,544 @@ from pymets import mets_factory as mf
 from pymets import mets_model as mm
 from pydnx import factory as dnx_factory
 
+from mets_dnx.build_cache import BuildCache
+from mets_dnx.fixity_cache import FixityCache
+from mets_dnx.model import FileRecord, IERecord, RepRecord
 
-def generate_md5(filepath, block_size=2**20):
-    """For producing md5 checksums for a file at a specified filepath."""
-    m = hashlib.md5()
-    with open(filepath, "rb") as f:
-        while True:
-            buf = f.read(block_size)
-            if not buf:
-                break
-            m.update(buf)
-    return m.hexdigest()
+
+# Rosetta fixityType values, mapped to their hashlib names
+FIXITY_ALGORITHMS = {
+    'MD5': 'md5',
+    'SHA1': 'sha1',
+    'SHA256': 'sha256',
+    'SHA512': 'sha512',
+}
+
+# Files at least this large are hashed through a memory map rather than
+# read into a buffer
+MMAP_THRESHOLD = 2**26
+
+_read_buffers = threading.local()
+
+
+def _normalise_algorithms(algorithms):
+    """Turn a fixityType or list of fixityTypes (e.g. 'md5', 'SHA-256')
+    into a tuple of Rosetta fixityType values, dropping duplicates."""
+    if algorithms is None:
+        algorithms = ('MD5',)
+    elif isinstance(algorithms, str):
+        algorithms = (algorithms,)
+    normalised = []
+    for algorithm in algorithms:
+        fixity_type = algorithm.upper().replace('-', '')
+        if fixity_type not in FIXITY_ALGORITHMS:
+            raise ValueError(
+                "\"{}\" is not a supported fixity algorithm "
+                "( acceptable values are {} )".format(
+                    algorithm, sorted(FIXITY_ALGORITHMS)))
+        if fixity_type not in normalised:
+            normalised.append(fixity_type)
+    return tuple(normalised)
+
+
+def _fixity_cache(fixity_cache):
+    """Accept either a FixityCache or the path to its database."""
+    if fixity_cache is None or isinstance(fixity_cache, FixityCache):
+        return fixity_cache
+    return FixityCache(fixity_cache)
+
+
+def _build_cache(build_cache):
+    """Accept either a BuildCache or the path to its folder."""
+    if build_cache is None or isinstance(build_cache, BuildCache):
+        return build_cache
+    return BuildCache(build_cache)
+
+
+class BuildHooks(object):
+    """Receives timings from the builders, which take an instance as their
+    hooks argument. The methods here do nothing; override them to record or
+    trace the timings (see PhaseTimings).
+
+    phase() is called with the name of each phase of a build as it ends,
+    and the seconds it took. The phases are 'scan' (walking the rep
+    directories), 'hash' (checksums generated up front, or verified against
+    a checksum manifest), 'ie' (the IE dmdSec and amdSec), 'assemble' (the
+    rep and file amdSecs, fileSec and structMaps), 'structmaps' (flattening
+    them for structmap_type), 'populate' (the DNX of each file amdSec,
+    including hashing any file not hashed up front) and 'serialize'
+    (writing a streamed document, not counting 'populate').
+    file_hashed() is called with the path of each file checksummed and the
+    seconds it took (including any fixity cache lookup); it may be called
+    from several threads at once.
+    inventory() is called once the files a build covers are known, with
+    their number and total size in bytes (for a JSON manifest, the
+    fileSizeBytes it gives, where it gives them)."""
+
+    def phase(self, name, seconds):
+        pass
+
+    def file_hashed(self, filepath, seconds):
+        pass
+
+    def inventory(self, files, size):
+        pass
+
+
+_NO_HOOKS = BuildHooks()
+
+
+class PhaseTimings(BuildHooks):
+    """BuildHooks that total the time spent in each phase, in the phases
+    dict, and list the (filepath, seconds) of each file hashed, in
+    hash_latencies."""
+
+    def __init__(self):
+        self.phases = {}
+        self.hash_latencies = []
+
+    def phase(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def file_hashed(self, filepath, seconds):
+        self.hash_latencies.append((filepath, seconds))
+
+
+def _report_inventory(hooks, ie):
+    files = 0
+    size = 0
+    for record in ie.files():
+        files += 1
+        if record.size is not None:
+            size += record.size
+        else:
+            size += int((record.characteristics or {}).get('fileSizeBytes')
+                        or 0)
+    hooks.inventory(files, size)
+
+
+@contextmanager
+def _phase(hooks, name):
+    start = time.perf_counter()
+    yield
+    hooks.phase(name, time.perf_counter() - start)
+
+
+ProgressReport = namedtuple('ProgressReport',
+    ['files_done', 'files_total', 'bytes_hashed', 'bytes_total',
+     'current_file', 'bytes_per_second', 'elapsed'])
+ProgressReport.__doc__ = """Progress of a build, as passed to a progress
+callback.
+
+files_done: files whose checksums have been generated (or found in the
+    fixity cache, a checksum manifest or the build cache)
+files_total: files in the SIP
+bytes_hashed: bytes read and hashed so far, including the part of a file
+    still being hashed
+bytes_total: total size of the files in the SIP (files found in the fixity
+    cache, a checksum manifest or the build cache are not read)
+current_file: the file most recently started
+bytes_per_second: the hashing rate since the previous report, or over the
+    whole build in the final report
+elapsed: seconds since hashing started
+"""
+
+
+class ProgressTracker(object):
+    """Counts the files and bytes hashed by a build, and passes a
+    ProgressReport to callback at most once every interval seconds, plus
+    once when the build is finished. The builders take an instance as their
+    progress argument, or a bare callback, which is given a tracker with the
+    default interval.
+
+    The counters are updated from whichever thread is hashing, under a
+    lock; callback is called from one of those threads, outside the lock,
+    and should return quickly (see mets_dnx.aio for running it on an event
+    loop instead)."""
+
+    def __init__(self, callback, interval=1.0):
+        self.callback = callback
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self, files_total=None, bytes_total=None):
+        with self._lock:
+            self._files_total = files_total
+            self._bytes_total = bytes_total
+            self._files_done = 0
+            self._bytes_hashed = 0
+            self._current_file = None
+            self._start = self._last_time = time.perf_counter()
+            self._last_bytes = 0
+
+    def _report(self, now, final=False):
+        # with the lock held
+        if final:
+            self._last_time = self._start
+            self._last_bytes = 0
+        rate = 0.0
+        if now > self._last_time:
+            rate = (self._bytes_hashed - self._last_bytes) / (
+                now - self._last_time)
+        self._last_time = now
+        self._last_bytes = self._bytes_hashed
+        return ProgressReport(self._files_done, self._files_total,
+                              self._bytes_hashed, self._bytes_total,
+                              self._current_file, rate, now - self._start)
+
+    def hashed(self, size):
+        """Record size more bytes hashed; called for each block read."""
+        with self._lock:
+            self._bytes_hashed += size
+            now = time.perf_counter()
+            if now - self._last_time < self.interval:
+                return
+            report = self._report(now)
+        self.callback(report)
+
+    def file_started(self, filepath):
+        with self._lock:
+            self._current_file = filepath
+
+    def file_done(self, filepath):
+        with self._lock:
+            self._files_done += 1
+            now = time.perf_counter()
+            if now - self._last_time < self.interval:
+                return
+            report = self._report(now)
+        self.callback(report)
+
+    def finish(self):
+        """Send a final report, whenever the last one was."""
+        with self._lock:
+            report = self._report(time.perf_counter(), final=True)
+        self.callback(report)
+
+
+def _progress_tracker(progress):
+    if progress is None or isinstance(progress, ProgressTracker):
+        return progress
+    return ProgressTracker(progress)
+
+
+def profile_build(profile_output, builder, *args, **kwargs):
+    """Call builder (e.g. build_mets) with args and kwargs under cProfile,
+    dump the profile to the file profile_output (for the pstats module or
+    a viewer such as snakeviz) and return what the builder returned."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(builder, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_output)
+
+
+def _read_buffer(block_size):
+    """Return a memoryview over a per-thread bytearray of block_size bytes,
+    so that the same buffer is reused for every file a thread hashes."""
+    view = getattr(_read_buffers, 'view', None)
+    if view is None or len(view) != block_size:
+        view = memoryview(bytearray(block_size))
+        _read_buffers.view = view
+    return view
+
+
+def _hash_with_readinto(f, hashers, block_size, on_read=None):
+    view = _read_buffer(block_size)
+    while True:
+        size = f.readinto(view)
+        if not size:
+            break
+        if size < block_size:
+            with view[:size] as chunk:
+                for hasher in hashers:
+                    hasher.update(chunk)
+        else:
+            for hasher in hashers:
+                hasher.update(view)
+        if on_read is not None:
+            on_read(size)
+
+
+def _hash_with_mmap(f, size, hashers, block_size, on_read=None):
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, block_size):
+                with view[offset:offset + block_size] as chunk:
+                    for hasher in hashers:
+                        hasher.update(chunk)
+                    if on_read is not None:
+                        on_read(len(chunk))
+
+
+def generate_checksums(filepath, algorithms=('MD5',), block_size=2**20,
+                       cache=None, mmap_threshold=MMAP_THRESHOLD,
+                       on_read=None):
+    """For producing several checksums for a file at a specified filepath
+    in a single read. Returns a dict of hex digests keyed by fixityType.
+    If a FixityCache is supplied, the file is only read when the cache has
+    no current digests for it.
+    Files are read with readinto() into a reused per-thread buffer; files of
+    at least mmap_threshold bytes are memory mapped instead (pass None to
+    never memory map).
+    on_read, if given, is called with the number of bytes in each block as
+    it is hashed (e.g. ProgressTracker.hashed)."""
+    algorithms = _normalise_algorithms(algorithms)
+    if cache is not None:
+        checksums, st = cache.lookup(filepath, algorithms)
+        if checksums is not None:
+            return checksums
+    hashers = [hashlib.new(FIXITY_ALGORITHMS[algorithm])
+               for algorithm in algorithms]
+    with open(filepath, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if (mmap_threshold is not None and size > 0
+                and size >= mmap_threshold):
+            try:
+                _hash_with_mmap(f, size, hashers, block_size, on_read)
+            except (OSError, ValueError):
+                # some filesystems cannot be memory mapped
+                hashers = [hashlib.new(FIXITY_ALGORITHMS[algorithm])
+                           for algorithm in algorithms]
+                f.seek(0)
+                _hash_with_readinto(f, hashers, block_size, on_read)
+        else:
+            _hash_with_readinto(f, hashers, block_size, on_read)
+    checksums = {algorithm: hasher.hexdigest()
+                 for algorithm, hasher in zip(algorithms, hashers)}
+    if cache is not None:
+        cache.store(filepath, checksums, st)
+    return checksums
 
 
-def build_amdsec(amdsec, tech_sec=None, rights_sec=None,
-                 source_sec=None, digiprov_sec=None):
-    amd_id = amdsec.attrib['ID']
-    amd_tech = ET.SubElement(
-                    amdsec,
-                    "{http://www.loc.gov/METS/}techMD",
-                    ID=amd_id + "-tech")
-    amd_rights = ET.SubElement(
-                    amdsec,
-                    "{http://www.loc.gov/METS/}rightsMD",
-                    ID=amd_id + "-rights")
-    amd_source = ET.SubElement(
-                    amdsec,
-                    "{http://www.loc.gov/METS/}sourceMD",
-                    ID=amd_id + "-source")
-    amd_digiprov = ET.SubElement(
-                    amdsec,
-                    "{http://www.loc.gov/METS/}digiprovMD",
-                    ID=amd_id + "-digiprov")
-
-    for el in [amd_tech, amd_rights, amd_source, amd_digiprov]:
+def generate_md5(filepath, block_size=2**20, cache=None):
+    """For producing md5 checksums for a file at a specified filepath."""
+    return generate_checksums(filepath, ('MD5',), block_size, cache)['MD5']
+
+
+def generate_checksums_for_files(filepaths, algorithms=('MD5',),
+                                 workers=None, block_size=2**20, cache=None,
+                                 mmap_threshold=MMAP_THRESHOLD, hooks=None,
+                                 progress=None):
+    """For producing checksums for a list of filepaths. Returns a dict of
+    generate_checksums() results keyed by filepath. If workers is greater
+    than 1, files are hashed concurrently in a thread pool of that size
+    (hashlib releases the GIL while digesting large buffers, so threads are
+    enough to keep several reads in flight). hooks is an optional
+    BuildHooks, told how long each file took, and progress an optional
+    ProgressTracker (or callback; see ProgressTracker), which is not
+    started or finished here."""
+    filepaths = list(filepaths)
+    algorithms = _normalise_algorithms(algorithms)
+    progress = _progress_tracker(progress)
+
+    def checksums_for(filepath):
+        return _timed_checksums(hooks or _NO_HOOKS, filepath, algorithms,
+                                block_size, cache, mmap_threshold,
+                                progress=progress)
+
+    if not workers or workers < 2 or len(filepaths) < 2:
+        return {filepath: checksums_for(filepath) for filepath in filepaths}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(filepaths, executor.map(checksums_for, filepaths)))
+
+
+def _timed_checksums(hooks, filepath, *args, progress=None, **kwargs):
+    start = time.perf_counter()
+    if progress is None:
+        checksums = generate_checksums(filepath, *args, **kwargs)
+    else:
+        progress.file_started(filepath)
+        checksums = generate_checksums(filepath, *args,
+                                       on_read=progress.hashed, **kwargs)
+        progress.file_done(filepath)
+    hooks.file_hashed(filepath, time.perf_counter() - start)
+    return checksums
+
+
+def generate_md5s(filepaths, workers=None, block_size=2**20, cache=None):
+    """For producing md5 checksums for a list of filepaths. Returns a dict
+    of checksums keyed by filepath."""
+    checksums = generate_checksums_for_files(
+        filepaths, ('MD5',), workers, block_size, cache)
+    return {filepath: checksums[filepath]['MD5'] for filepath in checksums}
+
+
+def _file_fixity(checksums, algorithms):
+    return [{'fixityType': algorithm, 'fixityValue': checksums[algorithm]}
+            for algorithm in algorithms]
+
+
+# The length of a hex digest for each fixityType, to tell which algorithm
+# a bare digest in a checksum manifest is for
+_DIGEST_LENGTHS = dict(
+    (hashlib.new(name).digest_size * 2, algorithm)
+    for algorithm, name in FIXITY_ALGORITHMS.items())
+
+
+def _digest_algorithm(digest):
+    algorithm = _DIGEST_LENGTHS.get(len(digest))
+    if algorithm is None:
+        raise ValueError("{!r} is not a digest of any supported fixity "
+                         "algorithm".format(digest))
+    return algorithm
+
+
+def _unescape_bagit_path(path):
+    # BagIt percent-encodes CR, LF and % in manifest filepaths
+    return (path.replace('%0D', '\r').replace('%0A', '\n')
+                .replace('%25', '%'))
+
+
+def _read_bagit_manifest(path, checksums):
+    directory = os.path.dirname(os.path.abspath(path))
+    name = os.path.basename(path)
+    algorithm = None
+    if name.startswith('manifest-') and name.endswith('.txt'):
+        algorithm = name[len('manifest-'):-len('.txt')].upper()
+        if algorithm not in FIXITY_ALGORITHMS:
+            raise ValueError("{} is not a manifest of a supported fixity "
+                             "algorithm".format(path))
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            digest, filepath = line.split(None, 1)
+            filepath = _unescape_bagit_path(filepath)
+            location = os.path.normpath(os.path.join(directory, filepath))
+            checksums.setdefault(location, {})[
+                algorithm or _digest_algorithm(digest)] = digest.lower()
+
+
+def read_checksum_manifest(manifest, input_dir=None):
+    """Read checksums generated elsewhere, returning a dict of {fixityType:
+    hex digest} dicts keyed by absolute, normalised filepath.
+
+    manifest is one of:
+    - the path of a BagIt payload manifest (e.g. a bag's manifest-md5.txt),
+      whose filepaths are relative to the folder holding it; the algorithm
+      is taken from the file name, or from the length of each digest
+    - the path of a bag, whose manifest-<algorithm>.txt files are all read
+    - a dict of filepath -> digest, or filepath -> {fixityType: digest},
+      with relative filepaths taken to be relative to input_dir. A bare
+      digest's algorithm is worked out from its length."""
+    checksums = {}
+    if isinstance(manifest, (str, os.PathLike)):
+        manifest = os.fspath(manifest)
+        if os.path.isdir(manifest):
+            for name in sorted(os.listdir(manifest)):
+                if (name.startswith('manifest-') and name.endswith('.txt')
+                        and name[len('manifest-'):-len('.txt')].upper()
+                        in FIXITY_ALGORITHMS):
+                    _read_bagit_manifest(os.path.join(manifest, name),
+                                         checksums)
+        else:
+            _read_bagit_manifest(manifest, checksums)
+        return checksums
+    for filepath, digests in manifest.items():
+        location = os.path.abspath(os.path.join(input_dir or '',
+                                                os.fspath(filepath)))
+        if isinstance(digests, str):
+            digests = {_digest_algorithm(digests): digests}
+        checksums.setdefault(location, {}).update(
+            (_normalise_algorithms(algorithm)[0], digest.lower())
+            for algorithm, digest in digests.items())
+    return checksums
+
+
+def _manifest_checksums(checksum_manifest, input_dir, locations, algorithms,
+                        verify_manifest):
+    """The checksums that checksum_manifest (see read_checksum_manifest())
+    gives for every algorithm of each of locations, keyed by location, and
+    the locations among them to verify: all of them if verify_manifest is
+    'full', a random sample of that many if it is a number, otherwise
+    none."""
+    recorded = read_checksum_manifest(checksum_manifest, input_dir)
+    checksums = {}
+    for location in locations:
+        digests = recorded.get(os.path.abspath(location))
+        if digests and all(algorithm in digests
+                           for algorithm in algorithms):
+            checksums[location] = dict((algorithm, digests[algorithm])
+                                       for algorithm in algorithms)
+    if verify_manifest == 'full':
+        verify = list(checksums)
+    elif verify_manifest:
+        verify = random.sample(list(checksums),
+                               min(int(verify_manifest), len(checksums)))
+    else:
+        verify = []
+    return checksums, verify
+
+
+def _check_manifest_checksums(checksums, generated):
+    """Raise a ValueError if any of the generated checksums differ from the
+    ones a checksum manifest gave."""
+    mismatches = sorted(location for location in generated
+                        if generated[location] != checksums[location])
+    if mismatches:
+        raise ValueError(
+            "{} file(s) do not match the checksum manifest: {}".format(
+                len(mismatches), ', '.join(mismatches[:10])
+                + (', ...' if len(mismatches) > 10 else '')))
+
+
+# DNX fragments that are the same for every document are built once, and
+# copies of them inserted, rather than constructing them afresh for every
+# file and rep: an amdSec whose four sections each hold an empty dnx
+# placeholder, and the rep techMD for each (preservationType,
+# digital_original).
+_AMDSEC_SECTIONS = (('techMD', '-tech'), ('rightsMD', '-rights'),
+                    ('sourceMD', '-source'), ('digiprovMD', '-digiprov'))
+
+
+def _build_empty_amdsec():
+    amdsec = ET.Element("{http://www.loc.gov/METS/}amdSec")
+    for tag, _ in _AMDSEC_SECTIONS:
+        el = ET.SubElement(amdsec, "{http://www.loc.gov/METS/}" + tag)
         mdWrap = ET.SubElement(
                         el,
                         "{http://www.loc.gov/METS/}mdWrap",
                         MDTYPE="OTHER", OTHERMDTYPE="dnx")
         xmlData = ET.SubElement(mdWrap, "{http://www.loc.gov/METS/}xmlData")
-        if (el.tag == "{http://www.loc.gov/METS/}techMD" and
-                tech_sec != None):
-            xmlData.append(tech_sec)
-        elif (el.tag == "{http://www.loc.gov/METS/}techMD" and
-                tech_sec == None):
-            xmlData.append(ET.Element("dnx",
-                xmlns="http://www.exlibrisgroup.com/dps/dnx"))
-
-        if (el.tag == "{http://www.loc.gov/METS/}rightsMD" and
-                rights_sec != None):
-            xmlData.append(rights_sec)
-        elif (el.tag == "{http://www.loc.gov/METS/}rightsMD" and
-                rights_sec == None):
-            xmlData.append(ET.Element("dnx",
-                xmlns="http://www.exlibrisgroup.com/dps/dnx"))
-
-        if (el.tag == "{http://www.loc.gov/METS/}sourceMD" and
-                source_sec != None):
-            xmlData.append(source_sec)
-        elif (el.tag == "{http://www.loc.gov/METS/}sourceMD" and
-                source_sec == None):
-            xmlData.append(ET.Element("dnx",
-                xmlns="http://www.exlibrisgroup.com/dps/dnx"))
-
-        if (el.tag == "{http://www.loc.gov/METS/}digiprovMD" and
-                digiprov_sec != None):
-            xmlData.append(digiprov_sec)
-        elif (el.tag == "{http://www.loc.gov/METS/}digiprovMD" and
-                digiprov_sec == None):
-            xmlData.append(ET.Element("dnx",
-                xmlns="http://www.exlibrisgroup.com/dps/dnx"))
+        xmlData.append(ET.Element("dnx",
+            xmlns="http://www.exlibrisgroup.com/dps/dnx"))
+    return amdsec
+
+
+_EMPTY_AMDSEC = _build_empty_amdsec()
+_rep_amd_tech_templates = {}
+
+
+def _rep_amd_tech(preservation_type, digital_original):
+    """A copy of the generalRepCharacteristics techMD DNX for a rep."""
+    key = (preservation_type, str(digital_original).lower())
+    template = _rep_amd_tech_templates.get(key)
+    if template is None:
+        template = dnx_factory.build_rep_amdTech(
+            generalRepCharacteristics=[{'RevisionNumber': '1',
+                'DigitalOriginal': key[1],
+                'usageType': 'VIEW',
+                'preservationType': preservation_type}])
+        _rep_amd_tech_templates[key] = template
+    return deepcopy(template)
+
+
+def build_amdsec(amdsec, tech_sec=None, rights_sec=None,
+                 source_sec=None, digiprov_sec=None):
+    amd_id = amdsec.attrib['ID']
+    amdsec.extend(deepcopy(_EMPTY_AMDSEC))
+    for el, (_, suffix), sec in zip(
+            amdsec[-4:], _AMDSEC_SECTIONS,
+            (tech_sec, rights_sec, source_sec, digiprov_sec)):
+        el.attrib['ID'] = amd_id + suffix
+        if sec is not None:
+            xmlData = el[0][0]
+            xmlData.replace(xmlData[0], sec)
 
 
 def _build_ie_dmd_amd(mets,
@@ -149,7 +623,349 @@ def _build_ie_dmd_amd(mets,
             ie_amd_digiprov,
             ie_amd_source)
 
-def build_mets(ie_dmd_dict=None,
+def _flocat_href(fl):
+    return fl.find('./{http://www.loc.gov/METS/}FLocat').attrib[
+        '{http://www.w3.org/1999/xlink}href']
+
+
+def _file_original_location(input_dir, href):
+    return os.path.join(input_dir, os.path.normpath(href))
+
+
+def _map_ids(id_map, old_id, new_id):
+    """Add an ID, along with the IDs derived from it for its amdSec and
+    that amdSec's sections, to an old ID -> new ID mapping table."""
+    id_map[old_id] = new_id
+    id_map[old_id + '-amd'] = new_id + '-amd'
+    for section in ('tech', 'rights', 'source', 'digiprov'):
+        id_map['{}-amd-{}'.format(old_id, section)] = '{}-amd-{}'.format(
+            new_id, section)
+
+
+ScannedFile = namedtuple('ScannedFile',
+    ['path', 'folders', 'name', 'size', 'mtime_ns', 'ctime_ns'])
+ScannedFile.__doc__ = """A file found by scan_directory().
+
+path: the file's path (the scanned directory joined with folders and name)
+folders: tuple of the names of the folders between the directory and file
+name: the file's name
+size: size in bytes
+mtime_ns: modification time, in nanoseconds since the epoch
+ctime_ns: ctime (metadata change time on Unix, creation time on Windows),
+    in nanoseconds since the epoch
+"""
+
+
+def _ordered_names(names):
+    # The order pymets gives the files in a folder: names sorted
+    # alphabetically, then names whose stem is an integer sorted
+    # numerically. Names with the same number (e.g. 1.jpg and 01.jpg) are
+    # sorted alphabetically, rather than left in listing order.
+    int_names = []
+    str_names = []
+    for name in names:
+        try:
+            int(name[:name.rfind(".")])
+            int_names.append(name)
+        except ValueError:
+            str_names.append(name)
+    int_names.sort(key=lambda name: (int(name[:name.rfind(".")]), name))
+    return sorted(str_names) + int_names
+
+
+def scan_directory(directory):
+    """Yield a ScannedFile for every file beneath directory, from a single
+    os.scandir() pass over each folder and one stat per file.
+    Files are yielded in the order the pymets directory walk used: folder
+    by folder, top-down, with the files in each folder in the order given
+    by _ordered_names(). Subfolders are taken in name order, rather than
+    the order the file system lists them in, so that the same tree always
+    gives the same document. Symbolic links to folders are not followed."""
+    stack = [(directory, ())]
+    while stack:
+        folder, folders = stack.pop()
+        files, subfolders = _list_folder(folder)
+        for entry in files:
+            yield _scanned_entry(entry, folders)
+        stack.extend((entry.path, folders + (entry.name,))
+                     for entry in reversed(subfolders))
+
+
+def _list_folder(folder):
+    """The os.DirEntry of each file in folder, in _ordered_names() order,
+    and of each subfolder that is not a symbolic link, in name order."""
+    files = {}
+    subfolders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files[entry.name] = entry
+            elif not entry.is_symlink():
+                subfolders.append(entry)
+    subfolders.sort(key=lambda entry: entry.name)
+    return [files[name] for name in _ordered_names(files)], subfolders
+
+
+def _scanned_entry(entry, folders):
+    st = entry.stat()
+    return ScannedFile(entry.path, folders, entry.name, st.st_size,
+                       st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _scan_file(filepath):
+    st = os.stat(filepath)
+    return ScannedFile(filepath, (), os.path.basename(filepath), st.st_size,
+                       st.st_mtime_ns, st.st_ctime_ns)
+
+
+def _sip_href(input_dir, filepath):
+    # as pymets does, trim input_dir from the start of the path
+    href = filepath[len(input_dir):]
+    if href[0] == "/" or href[0] == "\\":
+        href = href[1:]
+    return href.replace('\\', '/')
+
+
+def _timestamp(time_ns):
+    return time.strftime("%Y-%m-%dT%H:%M:%S",
+                         time.localtime(time_ns // 10**9))
+
+
+def _time_zone():
+    """What identifies the local time zone that _timestamp() uses."""
+    return [os.environ.get('TZ'), time.tzname, time.timezone, time.altzone]
+
+
+class _DivTree(object):
+    """Builds the nested folder and file divs of a structMap beneath a
+    given div. The folder divs under each div are kept in a dict keyed by
+    LABEL, so a file is placed with one lookup per folder in its path
+    rather than a search of the sibling divs at each level."""
+
+    def __init__(self, div):
+        self._root = (div, {})
+
+    def add_file(self, folders, label, file_id):
+        """Append a FILE div for file_id, labelled label, under the folder
+        divs named by folders, creating any that do not exist yet."""
+        div, children = self._root
+        for folder in folders:
+            node = children.get(folder)
+            if node is None:
+                folder_div = mm.Div(LABEL=str(folder))
+                div.append(folder_div)
+                node = children[folder] = (folder_div, {})
+            div, children = node
+        file_div = mm.Div(LABEL=str(label), TYPE="FILE")
+        file_div.append(mm.Fptr(FILEID=file_id))
+        div.append(file_div)
+
+
+def _build_file_amdsec(fl_amdsec, scanned, file_original_path, file_fixity):
+    """Populate a file amdSec from its ScannedFile, without any further
+    stat calls."""
+    general_file_characteristics = [{
+        'fileOriginalPath': file_original_path,
+        'fileSizeBytes': str(scanned.size),
+        'fileModificationDate': _timestamp(scanned.mtime_ns),
+        'fileCreationDate': _timestamp(scanned.ctime_ns),
+        'fileOriginalName': scanned.name,
+        'label': os.path.splitext(scanned.name)[0]}]
+
+    fl_amd_tech = dnx_factory.build_file_amdTech(
+        generalFileCharacteristics=general_file_characteristics,
+        fileFixity=file_fixity)
+    build_amdsec(fl_amdsec, tech_sec=fl_amd_tech)
+
+
+def write_mets(mets, output, populate=None):
+    """Serialize a METS document to output (a filepath or a writable binary
+    stream) one top-level section at a time, using lxml's incremental
+    xmlfile writer. Each section is removed from the tree as soon as it has
+    been written, so that it can be freed; the tree is left empty.
+    If populate is given, it is called with each section just before the
+    section is written.
+    When output is a filepath, the document is written to a temporary file
+    alongside it, which replaces output once the document is complete."""
+    _write_atomically(output,
+                      lambda target: _write_sections(mets, target, populate))
+
+
+def _write_atomically(output, write):
+    """Call write() with output, or, if output is a filepath, with a
+    temporary file alongside it that replaces output once write() has
+    returned."""
+    if isinstance(output, (str, os.PathLike)):
+        output = os.fspath(output)
+        # unique to the thread as well as the process, as threads may
+        # write the same output at once
+        tmp_path = "{}.{}.{}.tmp".format(output, os.getpid(),
+                                         threading.get_ident())
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    else:
+        write(output)
+
+
+def _discard(section):
+    # Free a section's subtree before detaching it: lxml moves a removed
+    # element's whole subtree into a document of its own, which is very
+    # slow for a large fileSec or structMap.
+    section.clear()
+    section.getparent().remove(section)
+
+
+def _write_sections(mets, output, populate):
+    with ET.xmlfile(output, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(mets.tag, attrib=dict(mets.attrib), nsmap=mets.nsmap):
+            while len(mets):
+                section = mets[0]
+                if populate is not None:
+                    populate(section)
+                xf.write(section)
+                _discard(section)
+                del section
+
+
+def _complete_mets(mets, pending, populate, output=None, hooks=_NO_HOOKS):
+    """Populate the file amdSecs that were deferred while the rest of the
+    document was built. pending maps the (final) ID of each empty file
+    amdSec to the details that populate(amdsec, details) needs to fill it in.
+    Without an output, every amdSec is populated and the document returned.
+    Otherwise the document is streamed to output by write_mets(), and each
+    file amdSec is populated just before it is written and freed straight
+    after, so that only one file's DNX is held in memory at a time.
+    The time spent populating, and for a streamed document the rest of the
+    time spent writing it, are reported to hooks as the 'populate' and
+    'serialize' phases."""
+    populating = [0]
+
+    def populate_section(section):
+        details = pending.pop(section.get('ID'), None)
+        if details is not None:
+            start = time.perf_counter()
+            populate(section, details)
+            populating[0] += time.perf_counter() - start
+
+    if output is None:
+        for amdsec in mets.iterchildren('{http://www.loc.gov/METS/}amdSec'):
+            populate_section(amdsec)
+        hooks.phase('populate', populating[0])
+        return mets
+    start = time.perf_counter()
+    write_mets(mets, output, populate_section)
+    hooks.phase('populate', populating[0])
+    hooks.phase('serialize', time.perf_counter() - start - populating[0])
+
+
+def _reps(pres_master_dir, modified_master_dir, access_derivative_dir):
+    """The (directory, preservationType, structMap label) of each rep, as
+    pymets made them: a preservation master, optionally followed by a
+    modified master and/or an access derivative."""
+    reps = []
+    if pres_master_dir != None:
+        reps.append((pres_master_dir, 'PRESERVATION_MASTER',
+                     'Preservation Master'))
+        if modified_master_dir != None:
+            reps.append((modified_master_dir, 'MODIFIED_MASTER',
+                         'Modified Master'))
+        if access_derivative_dir != None:
+            reps.append((access_derivative_dir, 'DERIVATIVE_COPY',
+                         'Derivative Copy'))
+    return reps
+
+
+def _renumber_amdsec(amdsec, amd_id):
+    amdsec.attrib['ID'] = amd_id
+    suffixes = dict(("{http://www.loc.gov/METS/}" + tag, suffix)
+                    for tag, suffix in _AMDSEC_SECTIONS)
+    for el in amdsec:
+        if el.tag in suffixes:
+            el.attrib['ID'] = amd_id + suffixes[el.tag]
+
+
+def _append_rep(place, filesec, rep_no, rep_amdsec, rep, pending, kept=None):
+    """Add a rep's amdSec and file amdSecs to the document, by calling
+    place() on each in order, and its fileGrp to filesec, numbering them
+    for rep_no; returns the rep's structMap.
+    rep is a RepRecord. Each of its files gets an empty amdSec, recorded in
+    pending against its FileRecord for _complete_mets() to populate, unless
+    kept maps the FileRecord to an already populated amdSec to renumber and
+    reuse."""
+    rep_id = 'rep{}'.format(rep_no)
+    _renumber_amdsec(rep_amdsec, rep_id + '-amd')
+    place(rep_amdsec)
+
+    if rep.use is None:
+        filegrp = mm.FileGrp(ID=rep_id, ADMID=rep_id + '-amd')
+    else:
+        filegrp = mm.FileGrp(USE=rep.use, ID=rep_id, ADMID=rep_id + '-amd')
+    filesec.append(filegrp)
+
+    # The structMap for the rep, with a "Table of Contents" div (which
+    # Rosetta requires) between the top div and the file divs.
+    # 2017-02-16 (SM): Modify the file label in the structmaps so that it
+    # does not contain file extensions. This is an NDHA requirement, so I
+    # am reluctant to put this on the actual METS factory level.
+    structmap = mm.StructMap(ID=rep_id + '-1', TYPE='PHYSICAL')
+    top_div = mm.Div(LABEL=rep.label)
+    structmap.append(top_div)
+    toc_div = mm.Div(LABEL='Table of Contents')
+    top_div.append(toc_div)
+    div_tree = _DivTree(toc_div)
+
+    for file_no, record in enumerate(rep.files, 1):
+        fl_id = 'fid{}-{}'.format(file_no, rep_no)
+        fl_amdsec = kept.get(record) if kept else None
+        if fl_amdsec is None:
+            fl_amdsec = mm.AmdSec(ID=fl_id + '-amd')
+            pending[fl_id + '-amd'] = record
+        else:
+            _renumber_amdsec(fl_amdsec, fl_id + '-amd')
+        place(fl_amdsec)
+        file_el = mm.File(ID=fl_id, ADMID=fl_id + '-amd')
+        file_el.append(mm.FLocat(href=record.href, LOCTYPE='URL'))
+        filegrp.append(file_el)
+        div_tree.add_file(record.folders, record.structmap_label, fl_id)
+    return structmap
+
+
+def _record_populator(input_dir, algorithms, fixity_cache, hooks=_NO_HOOKS,
+                      progress=None):
+    """A function populating a file amdSec from its FileRecord, for
+    _complete_mets(). A file described by a manifest is recorded as given;
+    a scanned file without checksums is hashed now."""
+    def populate_file_amdsec(fl_amdsec, record):
+        if record.characteristics is not None:
+            _build_fl_amd_from_json(fl_amdsec, record)
+            return
+        checksums = record.checksums
+        if checksums is None:
+            checksums = _timed_checksums(
+                hooks, _file_original_location(input_dir, record.href),
+                algorithms, cache=fixity_cache, progress=progress)
+        _build_file_amdsec(fl_amdsec, record,
+                           Path(os.path.normpath(record.href)).as_posix(),
+                           _file_fixity(checksums, algorithms))
+    return populate_file_amdsec
+
+
+def _scanned_record(scanned, href, folders=None):
+    return FileRecord(scanned.folders if folders is None else folders,
+                      scanned.name, href, size=scanned.size,
+                      mtime_ns=scanned.mtime_ns, ctime_ns=scanned.ctime_ns)
+
+
+def directory_inventory(ie_dmd_dict=None,
                 pres_master_dir=None,
                 modified_master_dir=None,
                 access_derivative_dir=None,
@@ -161,160 +977,523 @@ def build_mets(ie_dmd_dict=None,
                 eventList=None,
                 input_dir=None,
                 digital_original=False,
-                structmap_type='DEFAULT'):
+                exclude=None):
+    """The IERecord (see mets_dnx.model) that build_mets() renders for
+    these arguments. Each rep directory is walked once with
+    scan_directory(), leaving out the files listed in exclude; the files
+    are not hashed."""
+    ie = IERecord(ie_dmd_dict=ie_dmd_dict,
+                  generalIECharacteristics=generalIECharacteristics,
+                  cms=cms,
+                  webHarvesting=webHarvesting,
+                  objectIdentifier=objectIdentifier,
+                  accessRightsPolicy=accessRightsPolicy,
+                  eventList=eventList,
+                  digital_original=digital_original,
+                  input_dir=input_dir)
+    for rep_dir, pres_type, rep_label in _reps(
+            pres_master_dir, modified_master_dir, access_derivative_dir):
+        if not os.listdir(rep_dir):
+            raise ValueError("rep directory {} is empty".format(rep_dir))
+        ie.reps.append(RepRecord(pres_type, rep_label, 'VIEW', [
+            _scanned_record(scanned, _sip_href(input_dir, scanned.path))
+            for scanned in _excluding(scan_directory(rep_dir), exclude)]))
+    return ie
+
+
+def _excluding(scanned_files, exclude):
+    """The ScannedFiles that are not among the filepaths in exclude."""
+    if not exclude:
+        return scanned_files
+    excluded = set(os.path.abspath(os.fspath(path)) for path in exclude)
+    return (scanned for scanned in scanned_files
+            if os.path.abspath(scanned.path) not in excluded)
 
-    mets = mf.build_mets()
 
-    _build_ie_dmd_amd(mets,
+def build_mets(ie_dmd_dict=None,
+                pres_master_dir=None,
+                modified_master_dir=None,
+                access_derivative_dir=None,
+                cms=None,
+                webHarvesting=None,
+                generalIECharacteristics=None,
+                objectIdentifier=None,
+                accessRightsPolicy=None,
+                eventList=None,
+                input_dir=None,
+                digital_original=False,
+                structmap_type='DEFAULT',
+                fixity_workers=None,
+                algorithms=('MD5',),
+                fixity_cache=None,
+                checksum_manifest=None,
+                verify_manifest=None,
+                id_map=None,
+                output=None,
+                hooks=None,
+                progress=None,
+                build_cache=None,
+                exclude=None):
+    """Build a METS XML file from directories of files, one directory
+    per rep. If fixity_workers is set, the checksums of every file in
+    every rep are generated up front by a pool of that many threads, rather
+    than one file at a time as each file amdSec is built.
+    algorithms lists the fixityTypes to record for each file (e.g.
+    ('MD5', 'SHA256')); all of them are generated from a single read.
+    fixity_cache is a FixityCache (or the path to one) that is consulted
+    before a file is read, so unchanged files are not hashed again.
+    checksum_manifest supplies checksums generated elsewhere, e.g. a bag's
+    manifest-md5.txt (see read_checksum_manifest()): files it has every
+    algorithm for are not hashed. verify_manifest checks it against the
+    files first, reading them all if 'full', or a random sample of that
+    many if it is a number, and raises a ValueError if any differ.
+    Each rep directory is walked once with scan_directory(), and the
+    stat details it records are used for the file amdSecs. This is the
+    same as rendering directory_inventory() with render_mets().
+    exclude lists filepaths to leave out of the scan, e.g. metadata kept in
+    a rep directory alongside the content.
+    If id_map is a dict, it is filled with the mapping from the IDs that
+    pymets' directory walk would have generated (e.g. "ie1-rep1-file1") to
+    the final Rosetta IDs (e.g. "fid1-1").
+    If output (a filepath or writable binary stream) is given, the
+    document is streamed to it rather than returned: each file amdSec is
+    built just before it is written and freed afterwards, so memory use
+    does not grow with the DNX of every file. In that case None is
+    returned.
+    hooks is an optional BuildHooks, told how long each phase of the build
+    and each file's hashing took.
+    progress is an optional callback, or ProgressTracker, which is given a
+    ProgressReport of the files and bytes hashed at regular intervals while
+    the files are hashed, and once they all have been.
+    build_cache is an optional BuildCache (or the path of its folder). If
+    it has the document for the same arguments and for files with the
+    same stat details as the scan finds, and in the same local time zone,
+    that document is returned (or copied to output) without any file being
+    hashed; otherwise the document built is stored in it. A build that
+    verifies checksum_manifest is never taken from the cache, as that
+    would skip reading the files, but its document is stored.
+    """
+    algorithms = _normalise_algorithms(algorithms)
+    fixity_cache = _fixity_cache(fixity_cache)
+    build_cache = _build_cache(build_cache)
+    hooks = hooks or _NO_HOOKS
+
+    with _phase(hooks, 'scan'):
+        ie = directory_inventory(
             ie_dmd_dict=ie_dmd_dict,
-            generalIECharacteristics=generalIECharacteristics,
+            pres_master_dir=pres_master_dir,
+            modified_master_dir=modified_master_dir,
+            access_derivative_dir=access_derivative_dir,
             cms=cms,
             webHarvesting=webHarvesting,
+            generalIECharacteristics=generalIECharacteristics,
             objectIdentifier=objectIdentifier,
             accessRightsPolicy=accessRightsPolicy,
-            eventList=eventList)
-
-    mf.build_amdsec_filegrp_structmap(
-        mets,
-        ie_id="ie1",
-        pres_master_dir=pres_master_dir,
-        modified_master_dir=modified_master_dir,
-        access_derivative_dir=access_derivative_dir,
-        digital_original=digital_original,
-        input_dir=input_dir)
-
-
-    # Create representation_level and file_level amdsecs, based on
-    # the filegrp details
-    file_groups = mets.findall('.//{http://www.loc.gov/METS/}fileGrp')
-    for file_group in file_groups:
-        rep_id = file_group.attrib['ID']
-        rep_type = mets.find('.//{%s}structMap[@ID="%s-1"]/{%s}div' %
-            ('http://www.loc.gov/METS/', rep_id, 'http://www.loc.gov/METS/')
-            ).attrib['LABEL']
-
-        if rep_type == 'Preservation Master':
-            pres_type = 'PRESERVATION_MASTER'
-            pres_location = pres_master_dir
-        elif rep_type == 'Modified Master':
-            pres_type = 'MODIFIED_MASTER'
-            pres_location = modified_master_dir
-        elif rep_type == 'Derivative Copy':
-            pres_location = access_derivative_dir
-            pres_type = 'DERIVATIVE_COPY'
-        else:
-            pres_type = None
-            pres_location = '.'
+            eventList=eventList,
+            input_dir=input_dir,
+            digital_original=digital_original,
+            exclude=exclude)
+    _report_inventory(hooks, ie)
+
+    if build_cache is not None:
+        manifest_checksums = None
+        if checksum_manifest is not None:
+            manifest_checksums = sorted(read_checksum_manifest(
+                checksum_manifest, input_dir).items())
+        cache_key = build_cache.key(ie, structmap_type=structmap_type,
+                                    algorithms=algorithms,
+                                    checksum_manifest=manifest_checksums,
+                                    time_zone=_time_zone())
+        if not verify_manifest and cache_key in build_cache:
+            if id_map is not None:
+                _map_inventory_ids(id_map, ie)
+            progress = _progress_tracker(progress)
+            if progress is not None:
+                # every file's checksums are in the cached document
+                records = list(ie.files())
+                progress.start(len(records),
+                               sum(record.size for record in records))
+                for record in records:
+                    progress.file_done(
+                        _file_original_location(input_dir, record.href))
+                progress.finish()
+            return build_cache.load(cache_key, output)
+
+    records = list(ie.files())
+    locations = [_file_original_location(input_dir, record.href)
+                 for record in records]
+    progress = _progress_tracker(progress)
+    if progress is not None:
+        progress.start(len(records),
+                       sum(record.size for record in records))
+    checksums = {}
+    with _phase(hooks, 'hash'):
+        if checksum_manifest is not None:
+            checksums, verify = _manifest_checksums(
+                checksum_manifest, input_dir, locations, algorithms,
+                verify_manifest)
+            if progress is not None:
+                verify_set = set(verify)
+                for location in checksums:
+                    if location not in verify_set:
+                        progress.file_done(location)
+            # verification reads the files themselves, not the fixity cache
+            _check_manifest_checksums(checksums, generate_checksums_for_files(
+                verify, algorithms=algorithms, workers=fixity_workers,
+                hooks=hooks, progress=progress))
+        if fixity_workers:
+            checksums.update(generate_checksums_for_files(
+                [location for location in locations
+                    if location not in checksums],
+                algorithms=algorithms,
+                workers=fixity_workers,
+                cache=fixity_cache,
+                hooks=hooks,
+                progress=progress))
+    for record, location in zip(records, locations):
+        record.checksums = checksums.get(location)
+    del records, locations, checksums
+
+    def render(output):
+        return render_mets(ie, structmap_type, algorithms, fixity_cache,
+                           {} if id_map is None else id_map, output, hooks,
+                           progress)
+    if build_cache is None:
+        return render(output)
+    return build_cache.store(cache_key, render, output)
+
+
+def _map_inventory_ids(id_map, ie):
+    """Fill id_map with the mapping from the IDs that pymets' directory
+    walk would have given the reps and files of an IERecord to their
+    Rosetta IDs."""
+    for rep_no, rep in enumerate(ie.reps, 1):
+        rep_id = 'rep{}'.format(rep_no)
+        _map_ids(id_map, 'ie1-' + rep_id, rep_id)
+        id_map['ie1-{}-1'.format(rep_id)] = rep_id + '-1'
+        for file_no in range(1, len(rep.files) + 1):
+            _map_ids(id_map, 'ie1-{}-file{}'.format(rep_id, file_no),
+                     'fid{}-{}'.format(file_no, rep_no))
+
+
+def render_mets(ie,
+                structmap_type='DEFAULT',
+                algorithms=('MD5',),
+                fixity_cache=None,
+                id_map=None,
+                output=None,
+                hooks=None,
+                progress=None):
+    """Render an IERecord (see mets_dnx.model), e.g. one made by
+    directory_inventory() or json_inventory() and then inspected or
+    altered, as a METS document.
+    Scanned files that have no checksums yet are hashed as their amdSecs
+    are rendered, with algorithms and fixity_cache as for build_mets().
+    If id_map is a dict, it is filled with the pymets IDs of the reps and
+    files, as in build_mets(). output, hooks and progress are as for
+    build_mets(); a ProgressTracker is used as it is, so that it can carry
+    on from hashing done beforehand, whereas a callback gets a new one
+    started for the files still to be hashed."""
+    algorithms = _normalise_algorithms(algorithms)
+    fixity_cache = _fixity_cache(fixity_cache)
+    hooks = hooks or _NO_HOOKS
+    if progress is not None and not isinstance(progress, ProgressTracker):
+        unhashed = [record for record in ie.files()
+                    if record.checksums is None
+                    and record.characteristics is None]
+        progress = ProgressTracker(progress)
+        progress.start(len(unhashed),
+                       sum(record.size or 0 for record in unhashed))
+        del unhashed
+
+    with _phase(hooks, 'ie'):
+        mets = mf.build_mets()
+        _build_ie_dmd_amd(mets,
+                ie_dmd_dict=ie.ie_dmd_dict,
+                generalIECharacteristics=ie.generalIECharacteristics,
+                cms=ie.cms,
+                webHarvesting=ie.webHarvesting,
+                objectIdentifier=ie.objectIdentifier,
+                accessRightsPolicy=ie.accessRightsPolicy,
+                eventList=ie.eventList)
+
+    # Create the representation and file level amdSecs, the fileSec and
+    # the structMaps, with their final Rosetta IDs. The file amdSecs are
+    # only recorded in pending here, and populated by _complete_mets() once
+    # the rest of the document is finished.
+    pending = {}
+    filesec = mm.FileSec()
+    structmap_list = []
+    with _phase(hooks, 'assemble'):
+        if id_map is not None:
+            _map_inventory_ids(id_map, ie)
+        for rep_no, rep in enumerate(ie.reps, 1):
+            rep_id = 'rep{}'.format(rep_no)
+            rep_amdsec = mm.AmdSec(ID=rep_id + '-amd')
+            build_amdsec(rep_amdsec, tech_sec=_rep_amd_tech(
+                rep.preservation_type, ie.digital_original))
+            structmap_list.append(_append_rep(
+                mets.append, filesec, rep_no, rep_amdsec, rep, pending))
+
+        if ie.reps:
+            mets.append(filesec)
+            for structmap in structmap_list:
+                mets.append(structmap)
+
+    populate_file_amdsec = _record_populator(
+        ie.input_dir, algorithms, fixity_cache, hooks, progress)
+    with _phase(hooks, 'structmaps'):
+        mets = _check_structmaps(mets, structmap_type)
+    mets = _complete_mets(mets, pending, populate_file_amdsec, output, hooks)
+    if progress is not None:
+        progress.finish()
+    return mets
 
-        rep_amdsec = mets.xpath("//mets:amdSec[@ID='%s']" %
-                str(rep_id + '-amd'), namespaces=mets.nsmap)[0]
-        general_rep_characteristics = [{'RevisionNumber': '1',
-                'DigitalOriginal': str(digital_original).lower(),
-                'usageType': 'VIEW',
-                'preservationType': pres_type}]
-        rep_amd_tech = dnx_factory.build_rep_amdTech(
-            generalRepCharacteristics=general_rep_characteristics)
-        rep_amd_rights = None
-        rep_amd_digiprov = None
-        rep_amd_source = None
-        build_amdsec(
-            rep_amdsec,
-            tech_sec=rep_amd_tech,
-            rights_sec=rep_amd_rights,
-            source_sec=rep_amd_source,
-            digiprov_sec=rep_amd_digiprov)
-
-        # create amdsec for files
-        for fl in file_group.findall('./{http://www.loc.gov/METS/}file'):
-            fl_id = fl.attrib['ID']
-            fl_amdsec = None
-            fl_amdsec = mets.xpath("//mets:amdSec[@ID='%s']" %
-                    str(fl_id + '-amd'), namespaces=mets.nsmap)[0]
-            file_original_location = os.path.join(input_dir,
-                os.path.normpath(fl.find('./{http://www.loc.gov/METS/}FLocat').attrib[
-                        '{http://www.w3.org/1999/xlink}href']))
-            file_original_name = os.path.normpath(file_original_location).split(os.path.sep)[-1]
-            file_label = os.path.splitext(file_original_name)[0]
-            file_size_bytes = os.path.getsize(file_original_location)
-            last_modified = time.strftime(
-                    "%Y-%m-%dT%H:%M:%S",
-                    time.localtime(os.path.getmtime(file_original_location)))
-            created_time = time.strftime(
-                    "%Y-%m-%dT%H:%M:%S",
-                    time.localtime(os.path.getctime(file_original_location)))
-            general_file_characteristics = [{
-                'fileOriginalPath': Path(os.path.normpath(fl.find('./{http://www.loc.gov/METS/}FLocat').attrib[
-                        '{http://www.w3.org/1999/xlink}href'])).as_posix(),
-                'fileSizeBytes': str(file_size_bytes),
-                'fileModificationDate': last_modified,
-                'fileCreationDate': created_time,
-                'fileOriginalName': file_original_name,
-                'label': file_label}]
-
-            file_fixity =  [{
-                'fixityType': 'MD5',
-                'fixityValue': generate_md5(file_original_location)}]
-
-            fl_amd_tech = dnx_factory.build_file_amdTech(
-                generalFileCharacteristics=general_file_characteristics,
-                fileFixity=file_fixity)
-            build_amdsec(fl_amdsec, tech_sec=fl_amd_tech)
-
-
-    # clean up identifiers so they are consistent with Rosetta requirements
-    for element in mets.xpath(".//*[@ID]"):
-        element.attrib['ID'] = re.sub(r'ie[0-9]+\-', '', element.attrib['ID'])
-        element.attrib['ID'] = re.sub(
-                r'rep([0-9]+)\-file([0-9]+)',
-                r'fid\2-\1',
-                element.attrib['ID'])
-    for element in mets.xpath(".//*[@ADMID]"):
-        element.attrib['ADMID'] = re.sub(
-                r'ie[0-9]+\-rep([0-9]+)\-file([0-9]+)-amd',
-                r'fid\2-\1-amd',
-                element.attrib['ADMID'])
-        element.attrib['ADMID'] = re.sub(
-                r'ie[0-9]+\-rep([0-9]+)-amd',
-                r'rep\1-amd',
-                element.attrib['ADMID'])
-    for element in mets.xpath(".//*[@FILEID]"):
-        element.attrib['FILEID'] = re.sub(
-                r'ie[0-9]+\-rep([0-9])+\-file([0-9]+)',
-                r'fid\2-\1',
-                element.attrib['FILEID'])
-
-    # 2017-02-16 (SM): Modify the file label in the structmaps so that it does
-    # not contain file extensions. This is an NDHA requirement, so I am
-    # reluctant to put this on the actual METS factory level.
-    # 2017-02-16 (SM): Add an order count to the divs in the structmap.
-    struct_maps = mets.findall('./{http://www.loc.gov/METS/}structMap')
-    for struct_map in struct_maps:
-        top_div_count = 0
-        top_divs = struct_map.findall('./{http://www.loc.gov/METS/}div')
-        for top_div in top_divs:
-            top_div_count += 1
-            # top_div.attrib['ORDER'] = str(top_div_count)
-             # Insert "Table of Contents" div between the file divs and the top div
-            toc_element = ET.Element('{http://www.loc.gov/METS/}div')
-            toc_element.attrib['LABEL'] = 'Table of Contents'
-
-            # lower_div_count = 0
-            file_divs = top_div.findall('./{http://www.loc.gov/METS/}div')
-            top_div.insert(0, toc_element)
-            for file_div in file_divs:
-            #     lower_div_count += 1
-            #     # 2017-07-20: Removing "ORDER" attribute
-            #     # file_div.attrib['ORDER'] = str(lower_div_count)
-                # file_div.attrib["LABEL"] = os.path.splitext(file_div.attrib["LABEL"])[0]
-            #     # 2017-07-19: commented out line below, not sure why it was there in the first place!
-            #     # del file_div.attrib['TYPE']
-                toc_element.append(file_div)
-            file_divs = top_div.findall('.//{http://www.loc.gov/METS/}div[@TYPE="FILE"]')
-            for file_div in file_divs:
-                file_div.attrib["LABEL"] = os.path.splitext(file_div.attrib["LABEL"])[0]
+
+def _file_sort_key(name):
+    # the position _ordered_names() gives a file among its folder's files
+    try:
+        return (1, int(name[:name.rfind(".")]), name)
+    except ValueError:
+        return (0, 0, name)
+
+
+def _insert_file(records, record):
+    """Insert a FileRecord into a rep's records, which are in
+    scan_directory() order, where a fresh scan would put it: after the
+    other files in its folder that sort before it, and, in a folder that
+    has no files yet, before any subfolders of it, and among the subfolders
+    of the nearest folder above that does by name."""
+    folders = record.folders
+    key = _file_sort_key(record.name)
+    block = [i for i, other in enumerate(records) if other.folders == folders]
+    if block:
+        position = block[-1] + 1
+        for i in block:
+            if _file_sort_key(records[i].name) > key:
+                position = i
+                break
+    else:
+        position = len(records)
+        for depth in range(len(folders), -1, -1):
+            subtree = [i for i, other in enumerate(records)
+                       if other.folders[:depth] == folders[:depth]]
+            if not subtree:
+                continue
+            position = subtree[-1] + 1
+            for i in subtree:
+                other = records[i].folders
+                if len(other) > depth and (depth == len(folders) or
+                                           other[depth] > folders[depth]):
+                    position = i
+                    break
+            break
+    records.insert(position, record)
+
+
+def _recorded_structmap_type(mets):
+    types = set(structmap.get('TYPE') for structmap in mets.iterchildren(
+        '{http://www.loc.gov/METS/}structMap'))
+    if 'LOGICAL' in types and 'PHYSICAL' in types:
+        return 'BOTH'
+    if types == set(['PHYSICAL']):
+        return 'PHYSICAL'
+    return 'DEFAULT'
+
+
+def update_mets(mets,
+                pres_master_dir=None,
+                modified_master_dir=None,
+                access_derivative_dir=None,
+                input_dir=None,
+                added=(),
+                removed=(),
+                changed=(),
+                structmap_type=None,
+                algorithms=None,
+                fixity_cache=None,
+                id_map=None,
+                output=None):
+    """Update a METS document made by build_mets() for files that have
+    been added, removed or changed since, without reading the others again.
+
+    mets is the document as returned by build_mets() (it is updated in
+    place), or the filepath of one that build_mets() wrote. The rep
+    directories and input_dir are the ones build_mets() was given; a rep
+    directory that the document does not have yet (e.g. a new access
+    derivative) is scanned and added in full. added, removed and changed
+    are paths of files within the rep directories.
+
+    Unchanged files keep their amdSecs, with their recorded fixity, and are
+    neither read nor stat'd. Added and changed files get new amdSecs. The
+    reps and files are then renumbered for their new positions (a file
+    added to an existing folder goes where a fresh scan would put it; see
+    _insert_file() for new folders), and the fileSec and structMaps are
+    rebuilt. If id_map is a dict, it is filled with the old -> new IDs of
+    the reps and files that were kept.
+
+    structmap_type and algorithms default to the ones found in the
+    document. If output is given, the document is streamed to it as in
+    build_mets(), and None is returned; otherwise the updated document is.
+    """
+    if isinstance(mets, (str, PurePath)):
+        mets = ET.parse(str(mets), ET.XMLParser(huge_tree=True)).getroot()
+    fixity_cache = _fixity_cache(fixity_cache)
+    if id_map is None:
+        id_map = {}
+    if structmap_type is None:
+        structmap_type = _recorded_structmap_type(mets)
+
+    # The reps recorded in the document, by preservationType, with their
+    # fileGrp ID, amdSec and (file ID, href, amdSec) for each file.
+    amdsecs = dict((amdsec.get('ID'), amdsec) for amdsec in
+                   mets.iterchildren('{http://www.loc.gov/METS/}amdSec'))
+    recorded = {}
+    for filegrp in mets.iterfind('./{http://www.loc.gov/METS/}fileSec'
+                                 '/{http://www.loc.gov/METS/}fileGrp'):
+        rep_amdsec = amdsecs[filegrp.get('ADMID')]
+        recorded[rep_amdsec.findtext('.//{*}key[@id="preservationType"]')] = (
+            filegrp.get('ID'), rep_amdsec,
+            [(fl.get('ID'), _flocat_href(fl), amdsecs[fl.get('ADMID')])
+                for fl in filegrp.iterchildren(
+                    '{http://www.loc.gov/METS/}file')])
+    del amdsecs
+
+    reps = _reps(pres_master_dir, modified_master_dir, access_derivative_dir)
+    missing = set(recorded) - set(pres_type for _, pres_type, _ in reps)
+    if missing:
+        raise ValueError("no directory given for the document's {} "
+                         "rep".format(', '.join(sorted(missing))))
+    digital_original = False
+    for _, rep_amdsec, files in recorded.values():
+        digital_original = rep_amdsec.findtext(
+            './/{*}key[@id="DigitalOriginal"]')
+        # record the same fixity for new files as for the existing ones
+        if algorithms is None and files:
+            algorithms = [key.text for key in files[0][2].iterfind(
+                './/{*}key[@id="fixityType"]')]
+    algorithms = _normalise_algorithms(algorithms or ('MD5',))
+
+    def rep_path(path):
+        # the rep a file is in, and its folders and name within the rep
+        for rep_dir, pres_type, _ in reps:
+            relative = os.path.relpath(os.path.abspath(path),
+                                       os.path.abspath(rep_dir))
+            if relative != os.curdir and not relative.startswith(os.pardir):
+                parts = relative.split(os.sep)
+                return pres_type, tuple(parts[:-1]), parts[-1]
+        raise ValueError("{} is not in any of the rep directories".format(
+            path))
+
+    updates = {}
+    for change, paths in (('added', added), ('removed', removed),
+                          ('changed', changed)):
+        for path in paths:
+            pres_type, folders, name = rep_path(path)
+            updates.setdefault(pres_type, {})[(folders, name)] = change
+
+    # Work out each rep's files, in order, as FileRecords; kept maps the
+    # records of unchanged files to their amdSecs, and old_ids to their
+    # file IDs. Only added and changed files, and the files of new reps,
+    # are stat'd.
+    rep_records = []
+    kept = {}
+    old_ids = {}
+    for rep_dir, pres_type, rep_label in reps:
+        if pres_type not in recorded:
+            # a new rep; any added paths within it are part of the scan
+            if not os.listdir(rep_dir):
+                raise ValueError("rep directory {} is empty".format(rep_dir))
+            rep_records.append(RepRecord(pres_type, rep_label, 'VIEW', [
+                _scanned_record(scanned, _sip_href(input_dir, scanned.path))
+                for scanned in scan_directory(rep_dir)]))
+            continue
+
+        records = []
+        positions = {}
+        for fl_id, href, amdsec in recorded[pres_type][2]:
+            parts = os.path.relpath(_file_original_location(input_dir, href),
+                                    rep_dir).split(os.sep)
+            positions[(tuple(parts[:-1]), parts[-1])] = len(records)
+            record = FileRecord(tuple(parts[:-1]), parts[-1], href)
+            records.append(record)
+            kept[record] = amdsec
+            old_ids[record] = fl_id
+        rep_updates = sorted(updates.get(pres_type, {}).items())
+        removed_records = set()
+        for (folders, name), change in rep_updates:
+            path = os.path.join(rep_dir, *(folders + (name,)))
+            if (change == 'added') == ((folders, name) in positions):
+                raise ValueError("{} {} is {} in the document".format(
+                    change, path,
+                    'already' if change == 'added' else 'not'))
+            if change == 'added':
+                continue
+            position = positions[(folders, name)]
+            record = records[position]
+            _discard(kept.pop(record))
+            del old_ids[record]
+            if change == 'removed':
+                removed_records.add(record)
+            else:
+                records[position] = _scanned_record(_scan_file(path),
+                                                    record.href, folders)
+        records = [record for record in records
+                   if record not in removed_records]
+        # (added files are inserted last, as this moves the others along)
+        for (folders, name), change in rep_updates:
+            if change == 'added':
+                path = os.path.join(rep_dir, *(folders + (name,)))
+                _insert_file(records, _scanned_record(
+                    _scan_file(path), _sip_href(input_dir, path), folders))
+        rep_records.append(RepRecord(pres_type, rep_label, 'VIEW', records))
+
+    # The fileSec and structMaps are rebuilt from scratch. The amdSecs that
+    # are kept stay where they are, with new ones placed in order among
+    # them.
+    for section in list(mets.iterchildren(
+            '{http://www.loc.gov/METS/}fileSec',
+            '{http://www.loc.gov/METS/}structMap')):
+        _discard(section)
+    last = [None]
+    if recorded:
+        last[0] = next(iter(recorded.values()))[1].getprevious()
+
+    def place(amdsec):
+        if amdsec.getparent() is None:
+            if last[0] is None:
+                mets.append(amdsec)
+            else:
+                last[0].addnext(amdsec)
+        last[0] = amdsec
+
+    pending = {}
+    filesec = mm.FileSec()
+    structmap_list = []
+    for rep_no, rep in enumerate(rep_records, 1):
+        if rep.preservation_type in recorded:
+            old_rep_id, rep_amdsec, _ = recorded[rep.preservation_type]
+            _map_ids(id_map, old_rep_id, 'rep{}'.format(rep_no))
+            id_map[old_rep_id + '-1'] = 'rep{}-1'.format(rep_no)
+        else:
+            rep_amdsec = mm.AmdSec(ID='rep{}-amd'.format(rep_no))
+            build_amdsec(rep_amdsec, tech_sec=_rep_amd_tech(
+                rep.preservation_type, digital_original))
+        for file_no, record in enumerate(rep.files, 1):
+            if record in old_ids:
+                _map_ids(id_map, old_ids[record],
+                         'fid{}-{}'.format(file_no, rep_no))
+        structmap_list.append(_append_rep(
+            place, filesec, rep_no, rep_amdsec, rep, pending, kept))
+    del recorded, kept, old_ids, rep_records
+    if reps:
+        mets.append(filesec)
+        for structmap in structmap_list:
+            mets.append(structmap)
 
     mets = _check_structmaps(mets, structmap_type)
-    return mets
+    return _complete_mets(mets, pending, _record_populator(
+        input_dir, algorithms, fixity_cache), output)
 
 
 def build_single_file_mets(ie_dmd_dict=None,
@@ -325,64 +1504,60 @@ def build_single_file_mets(ie_dmd_dict=None,
                 objectIdentifier=None,
                 accessRightsPolicy=None,
                 eventList=None,
-                digital_original=False):
-    mets = mf.build_mets()
-    _build_ie_dmd_amd(mets,
-            ie_dmd_dict=ie_dmd_dict,
-            generalIECharacteristics=generalIECharacteristics,
-            cms=cms,
-            webHarvesting=webHarvesting,
-            objectIdentifier=objectIdentifier,
-            accessRightsPolicy=accessRightsPolicy,
-            eventList=eventList)
-
+                digital_original=False,
+                algorithms=('MD5',),
+                fixity_cache=None,
+                output=None,
+                hooks=None,
+                progress=None):
+    """Build a METS XML file for a single file. algorithms lists the
+    fixityTypes to record for the file (e.g. ('MD5', 'SHA256')), and
+    fixity_cache is an optional FixityCache (or the path to one).
+    If output (a filepath or writable binary stream) is given, the
+    document is written to it with write_mets(), and None is returned.
+    hooks and progress are an optional BuildHooks and progress callback (or
+    ProgressTracker), as for build_mets()."""
+    algorithms = _normalise_algorithms(algorithms)
+    fixity_cache = _fixity_cache(fixity_cache)
+    hooks = hooks or _NO_HOOKS
+    with _phase(hooks, 'ie'):
+        mets = mf.build_mets()
+        _build_ie_dmd_amd(mets,
+                ie_dmd_dict=ie_dmd_dict,
+                generalIECharacteristics=generalIECharacteristics,
+                cms=cms,
+                webHarvesting=webHarvesting,
+                objectIdentifier=objectIdentifier,
+                accessRightsPolicy=accessRightsPolicy,
+                eventList=eventList)
+
+    scanned = _scan_file(filepath)
+    hooks.inventory(1, scanned.size)
+    progress = _progress_tracker(progress)
+    if progress is not None:
+        progress.start(1, scanned.size)
+    with _phase(hooks, 'hash'):
+        checksums = _timed_checksums(hooks, filepath, algorithms,
+                                     cache=fixity_cache, progress=progress)
+    if progress is not None:
+        progress.finish()
+
+    with _phase(hooks, 'assemble'):
+        mets = _single_file_sections(mets, filepath, scanned,
+                                     digital_original,
+                                     _file_fixity(checksums, algorithms))
+    return _complete_mets(mets, {}, None, output, hooks)
+
+
+def _single_file_sections(mets, filepath, scanned, digital_original,
+                          file_fixity):
     # Build rep amdsec
-    rep_amdsec = ET.Element("{http://www.loc.gov/METS/}amdSec", ID="rep1-amd")
-    general_rep_characteristics = [{'RevisionNumber': '1',
-            'DigitalOriginal': str(digital_original).lower(),
-            'usageType': 'VIEW',
-            'preservationType': 'PRESERVATION_MASTER'}]
-    rep_amd_tech = dnx_factory.build_rep_amdTech(
-        generalRepCharacteristics=general_rep_characteristics)
-    rep_amd_rights = None
-    rep_amd_digiprov = None
-    rep_amd_source = None
-    build_amdsec(
-        rep_amdsec,
-        tech_sec=rep_amd_tech,
-        rights_sec=rep_amd_rights,
-        source_sec=rep_amd_source,
-        digiprov_sec=rep_amd_digiprov)
-    mets.append(rep_amdsec)
+    _build_rep_amdsec(mets, 1, digital_original, 'PRESERVATION_MASTER')
 
     # Build file amdsec
     fl_amdsec = ET.Element("{http://www.loc.gov/METS/}amdSec", ID="fid1-1-amd")
-    file_original_location = filepath
-    file_original_name = os.path.normpath(file_original_location).split(os.path.sep)[-1]
-    file_label = os.path.splitext(file_original_name)[0]
-    file_size_bytes = os.path.getsize(file_original_location)
-    last_modified = time.strftime(
-            "%Y-%m-%dT%H:%M:%S",
-            time.localtime(os.path.getmtime(file_original_location)))
-    created_time = time.strftime(
-            "%Y-%m-%dT%H:%M:%S",
-            time.localtime(os.path.getctime(file_original_location)))
-    general_file_characteristics = [{
-        'fileOriginalPath': PurePath(file_original_location).as_posix(),
-        'fileSizeBytes': str(file_size_bytes),
-        'fileModificationDate': last_modified,
-        'fileCreationDate': created_time,
-        'fileOriginalName': file_original_name,
-        'label': file_label}]
-
-    file_fixity =  [{
-        'fixityType': 'MD5',
-        'fixityValue': generate_md5(file_original_location)}]
-
-    fl_amd_tech = dnx_factory.build_file_amdTech(
-        generalFileCharacteristics=general_file_characteristics,
-        fileFixity=file_fixity)
-    build_amdsec(fl_amdsec, tech_sec=fl_amd_tech)
+    _build_file_amdsec(fl_amdsec, scanned, PurePath(filepath).as_posix(),
+                       file_fixity)
     mets.append(fl_amdsec)
 
     # build filesec
@@ -416,42 +1591,24 @@ def build_single_file_mets(ie_dmd_dict=None,
     div_3.append(fptr)
 
     mets.append(structmap)
-
     return mets
 
 
-def _build_fl_amd_from_json(mets, file_no, rep_no, item):
-    fl_amd_sec = mm.AmdSec(ID="fid{}-{}-amd".format(file_no, rep_no))
-    fileOriginalName = None
-    fileSizeBytes = None
-    md5sum = None
-    fileCreationDate = None
-    fileModificationDate = None
-    note = None
-    # events = None
-
+def _normalise_json_file(item):
+    """The FileRecord for a file dict from a JSON rep manifest: its
+    generalFileCharacteristics, MD5 and events are recorded as given."""
     gfc = {} # general file characteristics
-    fixity = {}
+    checksums = {}
     events = {}
     gfc['fileOriginalPath'] = item['fileOriginalPath']
     for key in item.keys():
-        if key == 'fileOriginalName':
-            gfc['fileOriginalName'] = item[key]
-        if key == 'fileSizeBytes':
-            gfc['fileSizeBytes'] = item[key]
-        if key == 'fileCreationDate':
-            gfc['fileCreationDate'] = item[key]
-        if key == 'fileModificationDate':
-            gfc['fileModificationDate'] = item[key]
-        if key == 'note':
-            gfc['note'] = item[key]
-        if key == 'label':
-            gfc['label'] = item[key]
+        if key in ('fileOriginalName', 'fileSizeBytes', 'fileCreationDate',
+                   'fileModificationDate', 'note', 'label'):
+            gfc[key] = item[key]
 
         # fixity values
         if key.upper() == 'MD5':
-            fixity['fixityType'] = 'MD5'
-            fixity['fixityValue'] = item[key]
+            checksums['MD5'] = item[key]
         # provenance values
         if key == 'events':
             events = item[key]
@@ -467,153 +1624,134 @@ def _build_fl_amd_from_json(mets, file_no, rep_no, item):
     #             fileOriginalPath, md5sum, checksum))
 
     # reset any empty dicts to None value
-    if len(gfc) == 0:
-        gfc = None
-    if len(fixity) == 0:
-        fixity = None
+    if len(checksums) == 0:
+        checksums = None
     if len(events) == 0:
         events = None
 
+    if 'label' in item:
+        label = item['label']
+    else:
+        label = os.path.splitext(item['fileOriginalName'])[0]
+    # This may rely on the OS running the script to be the same type that
+    # made the path. Not sure on this, but it sounds like a good unit test
+    # case...
+    pathlist = os.path.normpath(item['fileOriginalPath']).split(os.path.sep)
+    return FileRecord(tuple(pathlist[:-1]), item.get('fileOriginalName'),
+                      item['fileOriginalPath'].replace('\\', '/'),
+                      label=label, checksums=checksums,
+                      characteristics=gfc, events=events)
+
+
+def _iter_rep_manifest(json_doc):
+    """Yield a FileRecord for each file in a rep manifest, which may be:
+    a JSON string (or bytes) holding a list of file dicts; a path to a
+    JSON file, or to a JSON Lines file (.jsonl or .ndjson, one file dict
+    per line), as a PurePath or as a string naming an existing file; or
+    any iterable of file dicts, or of JSON-encoded lines, such as an open
+    JSON Lines file or a generator. A single dict is taken to be a
+    one-file rep.
+    Paths, files and iterators are consumed one record at a time."""
+    if isinstance(json_doc, str) and os.path.isfile(json_doc):
+        json_doc = PurePath(json_doc)
+    if isinstance(json_doc, (str, bytes)):
+        json_doc = json.loads(json_doc)
+    elif isinstance(json_doc, PurePath):
+        json_doc = _read_manifest_file(json_doc)
+    if isinstance(json_doc, dict):
+        json_doc = [json_doc]
+    for item in json_doc:
+        if isinstance(item, (str, bytes)):
+            if not item.strip():
+                continue
+            item = json.loads(item)
+        yield _normalise_json_file(item)
+
+
+def _read_manifest_file(path):
+    with open(str(path), 'rb') as f:
+        if path.suffix.lower() not in ('.jsonl', '.ndjson'):
+            for item in json.load(f):
+                yield item
+        else:
+            for line in f:
+                yield line
+
+
+def _build_fl_amd_from_json(fl_amd_sec, record):
+    fixity = [None]
+    if record.checksums:
+        fixity = [{'fixityType': algorithm, 'fixityValue': digest}
+                  for algorithm, digest in record.checksums.items()]
     fl_amd_tech = dnx_factory.build_file_amdTech(
-        generalFileCharacteristics=[gfc],
-        fileFixity=[fixity])
+        generalFileCharacteristics=[record.characteristics],
+        fileFixity=fixity)
     fl_amd_digiprov = dnx_factory.build_ie_amdDigiprov(
-        event=events)
+        event=record.events)
     # yes, the call to ie amdDigiprov is intentional,
     # as we don't yet have a file digiprov builder. Should be fine though.
 
     build_amdsec(fl_amd_sec, tech_sec=fl_amd_tech, digiprov_sec=fl_amd_digiprov)
-    mets.append(fl_amd_sec)
-
-
-def _parse_json_for_fl_amd(mets, rep_no, json_doc):
-    if type(json_doc) == str:
-        rep_dict = json.loads(json_doc)
-    else:
-        rep_dict = json_doc
-    file_no = 1
-    for item in rep_dict:
-        _build_fl_amd_from_json(mets, file_no, rep_no, item)
-        file_no += 1
-
-
-def _parse_json_for_filegrp(filegrp, rep_no, json_doc, input_dir):
-    if type(json_doc) == str:
-        rep_dict = json.loads(json_doc)
-    else:
-        rep_dict = json_doc
-    file_no = 1
-    for item in rep_dict:
-        try:
-            file_el = mm.File(ID="fid{}-{}".format(file_no, rep_no),
-                              ADMID="fid{}-{}-amd".format(file_no, rep_no))
-            flocat = mm.FLocat(LOCTYPE="URL", href=item['fileOriginalPath'].replace('\\', '/'))
-            file_el.append(flocat)
-            filegrp.append(file_el)
-            file_no += 1
-        except KeyError:
-            print("The following json was missing an important value: {}".format(item))
-
-
-def _recursively_build_divs(div, pathlist, rep_no, file_no, json_doc):
-    if type(json_doc) == str:
-        rep_dict = json.loads(json_doc)
-    else:
-        rep_dict = json_doc
-    newdiv = div.find('./{http://www.loc.gov/METS/}div[@LABEL="%s"]' % (pathlist[0]))
-    if newdiv != None:
-        _recursively_build_divs(newdiv, pathlist[1:], rep_no, file_no, json_doc)
-    else:
-        if len(pathlist) == 1:
-            if 'label' in rep_dict.keys():
-                label = rep_dict['label']
-            else:
-                label = os.path.splitext(rep_dict['fileOriginalName'])[0]
-            newdiv = mm.Div(LABEL="{}".format(label),
-                            TYPE="FILE")
-            fptr = mm.Fptr(FILEID="fid{}-{}".format(file_no, rep_no))
-            newdiv.append(fptr)
-            div.append(newdiv)
-        else:
-            newdiv = mm.Div(LABEL="{}".format(pathlist[0]))
-            div.append(newdiv)
-            _recursively_build_divs(newdiv, pathlist[1:], rep_no, file_no, rep_dict)
-
-
-def _parse_json_for_structmap(div, rep_no, json_doc):
-    if type(json_doc) == str:
-        rep_dict = json.loads(json_doc)
-    else:
-        rep_dict = json_doc
-    file_no = 0
-    for item in rep_dict:
-        file_no += 1
-        pathlist = os.path.normpath(item['fileOriginalPath']).split(os.path.sep)
-        # This above may rely on the OS running the script to be the
-        # same type that made the path. Not sure on this, but it sounds like
-        # a good unit test case...
-        _recursively_build_divs(div, pathlist, rep_no, file_no, item)
 
 
 def _build_rep_amdsec(mets, rep_no, digital_original, preservation_type):
     rep_amdsec = ET.Element("{http://www.loc.gov/METS/}amdSec", ID="rep{}-amd".format(rep_no))
-    general_rep_characteristics = [{'RevisionNumber': '1',
-            'DigitalOriginal': str(digital_original).lower(),
-            'usageType': 'VIEW',
-            'preservationType': preservation_type}]
-    rep_amd_tech = dnx_factory.build_rep_amdTech(
-        generalRepCharacteristics=general_rep_characteristics)
-    rep_amd_rights = None
-    rep_amd_digiprov = None
-    rep_amd_source = None
     build_amdsec(
         rep_amdsec,
-        tech_sec=rep_amd_tech,
-        rights_sec=rep_amd_rights,
-        source_sec=rep_amd_source,
-        digiprov_sec=rep_amd_digiprov)
+        tech_sec=_rep_amd_tech(preservation_type, digital_original))
     mets.append(rep_amdsec)
 
 
 def _check_structmaps(mets, structmap_type):
-    structmaps = mets.findall("{http://www.loc.gov/METS/}structMap")
+    """Make the structMaps fit Rosetta's rules: a structMap with nested
+    divs is LOGICAL, so for structmap_type 'PHYSICAL' or 'BOTH' a flat
+    PHYSICAL structMap listing every FILE div beneath a "Table of Contents"
+    div is generated from it as well. With 'PHYSICAL' it replaces the
+    nested structMap, and with 'BOTH' the nested one is kept as the
+    LOGICAL map.
+    Each structMap is traversed once, and its FILE divs moved into the
+    flat map. With 'BOTH', they are moved out of a copy of the nested map,
+    taken with a single deepcopy, rather than found with a findall and
+    deep-copied one by one."""
+    structmap_type = structmap_type.upper()
+    structmaps = list(mets.iterchildren("{http://www.loc.gov/METS/}structMap"))
     for structmap in structmaps:
         # Grab top div label if exists
-        top_div_label = None
         top_div = structmap.find("./{http://www.loc.gov/METS/}div")
-        if 'LABEL' in top_div.attrib:
-            top_div_label = top_div.attrib['LABEL']
-        # jump down to the second layer of divs (usually the
+        top_div_label = top_div.attrib.get('LABEL')
+        # check if there are any divs below the top one (usually the
         # 'table of contents' div)
-        toc_div = structmap.find("./{http://www.loc.gov/METS/}div/" +
-                                 "{http://www.loc.gov/METS/}div")
-        # check if there are two or more divs below this
-        double_divs = structmap.findall(
-            "{http://www.loc.gov/METS/}div/{http://www.loc.gov/METS/}div")
-        if len(double_divs) > 0:
-            if structmap_type.upper() not in ['PHYSICAL', 'BOTH']:
-                # This violates Rosetta's rules about structmap types,
-                # So let's make it logical
-                structmap.attrib['TYPE'] = 'LOGICAL'
-            elif structmap_type.upper() in ['PHYSICAL', 'BOTH']:
-                new_sm = mm.StructMap(ID=structmap.attrib['ID'],
-                                      TYPE="PHYSICAL")
-
-                div_1 = mm.Div(LABEL=top_div_label)
-                new_sm.append(div_1)
-
-                div_2 = mm.Div(LABEL="Table of Contents")
-                div_1.append(div_2)
-
-                file_divs = structmap.findall(
-                    './/{http://www.loc.gov/METS/}div[@TYPE="FILE"]')
-                for file_div in file_divs:
-                    div_2.append(deepcopy(file_div))
-                mets.append(new_sm)
-                if structmap_type.upper() == 'PHYSICAL':
-                    mets.remove(structmap)
-                else:
-                    structmap.attrib['TYPE'] = 'LOGICAL'
+        if structmap.find("./{http://www.loc.gov/METS/}div/" +
+                          "{http://www.loc.gov/METS/}div") is None:
+            continue
+        if structmap_type not in ['PHYSICAL', 'BOTH']:
+            # This violates Rosetta's rules about structmap types,
+            # So let's make it logical
+            structmap.attrib['TYPE'] = 'LOGICAL'
+            continue
+        new_sm = mm.StructMap(ID=structmap.attrib['ID'],
+                              TYPE="PHYSICAL")
+
+        div_1 = mm.Div(LABEL=top_div_label)
+        new_sm.append(div_1)
+
+        div_2 = mm.Div(LABEL="Table of Contents")
+        div_1.append(div_2)
+
+        if structmap_type == 'PHYSICAL':
+            # the nested map is dropped, so its file divs can simply be
+            # moved. (Move them before removing it: detaching a large
+            # subtree from the document is slow.)
+            source = structmap
+        else:
+            source = deepcopy(structmap)
+            structmap.attrib['TYPE'] = 'LOGICAL'
+        div_2.extend([div for div in source.iter(
+                          "{http://www.loc.gov/METS/}div")
+                      if div.get('TYPE') == 'FILE'])
+        if structmap_type == 'PHYSICAL':
+            mets.remove(structmap)
+        mets.append(new_sm)
     return mets
 
 
@@ -637,98 +1775,82 @@ def build_mets_from_json(ie_dmd_dict=None,
                 eventList=None,
                 input_dir=None,
                 digital_original=False,
-                structmap_type="DEFAULT"):
+                structmap_type="DEFAULT",
+                output=None,
+                hooks=None,
+                build_cache=None):
     """Build a METS XML file using JSON-formatted data describing the
-    rep structures, rather than directory paths."""
-    mets = mf.build_mets()
-    _build_ie_dmd_amd(mets,
-        ie_dmd_dict=ie_dmd_dict,
-        generalIECharacteristics=generalIECharacteristics,
-        cms=cms,
-        webHarvesting=webHarvesting,
-        objectIdentifier=objectIdentifier,
-        accessRightsPolicy=accessRightsPolicy,
-        eventList=eventList)
-
-    # start building fileSec here, but do not append it until after all
-    # the amdSecs have been added.
-    filesec = mm.FileSec()
-
-    # start building list of structmaps here, but do not append it until after
-    # the fileSec has been added.
-    structmap_list = []
-
-
-    rep_no = 1
-    if pres_master_json != None:
-        pmd = json.loads(pres_master_json)
-        pm_rep_no = rep_no
-
-        # Build rep AMD Sec
-        _build_rep_amdsec(mets, rep_no, digital_original, 'PRESERVATION_MASTER')
-        # run through json structure and find files, assembling their
-        # filepaths along the way
-        _parse_json_for_fl_amd(mets, rep_no, pres_master_json)
-        # construct fileSec details for rep
-        filegrp = mm.FileGrp(ID="rep{}".format(rep_no),
-                    ADMID="rep{}-amd".format(rep_no))
-        _parse_json_for_filegrp(filegrp, rep_no, pres_master_json, input_dir)
-        filesec.append(filegrp)
-        # Build the structmap for this rep
-        structmap = mm.StructMap(ID="rep{}-1".format(rep_no), TYPE="PHYSICAL")
-        div1 = mm.Div(LABEL='Preservation Master')
-        structmap.append(div1)
-        div2 = mm.Div(LABEL='Table of Contents')
-        div1.append(div2)
-        mets.append(structmap)
-        _parse_json_for_structmap(div2, rep_no, pres_master_json)
-        structmap_list.append(structmap)
-        rep_no += 1
-    if modified_master_json != None:
-        mm_rep_no = rep_no
-        mmd = json.loads(modified_master_json)
-        _build_rep_amdsec(mets, rep_no, digital_original, 'MODIFIED_MASTER')
-        _parse_json_for_fl_amd(mets, rep_no, modified_master_json)
-        # construct fileSec details for rep
-        filegrp = mm.FileGrp(ID="rep{}".format(rep_no),
-                    ADMID="rep{}-amd".format(rep_no))
-        _parse_json_for_filegrp(filegrp, rep_no, modified_master_json, input_dir)
-        filesec.append(filegrp)
-        # Build the structmap for this rep
-        structmap = mm.StructMap(ID="rep{}-1".format(rep_no), TYPE="PHYSICAL")
-        div1 = mm.Div(LABEL='Modified Master')
-        structmap.append(div1)
-        div2 = mm.Div(LABEL='Table of Contents')
-        div1.append(div2)
-        mets.append(structmap)
-        _parse_json_for_structmap(div2, rep_no, modified_master_json)
-        structmap_list.append(structmap)
-        rep_no += 1
-    if access_derivative_json != None:
-        add = json.loads(access_derivative_json)
-        ad_rep_no = rep_no
-        _build_rep_amdsec(mets, rep_no, digital_original, 'DERIVATIVE_COPY')
-        _parse_json_for_fl_amd(mets, rep_no, access_derivative_json)
-        # construct fileSec details for rep
-        filegrp = mm.FileGrp(ID="rep{}".format(rep_no),
-                    ADMID="rep{}-amd".format(rep_no))
-        _parse_json_for_filegrp(filegrp, rep_no, access_derivative_json, input_dir)
-        filesec.append(filegrp)
-        # Build the structmap for this rep
-        structmap = mm.StructMap(ID="rep{}-1".format(rep_no), TYPE="PHYSICAL")
-        div1 = mm.Div(LABEL='Access Derivative')
-        structmap.append(div1)
-        div2 = mm.Div(LABEL='Table of Contents')
-        div1.append(div2)
-        mets.append(structmap)
-        _parse_json_for_structmap(div2, ad_rep_no, access_derivative_json)
-        structmap_list.append(structmap)
-        rep_no += 1
-
-    mets.append(filesec)
-
-    for structmap in structmap_list:
-        mets.append(structmap)
-
-    _check_structmaps(mets, structmap_type)
-    return mets
+    rep structures, rather than directory paths. Each rep manifest may be
+    a JSON string, an already decoded list of file dicts, a path (a
+    PurePath, or a string naming an existing file) to a JSON or JSON Lines
+    file, or an iterator of file dicts or JSON Lines; see
+    _iter_rep_manifest(). This is the same as rendering json_inventory()
+    with render_mets().
+    If output (a filepath or writable binary stream) is given, the
+    document is streamed to it as in build_mets(), and None is returned.
+    hooks is an optional BuildHooks, as for build_mets(); no files are
+    hashed, and reading the manifests is the 'scan' phase.
+    build_cache is an optional BuildCache (or the path of its folder), as
+    for build_mets(), keyed by the arguments and the records read from the
+    manifests."""
+    build_cache = _build_cache(build_cache)
+    hooks = hooks or _NO_HOOKS
+    with _phase(hooks, 'scan'):
+        ie = json_inventory(
+            ie_dmd_dict=ie_dmd_dict,
+            pres_master_json=pres_master_json,
+            modified_master_json=modified_master_json,
+            access_derivative_json=access_derivative_json,
+            cms=cms,
+            webHarvesting=webHarvesting,
+            generalIECharacteristics=generalIECharacteristics,
+            objectIdentifier=objectIdentifier,
+            accessRightsPolicy=accessRightsPolicy,
+            eventList=eventList,
+            input_dir=input_dir,
+            digital_original=digital_original)
+    _report_inventory(hooks, ie)
+
+    def render(output):
+        return render_mets(ie, structmap_type, output=output, hooks=hooks)
+    if build_cache is None:
+        return render(output)
+    cache_key = build_cache.key(ie, structmap_type=structmap_type)
+    if cache_key in build_cache:
+        return build_cache.load(cache_key, output)
+    return build_cache.store(cache_key, render, output)
+
+
+def json_inventory(ie_dmd_dict=None,
+                pres_master_json=None,
+                modified_master_json=None,
+                access_derivative_json=None,
+                cms=None,
+                webHarvesting=None,
+                generalIECharacteristics=None,
+                objectIdentifier=None,
+                accessRightsPolicy=None,
+                eventList=None,
+                input_dir=None,
+                digital_original=False):
+    """The IERecord (see mets_dnx.model) that build_mets_from_json()
+    renders for these arguments. Each rep manifest is read in full, one
+    file dict at a time."""
+    ie = IERecord(ie_dmd_dict=ie_dmd_dict,
+                  generalIECharacteristics=generalIECharacteristics,
+                  cms=cms,
+                  webHarvesting=webHarvesting,
+                  objectIdentifier=objectIdentifier,
+                  accessRightsPolicy=accessRightsPolicy,
+                  eventList=eventList,
+                  digital_original=digital_original,
+                  input_dir=input_dir)
+    reps = ((pres_master_json, 'PRESERVATION_MASTER', 'Preservation Master'),
+            (modified_master_json, 'MODIFIED_MASTER', 'Modified Master'),
+            (access_derivative_json, 'DERIVATIVE_COPY', 'Access Derivative'))
+    for rep_json, preservation_type, rep_label in reps:
+        if rep_json is None:
+            continue
+        ie.reps.append(RepRecord(preservation_type, rep_label,
+                                 files=list(_iter_rep_manifest(rep_json))))
+    return ie
@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import threading
+
+
+class FixityCache(object):
+    """On-disk cache of file checksums, stored in a SQLite database.
+
+    A cached digest is only returned while the file's device, inode, size
+    and modification time (in nanoseconds) are the same as when it was
+    hashed, so any change to a file causes it to be hashed again.
+
+    The database runs in WAL mode with a busy timeout, and each thread
+    opens its own connection, so a single cache file can be shared by
+    several threads and by concurrent worker processes on one host.
+    Instances can be pickled, e.g. to hand them to a process pool; only the
+    database path is carried across.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connect()
+
+    def __getstate__(self):
+        return {'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.timeout = state['timeout']
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.path)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fixity ("
+                "path TEXT NOT NULL, "
+                "algorithm TEXT NOT NULL, "
+                "device INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "digest TEXT NOT NULL, "
+                "PRIMARY KEY (path, algorithm))")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection to the database."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _stat_key(st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def lookup(self, filepath, algorithms):
+        """Look up the checksums of a file. Returns a tuple of
+        (checksums, stat_result), where checksums is a dict keyed by
+        fixityType, or None if any of the algorithms is missing or stale."""
+        st = os.stat(filepath)
+        rows = self._connect().execute(
+            "SELECT algorithm, digest FROM fixity WHERE path = ? AND "
+            "device = ? AND inode = ? AND size = ? AND mtime_ns = ?",
+            (os.path.abspath(filepath),) + self._stat_key(st)).fetchall()
+        digests = dict(rows)
+        if all(algorithm in digests for algorithm in algorithms):
+            return {algorithm: digests[algorithm]
+                    for algorithm in algorithms}, st
+        return None, st
+
+    def store(self, filepath, checksums, st):
+        """Record the checksums of a file, where st is the stat_result
+        taken before the file was read. Nothing is stored if the file has
+        changed since then."""
+        stat_key = self._stat_key(st)
+        if self._stat_key(os.stat(filepath)) != stat_key:
+            return
+        path = os.path.abspath(filepath)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO fixity (path, algorithm, device, "
+                "inode, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(path, algorithm) + stat_key + (digest,)
+                    for algorithm, digest in checksums.items()])
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
@@ -0,0 +1,107 @@
+"""A compact model of what a METS document describes: an IE, its reps, and
+the files in each rep.
+
+The builders fill in this model first (see factory.directory_inventory()
+and factory.json_inventory()) and render it to XML in a separate step
+(factory.render_mets()), so the model can be inspected or altered in
+between. The classes use __slots__, and hold little more than the values
+that end up in the document, so that a record costs a small fraction of
+the lxml elements rendered from it.
+"""
+import os
+
+
+class IERecord(object):
+    """An intellectual entity: the IE-level builder arguments (see
+    factory.build_mets()), the folder the reps' files are relative to, and
+    a list of RepRecords."""
+
+    __slots__ = ('ie_dmd_dict', 'generalIECharacteristics', 'cms',
+                 'webHarvesting', 'objectIdentifier', 'accessRightsPolicy',
+                 'eventList', 'digital_original', 'input_dir', 'reps')
+
+    def __init__(self, ie_dmd_dict=None, generalIECharacteristics=None,
+                 cms=None, webHarvesting=None, objectIdentifier=None,
+                 accessRightsPolicy=None, eventList=None,
+                 digital_original=False, input_dir=None, reps=None):
+        self.ie_dmd_dict = ie_dmd_dict
+        self.generalIECharacteristics = generalIECharacteristics
+        self.cms = cms
+        self.webHarvesting = webHarvesting
+        self.objectIdentifier = objectIdentifier
+        self.accessRightsPolicy = accessRightsPolicy
+        self.eventList = eventList
+        self.digital_original = digital_original
+        self.input_dir = input_dir
+        self.reps = [] if reps is None else reps
+
+    def __repr__(self):
+        return '{}({} reps)'.format(self.__class__.__name__, len(self.reps))
+
+    def files(self):
+        """Iterate over the FileRecords of every rep, in order."""
+        for rep in self.reps:
+            for record in rep.files:
+                yield record
+
+
+class RepRecord(object):
+    """A representation: its preservationType (e.g. 'PRESERVATION_MASTER'),
+    the LABEL of its structMap's top div, the USE of its fileGrp (None for
+    no USE attribute) and a list of FileRecords, in the order they are
+    numbered."""
+
+    __slots__ = ('preservation_type', 'label', 'use', 'files')
+
+    def __init__(self, preservation_type, label, use=None, files=None):
+        self.preservation_type = preservation_type
+        self.label = label
+        self.use = use
+        self.files = [] if files is None else files
+
+    def __repr__(self):
+        return '{}({!r}, {} files)'.format(
+            self.__class__.__name__, self.preservation_type, len(self.files))
+
+
+class FileRecord(object):
+    """A file in a rep.
+
+    folders: tuple of the folder names placing the file in the structMap
+    name: the file's name
+    href: its FLocat href, relative to the IE's input_dir
+    label: its structMap label; None for the name without its extension
+    size, mtime_ns, ctime_ns: from a stat of the file, as in a ScannedFile
+    checksums: dict of hex digests keyed by fixityType, or None for a
+        scanned file to be hashed when its amdSec is rendered
+    characteristics: for a file described by a manifest rather than
+        scanned, the dict of generalFileCharacteristics to record as given;
+        such a file's amdSec also gets a digiprovMD of its events
+    events: list of event dicts for the file's digiprovMD, or None
+    """
+
+    __slots__ = ('folders', 'name', 'href', 'label', 'size', 'mtime_ns',
+                 'ctime_ns', 'checksums', 'characteristics', 'events')
+
+    def __init__(self, folders, name, href, label=None, size=None,
+                 mtime_ns=None, ctime_ns=None, checksums=None,
+                 characteristics=None, events=None):
+        self.folders = folders
+        self.name = name
+        self.href = href
+        self.label = label
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ctime_ns = ctime_ns
+        self.checksums = checksums
+        self.characteristics = characteristics
+        self.events = events
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.href)
+
+    @property
+    def structmap_label(self):
+        if self.label is not None:
+            return self.label
+        return os.path.splitext(self.name)[0]
@@ -0,0 +1,607 @@
+"""Out-of-core METS building, for SIPs with more files than their records,
+let alone the document, can hold in a worker's memory.
+
+The file records are spilled to a temporary SQLite database as the rep
+directories are scanned (and, with fixity workers, as the files are
+hashed), and the document is streamed to its output section by section:
+the amdSecs, then the fileSec, then the structMaps, each read back from
+the database in turn. The listing of each folder scanned, and the folders
+still to scan, go through the database as well. Only a batch of records (or
+of a folder's entries) and the XML of a single file are held in memory at a
+time, along with SQLite's page cache, and the two are kept within
+memory_limit. What memory use still grows with is the depth to which the
+folders are nested, as the folders around the current file are held open.
+"""
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+import time
+
+from lxml import etree as ET
+from pymets import mets_factory as mf
+from pymets import mets_model as mm
+
+from mets_dnx import factory
+from mets_dnx.model import FileRecord, IERecord, RepRecord
+
+
+METS_NS = "{http://www.loc.gov/METS/}"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+
+# A generous estimate of the memory a FileRecord read from the store takes,
+# used to size the batches
+_RECORD_SIZE = 2048
+
+
+class RecordStore(object):
+    """A temporary SQLite database holding the FileRecords of an IE's reps;
+    see files() and scan_directory().
+
+    Half of memory_limit goes to SQLite's page cache, and the other half to
+    the records buffered for writing or read back in a batch, so that at
+    most batch_size records are in memory at a time. The database is
+    created in directory (by default the system's temporary directory) and
+    deleted when the store is closed.
+    """
+
+    def __init__(self, directory=None, memory_limit=64 * 2**20):
+        fd, self.path = tempfile.mkstemp(prefix='mets-dnx-', suffix='.db',
+                                         dir=directory)
+        os.close(fd)
+        self.batch_size = max(1, memory_limit // 2 // _RECORD_SIZE)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA cache_size=-{}".format(
+            max(1, memory_limit // 2 // 1024)))
+        # the database is thrown away if the build fails, so there is
+        # nothing to recover
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute(
+            "CREATE TABLE files ("
+            "rep INTEGER NOT NULL, "
+            "seq INTEGER NOT NULL, "
+            "tree_key BLOB NOT NULL, "
+            "folders TEXT NOT NULL, "
+            "name TEXT, "
+            "href TEXT NOT NULL, "
+            "label TEXT, "
+            "size INTEGER, "
+            "mtime_ns INTEGER, "
+            "ctime_ns INTEGER, "
+            "checksums TEXT, "
+            "characteristics TEXT, "
+            "events TEXT, "
+            "PRIMARY KEY (rep, seq))")
+        self._conn.execute("CREATE INDEX files_tree ON files (rep, tree_key)")
+        self._conn.execute(
+            "CREATE TABLE folder_seqs ("
+            "rep INTEGER NOT NULL, "
+            "folders TEXT NOT NULL, "
+            "seq INTEGER NOT NULL, "
+            "PRIMARY KEY (rep, folders))")
+        # the entries of the folder being scanned, and the folders still to
+        # scan, as a stack
+        self._conn.execute(
+            "CREATE TABLE listing ("
+            "is_dir INTEGER NOT NULL, "
+            "sort_key BLOB NOT NULL, "
+            "name BLOB NOT NULL, "
+            "PRIMARY KEY (is_dir, sort_key))")
+        self._conn.execute(
+            "CREATE TABLE pending ("
+            "id INTEGER PRIMARY KEY, "
+            "folders TEXT NOT NULL)")
+        self._reps = 0
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def files(self):
+        """A new, empty SpilledFiles for a rep's files, to use as the files
+        of a RepRecord."""
+        self._reps += 1
+        return SpilledFiles(self, self._reps)
+
+    def scan_directory(self, directory):
+        """Yield a ScannedFile for every file beneath directory, in the same
+        order as factory.scan_directory(), but with each folder's listing
+        sorted in the database, and the folders still to scan kept there,
+        so that neither a folder of many files nor many folders are held in
+        memory."""
+        conn = self._conn
+        with conn:
+            conn.execute("DELETE FROM pending")
+            conn.execute("INSERT INTO pending (folders) VALUES ('[]')")
+        while True:
+            row = conn.execute("SELECT id, folders FROM pending "
+                               "ORDER BY id DESC LIMIT 1").fetchone()
+            if row is None:
+                return
+            with conn:
+                conn.execute("DELETE FROM pending WHERE id = ?", (row[0],))
+            folders = tuple(json.loads(row[1]))
+            folder = os.path.join(directory, *folders)
+            self._list_folder(folder)
+            # pushed last first, so that the first is scanned next
+            for names in self._listed(True, descending=True):
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO pending (folders) VALUES (?)",
+                        [(json.dumps(folders + (name,)),) for name in names])
+            for names in self._listed(False):
+                for name in names:
+                    path = os.path.join(folder, name)
+                    st = os.stat(path)
+                    yield factory.ScannedFile(path, folders, name,
+                                              st.st_size, st.st_mtime_ns,
+                                              st.st_ctime_ns)
+
+    def _list_folder(self, folder):
+        # as factory._list_folder(), into the listing table
+        with self._conn:
+            self._conn.execute("DELETE FROM listing")
+        batch = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                name = _name_bytes(entry.name)
+                if not is_dir:
+                    batch.append((False, _file_sort_key(entry.name), name))
+                elif not entry.is_symlink():
+                    batch.append((True, name, name))
+                if len(batch) >= self.batch_size:
+                    self._insert_listing(batch)
+                    batch = []
+        self._insert_listing(batch)
+
+    def _insert_listing(self, batch):
+        with self._conn:
+            self._conn.executemany("INSERT INTO listing VALUES (?, ?, ?)",
+                                   batch)
+
+    def _listed(self, is_dir, descending=False):
+        # lists of up to batch_size names from the listing table, in order,
+        # with keyset pagination as in SpilledFiles._select()
+        order, op = ('DESC', '<') if descending else ('ASC', '>')
+        last = None
+        while True:
+            where = '' if last is None else 'AND sort_key {} ?'.format(op)
+            rows = self._conn.execute(
+                "SELECT sort_key, name FROM listing WHERE is_dir = ? {} "
+                "ORDER BY sort_key {} LIMIT ?".format(where, order),
+                (is_dir,) + (() if last is None else (last,))
+                + (self.batch_size,)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [row[1].decode('utf-8', 'surrogatepass') for row in rows]
+
+    def close(self):
+        """Close and delete the database."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            os.remove(self.path)
+
+
+def _name_bytes(name):
+    # SQLite compares BLOBs bytewise, and UTF-8 sorts in code point order,
+    # as str does; surrogatepass keeps the undecodable bytes of a name (see
+    # os.fsdecode())
+    return name.encode('utf-8', 'surrogatepass')
+
+
+def _file_sort_key(name):
+    # a BLOB that sorts in factory._ordered_names() order: named files,
+    # then numbered ones by number (signed, then by length, then by the
+    # bytes of its magnitude), each followed by the name
+    try:
+        number = int(name[:name.rfind(".")])
+    except ValueError:
+        return b'\x00' + _name_bytes(name)
+    magnitude = abs(number).to_bytes((abs(number).bit_length() + 7) // 8,
+                                     'big')
+    if number < 0:
+        prefix = (b'\x01' + struct.pack('>I', 2**32 - 1 - len(magnitude))
+                  + bytes(255 - byte for byte in magnitude))
+    else:
+        prefix = b'\x02' + struct.pack('>I', len(magnitude)) + magnitude
+    return prefix + _name_bytes(name)
+
+
+def _is_empty(directory):
+    with os.scandir(directory) as entries:
+        return next(entries, None) is None
+
+
+def _dumps(value):
+    return None if value is None else json.dumps(value)
+
+
+def _loads(value):
+    return None if value is None else json.loads(value)
+
+
+class SpilledFiles(object):
+    """The FileRecords of one rep, kept in a RecordStore: a stand-in for
+    the list of a RepRecord that is appended to and iterated over in
+    order, but never held in memory as a whole.
+
+    Records read back are copies: changing one does not change the store,
+    except through update_checksums().
+    """
+
+    def __init__(self, store, rep):
+        self._store = store
+        self._rep = rep
+        self._buffer = []
+        self._len = 0
+        # the sequence number of the first file beneath each folder, which
+        # orders the folder among its siblings in the structMap, is kept in
+        # the store; only those of the last record's folders are kept here
+        self._folders = ()
+        self._folder_seqs = []
+
+    def __repr__(self):
+        return '{}({} files)'.format(self.__class__.__name__, len(self))
+
+    def __len__(self):
+        return self._len
+
+    def append(self, record):
+        seq = self._len
+        folders = tuple(record.folders)
+        key = self._folder_key(folders, seq) + [seq]
+        self._buffer.append((
+            self._rep, seq, struct.pack('>{}Q'.format(len(key)), *key),
+            json.dumps(folders), record.name, record.href, record.label,
+            record.size, record.mtime_ns, record.ctime_ns,
+            _dumps(record.checksums), _dumps(record.characteristics),
+            _dumps(record.events)))
+        self._len += 1
+        if len(self._buffer) >= self._store.batch_size:
+            self.flush()
+
+    def _folder_key(self, folders, seq):
+        if folders != self._folders:
+            common = 0
+            while (common < min(len(folders), len(self._folders)) and
+                   folders[common] == self._folders[common]):
+                common += 1
+            del self._folder_seqs[common:]
+            conn = self._store._conn
+            for depth in range(common + 1, len(folders) + 1):
+                name = json.dumps(folders[:depth])
+                row = conn.execute(
+                    "SELECT seq FROM folder_seqs WHERE rep = ? "
+                    "AND folders = ?", (self._rep, name)).fetchone()
+                if row is None:
+                    conn.execute("INSERT INTO folder_seqs VALUES (?, ?, ?)",
+                                 (self._rep, name, seq))
+                    row = (seq,)
+                self._folder_seqs.append(row[0])
+            self._folders = folders
+        return list(self._folder_seqs)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def flush(self):
+        """Write the buffered records to the store."""
+        if self._buffer:
+            with self._store._conn:
+                self._store._conn.executemany(
+                    "INSERT INTO files VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._buffer)
+            self._buffer = []
+
+    def _select(self, order, where=''):
+        # keyset pagination, so that no cursor is left open between
+        # batches and the store can be updated while they are read
+        self.flush()
+        last = b'' if order == 'tree_key' else -1
+        while True:
+            rows = self._store._conn.execute(
+                "SELECT seq, {0}, folders, name, href, label, size, "
+                "mtime_ns, ctime_ns, checksums, characteristics, events "
+                "FROM files WHERE rep = ? AND {0} > ? {1} ORDER BY {0} "
+                "LIMIT ?".format(order, where),
+                (self._rep, last, self._store.batch_size)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][1]
+            yield [(row[0] + 1, FileRecord(
+                tuple(json.loads(row[2])), row[3], row[4], label=row[5],
+                size=row[6], mtime_ns=row[7], ctime_ns=row[8],
+                checksums=_loads(row[9]), characteristics=_loads(row[10]),
+                events=_loads(row[11]))) for row in rows]
+
+    def __iter__(self):
+        for batch in self._select('seq'):
+            for _, record in batch:
+                yield record
+
+    def numbered(self):
+        """Yield the (file number, FileRecord) of each file, in order."""
+        for batch in self._select('seq'):
+            for item in batch:
+                yield item
+
+    def unhashed(self):
+        """Yield lists of up to batch_size (file number, FileRecord) of the
+        scanned files that have no checksums yet."""
+        return self._select('seq', 'AND checksums IS NULL '
+                            'AND characteristics IS NULL')
+
+    def in_structmap_order(self):
+        """Yield the (file number, FileRecord) of each file in the order
+        its FILE div has in the structMap: the order the files were added
+        in, except that every folder's files and subfolders are together,
+        where the first of them was added."""
+        for batch in self._select('tree_key'):
+            for item in batch:
+                yield item
+
+    def update_checksums(self, checksums):
+        """Set the checksums of files, given as (file number, checksums)
+        pairs."""
+        with self._store._conn:
+            self._store._conn.executemany(
+                "UPDATE files SET checksums = ? WHERE rep = ? AND seq = ?",
+                [(json.dumps(file_checksums), self._rep, file_no - 1)
+                    for file_no, file_checksums in checksums])
+
+    def total_size(self):
+        """The sum of the sizes of the files."""
+        self.flush()
+        return self._store._conn.execute(
+            "SELECT TOTAL(size) FROM files WHERE rep = ?",
+            (self._rep,)).fetchone()[0]
+
+
+def _write_file_div(xf, file_no, rep_no, record):
+    with xf.element(METS_NS + 'div', {'LABEL': str(record.structmap_label),
+                                      'TYPE': 'FILE'}):
+        with xf.element(METS_NS + 'fptr',
+                        {'FILEID': 'fid{}-{}'.format(file_no, rep_no)}):
+            pass
+
+
+def _write_structmap(xf, rep_no, rep, structmap_type):
+    """Write a rep's structMap: nested, as a LOGICAL map, or flat, as a
+    PHYSICAL one, with the same divs as _check_structmaps() leaves."""
+    with xf.element(METS_NS + 'structMap',
+                    {'ID': 'rep{}-1'.format(rep_no), 'TYPE': structmap_type}):
+        with xf.element(METS_NS + 'div', {'LABEL': rep.label}):
+            with xf.element(METS_NS + 'div', {'LABEL': 'Table of Contents'}):
+                # the folder divs open around the current file, and their
+                # names
+                opened = []
+                names = ()
+                for file_no, record in rep.files.in_structmap_order():
+                    if structmap_type == 'LOGICAL':
+                        folders = tuple(record.folders)
+                        common = 0
+                        while (common < min(len(names), len(folders)) and
+                               names[common] == folders[common]):
+                            common += 1
+                        while len(opened) > common:
+                            opened.pop().__exit__(None, None, None)
+                        for folder in folders[common:]:
+                            div = xf.element(METS_NS + 'div',
+                                             {'LABEL': str(folder)})
+                            div.__enter__()
+                            opened.append(div)
+                        names = folders
+                    _write_file_div(xf, file_no, rep_no, record)
+                while opened:
+                    opened.pop().__exit__(None, None, None)
+
+
+def _write_spilled_sections(ie, output, structmap_type, populate, timings):
+    mets = mf.build_mets()
+    start = time.perf_counter()
+    factory._build_ie_dmd_amd(mets,
+            ie_dmd_dict=ie.ie_dmd_dict,
+            generalIECharacteristics=ie.generalIECharacteristics,
+            cms=ie.cms,
+            webHarvesting=ie.webHarvesting,
+            objectIdentifier=ie.objectIdentifier,
+            accessRightsPolicy=ie.accessRightsPolicy,
+            eventList=ie.eventList)
+    timings['ie'] = time.perf_counter() - start
+
+    with ET.xmlfile(output, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(mets.tag, attrib=dict(mets.attrib),
+                        nsmap=mets.nsmap):
+            for section in list(mets):
+                xf.write(section)
+                factory._discard(section)
+
+            # the amdSecs of each rep, followed by those of its files
+            for rep_no, rep in enumerate(ie.reps, 1):
+                rep_amdsec = mm.AmdSec(ID='rep{}-amd'.format(rep_no))
+                factory.build_amdsec(
+                    rep_amdsec, tech_sec=factory._rep_amd_tech(
+                        rep.preservation_type, ie.digital_original))
+                xf.write(rep_amdsec)
+                for file_no, record in rep.files.numbered():
+                    fl_amdsec = mm.AmdSec(
+                        ID='fid{}-{}-amd'.format(file_no, rep_no))
+                    start = time.perf_counter()
+                    populate(fl_amdsec, record)
+                    timings['populate'] += time.perf_counter() - start
+                    xf.write(fl_amdsec)
+
+            if not ie.reps:
+                return
+            with xf.element(METS_NS + 'fileSec'):
+                for rep_no, rep in enumerate(ie.reps, 1):
+                    attrib = {}
+                    if rep.use is not None:
+                        attrib['USE'] = rep.use
+                    attrib['ID'] = 'rep{}'.format(rep_no)
+                    attrib['ADMID'] = 'rep{}-amd'.format(rep_no)
+                    with xf.element(METS_NS + 'fileGrp', attrib):
+                        for file_no, record in rep.files.numbered():
+                            fl_id = 'fid{}-{}'.format(file_no, rep_no)
+                            with xf.element(METS_NS + 'file',
+                                            {'ID': fl_id,
+                                             'ADMID': fl_id + '-amd'}):
+                                with xf.element(
+                                        METS_NS + 'FLocat',
+                                        {'LOCTYPE': 'URL',
+                                         '{' + XLINK_NS + '}href':
+                                             record.href},
+                                        nsmap={'xlin': XLINK_NS}):
+                                    pass
+
+            structmap_types = {'PHYSICAL': ['PHYSICAL'],
+                               'BOTH': ['LOGICAL', 'PHYSICAL']}.get(
+                                   structmap_type.upper(), ['LOGICAL'])
+            for type_ in structmap_types:
+                for rep_no, rep in enumerate(ie.reps, 1):
+                    _write_structmap(xf, rep_no, rep, type_)
+
+
+def write_spilled_mets(ie, output, structmap_type='DEFAULT',
+                       algorithms=('MD5',), fixity_cache=None, hooks=None,
+                       progress=None):
+    """Stream an IERecord whose reps' files are SpilledFiles to output (a
+    filepath or writable binary stream), section by section, reading the
+    file records back from the store once for the amdSecs, once for the
+    fileSec and once for each structMap. The document is the same as
+    factory.render_mets() would give for the same records.
+    Scanned files without checksums are hashed as their amdSecs are
+    written. hooks and progress are as for factory.build_mets(); a
+    ProgressTracker is used as it is, whereas a callback gets a new one
+    started for the files still to be hashed."""
+    algorithms = factory._normalise_algorithms(algorithms)
+    fixity_cache = factory._fixity_cache(fixity_cache)
+    hooks = hooks or factory._NO_HOOKS
+    if progress is not None and not isinstance(progress,
+                                               factory.ProgressTracker):
+        progress = factory.ProgressTracker(progress)
+        progress.start(
+            sum(len(batch) for rep in ie.reps
+                for batch in rep.files.unhashed()),
+            sum(record.size or 0 for rep in ie.reps
+                for batch in rep.files.unhashed() for _, record in batch))
+
+    populate = factory._record_populator(ie.input_dir, algorithms,
+                                         fixity_cache, hooks, progress)
+    timings = {'ie': 0, 'populate': 0}
+    start = time.perf_counter()
+    factory._write_atomically(output, lambda target: _write_spilled_sections(
+        ie, target, structmap_type, populate, timings))
+    hooks.phase('ie', timings['ie'])
+    hooks.phase('populate', timings['populate'])
+    hooks.phase('serialize', time.perf_counter() - start - timings['ie'] -
+                timings['populate'])
+    if progress is not None:
+        progress.finish()
+
+
+def build_mets_out_of_core(ie_dmd_dict=None,
+                pres_master_dir=None,
+                modified_master_dir=None,
+                access_derivative_dir=None,
+                cms=None,
+                webHarvesting=None,
+                generalIECharacteristics=None,
+                objectIdentifier=None,
+                accessRightsPolicy=None,
+                eventList=None,
+                input_dir=None,
+                digital_original=False,
+                structmap_type='DEFAULT',
+                fixity_workers=None,
+                algorithms=('MD5',),
+                fixity_cache=None,
+                output=None,
+                hooks=None,
+                progress=None,
+                memory_limit=64 * 2**20,
+                spill_dir=None,
+                exclude=None):
+    """Build the same METS as factory.build_mets() (see there for the
+    arguments), streaming it to output, with the file records spilled to a
+    temporary RecordStore in spill_dir rather than held in memory. The
+    memory used stays within memory_limit (in bytes), plus what lxml and
+    the hashing take for one file (or, with fixity_workers, one file per
+    worker), however many files and folders there are; it grows only with
+    the depth to which the folders are nested.
+    The rep directories are scanned into the store, and with fixity_workers
+    the files are then hashed a batch at a time, their checksums going back
+    into the store; otherwise each is hashed as its amdSec is written. The
+    document is then written by write_spilled_mets().
+    checksum_manifest and id_map are not supported, as they are held in
+    memory whole."""
+    if output is None:
+        raise ValueError("an out-of-core build needs an output to write to")
+    algorithms = factory._normalise_algorithms(algorithms)
+    fixity_cache = factory._fixity_cache(fixity_cache)
+    hooks = hooks or factory._NO_HOOKS
+
+    with RecordStore(spill_dir, memory_limit) as store:
+        ie = IERecord(ie_dmd_dict=ie_dmd_dict,
+                      generalIECharacteristics=generalIECharacteristics,
+                      cms=cms,
+                      webHarvesting=webHarvesting,
+                      objectIdentifier=objectIdentifier,
+                      accessRightsPolicy=accessRightsPolicy,
+                      eventList=eventList,
+                      digital_original=digital_original,
+                      input_dir=input_dir)
+        with factory._phase(hooks, 'scan'):
+            for rep_dir, pres_type, rep_label in factory._reps(
+                    pres_master_dir, modified_master_dir,
+                    access_derivative_dir):
+                if _is_empty(rep_dir):
+                    raise ValueError(
+                        "rep directory {} is empty".format(rep_dir))
+                files = store.files()
+                files.extend(factory._scanned_record(
+                    scanned, factory._sip_href(input_dir, scanned.path))
+                    for scanned in factory._excluding(
+                        store.scan_directory(rep_dir), exclude))
+                files.flush()
+                ie.reps.append(RepRecord(pres_type, rep_label, 'VIEW',
+                                         files))
+
+        files = sum(len(rep.files) for rep in ie.reps)
+        size = int(sum(rep.files.total_size() for rep in ie.reps))
+        hooks.inventory(files, size)
+        progress = factory._progress_tracker(progress)
+        if progress is not None:
+            progress.start(files, size)
+        if fixity_workers:
+            with factory._phase(hooks, 'hash'):
+                for rep in ie.reps:
+                    for batch in rep.files.unhashed():
+                        locations = [factory._file_original_location(
+                            input_dir, record.href) for _, record in batch]
+                        checksums = factory.generate_checksums_for_files(
+                            locations, algorithms=algorithms,
+                            workers=fixity_workers, cache=fixity_cache,
+                            hooks=hooks, progress=progress)
+                        rep.files.update_checksums(
+                            (file_no, checksums[location])
+                            for (file_no, _), location in zip(batch,
+                                                              locations))
+
+        write_spilled_mets(ie, output, structmap_type, algorithms,
+                           fixity_cache, hooks, progress)
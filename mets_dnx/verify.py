@@ -0,0 +1,142 @@
+"""Verify the files a METS document describes against the fixity recorded
+for them.
+
+Each file amdSec's fileOriginalPath, fileSizeBytes and fileFixity values
+are read back, and the file is stat'd and re-hashed. Documents written to
+disk are parsed incrementally, and only as far as the fileSec, so the
+memory used does not grow with the number of files.
+"""
+import os
+
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree as ET
+
+from mets_dnx import factory
+
+
+METS_NS = "{http://www.loc.gov/METS/}"
+
+FileCheck = namedtuple('FileCheck',
+    ['file_id', 'path', 'status', 'expected', 'actual', 'size'])
+FileCheck.__doc__ = """Outcome of checking one file described by a METS.
+
+file_id: the file's ID in the METS (e.g. 'fid1-1')
+path: the filepath that was checked
+status: 'ok', 'missing' (the file does not exist or cannot be read),
+    'size' (its size differs from fileSizeBytes; it is not hashed),
+    'fixity' (one or more of its checksums differ) or 'error' (its
+    checksums cannot be generated, e.g. for an unsupported fixityType)
+expected: the recorded checksums, as a dict keyed by fixityType, or the
+    recorded size for a 'size' check
+actual: the checksums generated from the file, its size for a 'size'
+    check, or the error message for an 'error' check (None if the file is
+    missing)
+size: the file's size in bytes (None if the file is missing)
+"""
+
+
+def _dnx_records(amdsec, section_id):
+    # DNX keys have no namespace in a document built in memory, and the
+    # DNX namespace in one read back from a file
+    for section in amdsec.iterfind(
+            './{*}techMD//{*}section[@id="' + section_id + '"]'):
+        for record in section.iterfind('{*}record'):
+            yield dict((key.get('id'), key.text)
+                       for key in record.iterfind('{*}key'))
+
+
+def recorded_file(amdsec):
+    """The (file ID, fileOriginalPath, fileSizeBytes or None, {fixityType:
+    fixityValue}) recorded in a file amdSec, or None if it does not describe
+    a file (e.g. the IE or a rep amdSec)."""
+    fixity = dict((record.get('fixityType'), record.get('fixityValue'))
+                  for record in _dnx_records(amdsec, 'fileFixity')
+                  if record.get('fixityType') and record.get('fixityValue'))
+    gfc = next(_dnx_records(amdsec, 'generalFileCharacteristics'), {})
+    if not fixity or not gfc.get('fileOriginalPath'):
+        return None
+    file_id = amdsec.get('ID', '')
+    if file_id.endswith('-amd'):
+        file_id = file_id[:-len('-amd')]
+    size = gfc.get('fileSizeBytes')
+    return (file_id, gfc['fileOriginalPath'],
+            int(size) if size else None, fixity)
+
+
+def iter_recorded_files(mets):
+    """Yield recorded_file() for each file amdSec of mets: an element, or a
+    filepath or binary file object to parse incrementally. Parsing stops at
+    the fileSec, which (as the METS schema requires) follows the last
+    amdSec; every amdSec is freed once it has been read."""
+    if isinstance(mets, ET._Element):
+        for amdsec in mets.iterchildren(METS_NS + 'amdSec'):
+            recorded = recorded_file(amdsec)
+            if recorded is not None:
+                yield recorded
+        return
+    if isinstance(mets, os.PathLike):
+        mets = os.fspath(mets)
+    events = ET.iterparse(mets, events=('start', 'end'), huge_tree=True,
+                          tag=(METS_NS + 'amdSec', METS_NS + 'fileSec'))
+    for event, element in events:
+        if element.tag == METS_NS + 'fileSec':
+            break
+        if event != 'end':
+            continue
+        recorded = recorded_file(element)
+        element.clear()
+        # drop the amdSecs already read, and what came before them
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if recorded is not None:
+            yield recorded
+
+
+def check_file(file_id, path, size, fixity, block_size=2**20):
+    """Check one file against its recorded size (if not None) and fixity;
+    returns a FileCheck."""
+    try:
+        actual_size = os.stat(path).st_size
+        if size is not None and actual_size != size:
+            return FileCheck(file_id, path, 'size', size, actual_size,
+                             actual_size)
+        checksums = factory.generate_checksums(
+            path, [algorithm for algorithm in fixity], block_size)
+    except OSError:
+        return FileCheck(file_id, path, 'missing', fixity, None, None)
+    except ValueError as e:
+        return FileCheck(file_id, path, 'error', fixity, str(e), actual_size)
+    status = 'ok'
+    if any(checksums[factory._normalise_algorithms(algorithm)[0]]
+           != digest.lower() for algorithm, digest in fixity.items()):
+        status = 'fixity'
+    return FileCheck(file_id, path, status, fixity, checksums, actual_size)
+
+
+def verify_mets(mets, input_dir=None, workers=None, block_size=2**20):
+    """Check every file a METS document describes against its recorded
+    fixity, yielding a FileCheck for each in document order.
+
+    mets is a document built by the factory: an element, or a filepath or
+    binary file object. Each file's fileOriginalPath is taken to be relative
+    to input_dir (the input_dir it was built with), unless it is absolute.
+    The files are stat'd and hashed by a pool of workers threads (by
+    default, as many as a ThreadPoolExecutor has), with only a few files
+    per thread in flight, so the results are produced while the
+    document is still being read."""
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        max_in_flight = workers * 4
+        in_flight = deque()
+        for file_id, original_path, size, fixity in iter_recorded_files(
+                mets):
+            path = os.path.join(input_dir or '',
+                                os.path.normpath(original_path))
+            in_flight.append(executor.submit(
+                check_file, file_id, path, size, fixity, block_size))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
@@ -3,7 +3,15 @@ try:
 except ImportError:
     from distutils.core import setup
 
-VERSION='0.1.16'
+import os
+import re
+
+# the version is __version__ in the package, which cannot be imported
+# before its requirements are installed
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+		'mets_dnx', '__init__.py')) as f:
+	VERSION = re.search(r"""^__version__ = ['"]([^'"]+)['"]""", f.read(),
+		re.M).group(1)
 
 config = {
 	'name':'mets_dnx',
@@ -15,6 +23,9 @@ config = {
 	'install_requires':['lxml>=3.6.4', 'pymets','pydc', 'pydnx'],
 	'download_url': 'https://github.com/NLNZDigitalPreservation/mets_dnx/archive/v'+VERSION+'.tar.gz',
 	'license': 'MIT',
+	'entry_points': {
+		'console_scripts': ['mets-dnx=mets_dnx.cli:main'],
+		},
 	}
 
 setup(**config)
@@ -0,0 +1,83 @@
+import asyncio
+import io
+import os
+
+from lxml import etree as ET
+
+from mets_dnx import aio
+from mets_dnx import factory as mdf
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+
+def test_build_mets_async_matches_build_mets():
+    """The async builder gives the same document as build_mets(), whether
+    it is returned or streamed."""
+    sip = os.path.join(CURRENT_DIR, 'data', 'test_batch_4')
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=os.path.join(sip, 'pm'),
+                  modified_master_dir=os.path.join(sip, 'mm'),
+                  access_derivative_dir=os.path.join(sip, 'ad'),
+                  input_dir=sip,
+                  algorithms=('MD5', 'SHA256'))
+    expected = ET.tostring(mdf.build_mets(**kwargs), method='c14n')
+
+    async def build():
+        stream = io.BytesIO()
+        mets, _ = await asyncio.gather(
+            aio.build_mets_async(concurrency=2, **kwargs),
+            aio.build_mets_async(concurrency=1, output=stream, **kwargs))
+        return mets, stream.getvalue()
+
+    mets, streamed = asyncio.run(build())
+    assert(ET.tostring(mets, method='c14n') == expected)
+    assert(ET.tostring(ET.fromstring(streamed), method='c14n') == expected)
+
+
+def test_scan_directory_async_order():
+    """Nested folders come out in scan_directory()'s order."""
+    directory = os.path.join(CURRENT_DIR, 'data', 'test_batch_5')
+
+    async def scan():
+        loop = asyncio.get_running_loop()
+
+        async def run(func, *args):
+            return await loop.run_in_executor(None, func, *args)
+        return await aio.scan_directory_async(directory, run, concurrency=3)
+
+    assert(asyncio.run(scan()) == list(mdf.scan_directory(directory)))
+
+
+def test_build_single_file_mets_async():
+    filepath = os.path.join(CURRENT_DIR, 'data', 'test_batch_2', 'path',
+                            'to', 'files', 'img1.jpg')
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"}, filepath=filepath)
+    mets = asyncio.run(aio.build_single_file_mets_async(**kwargs))
+    assert(ET.tostring(mets, method='c14n') == ET.tostring(
+        mdf.build_single_file_mets(**kwargs), method='c14n'))
+
+
+def test_async_progress_is_reported_on_the_loop_thread():
+    import threading
+    sip = os.path.join(CURRENT_DIR, 'data', 'test_batch_5')
+    threads = set()
+
+    async def build():
+        queue = asyncio.Queue()
+
+        def report(progress):
+            threads.add(threading.get_ident())
+            queue.put_nowait(progress)
+        await aio.build_mets_async(
+            ie_dmd_dict={"dc:title": "test title"},
+            pres_master_dir=sip, input_dir=sip,
+            progress=mdf.ProgressTracker(report, interval=0))
+        reports = []
+        while not queue.empty():
+            reports.append(queue.get_nowait())
+        return reports
+
+    reports = asyncio.run(build())
+    assert(threads == {threading.get_ident()})
+    assert(reports[-1].files_done == 6)
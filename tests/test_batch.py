@@ -0,0 +1,76 @@
+import os
+
+from lxml import etree as ET
+
+from mets_dnx import batch
+from mets_dnx import factory as mdf
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+
+def _jobs(tmp_path):
+    return [
+        {'output': str(tmp_path / 'one' / 'mets.xml'),
+         'ie_dmd_dict': {"dc:title": "one"},
+         'pres_master_dir': os.path.join(CURRENT_DIR, 'data', 'test_batch_1', 'pm'),
+         'input_dir': os.path.join(CURRENT_DIR, 'data', 'test_batch_1')},
+        {'output': str(tmp_path / 'missing' / 'mets.xml'),
+         'ie_dmd_dict': {"dc:title": "missing"},
+         'pres_master_dir': str(tmp_path / 'does_not_exist'),
+         'input_dir': str(tmp_path)},
+        {'output': str(tmp_path / 'json' / 'mets.xml'),
+         'ie_dmd_dict': {"dc:title": "json"},
+         'pres_master_json': '[{"fileOriginalPath": "img1.jpg", '
+                             '"fileOriginalName": "img1.jpg", '
+                             '"MD5": "aff64bf1391ac627edb3234a422f9a77"}]',
+         'input_dir': os.path.join(CURRENT_DIR, 'data', 'test_batch_3')},
+    ]
+
+
+def test_batch_isolates_failing_jobs(tmp_path):
+    """A failing job is reported, and the other jobs are still written."""
+    results = batch.build_batch(_jobs(tmp_path), workers=2,
+                                defaults={'digital_original': True})
+    assert([result.index for result in results] == [0, 1, 2])
+    assert([result.status for result in results] == ['ok', 'failed', 'ok'])
+    assert(isinstance(results[1].error, OSError))
+    assert('Traceback' in results[1].traceback)
+    assert(all(result.elapsed >= 0 for result in results))
+
+    written = ET.parse(results[0].output)
+    expected = mdf.build_mets(
+        ie_dmd_dict={"dc:title": "one"},
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_1', 'pm'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_1'),
+        digital_original=True)
+    assert(ET.tostring(written, method='c14n')
+        == ET.tostring(expected, method='c14n'))
+    assert(os.path.exists(results[2].output))
+    assert(not os.path.exists(results[1].output))
+
+
+def test_batch_in_process(tmp_path):
+    """workers=1 runs the jobs in the calling process."""
+    jobs = _jobs(tmp_path)
+    timings = mdf.PhaseTimings()
+    jobs[0]['hooks'] = timings
+    results = batch.build_batch(jobs, workers=1)
+    assert([result.status for result in results] == ['ok', 'failed', 'ok'])
+    pm = jobs[0]['pres_master_dir']
+    assert(results[0].files == 1)
+    assert(results[0].bytes == sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(pm) for name in names))
+    assert('scan' in timings.phases)
+    assert((results[2].files, results[2].bytes) == (1, 0))
+
+
+def test_batch_isolates_jobs_that_cannot_be_sent_to_a_worker(tmp_path):
+    jobs = [dict(_jobs(tmp_path)[0], output=str(tmp_path / name / 'mets.xml'))
+            for name in ('one', 'two', 'three')]
+    jobs[1]['progress'] = lambda report: None
+    results = batch.build_batch(jobs, workers=2)
+    assert([result.status for result in results] == ['ok', 'failed', 'ok'])
+    assert('Traceback' in results[1].traceback)
+    assert(os.path.exists(jobs[2]['output']))
@@ -0,0 +1,163 @@
+import io
+import os
+import pickle
+import shutil
+import time
+
+from lxml import etree as ET
+from pytest import raises
+
+from mets_dnx import factory as mdf
+from mets_dnx.build_cache import BuildCache
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+
+def _sip(tmp_path):
+    sip = str(tmp_path / 'sip')
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_5'), sip)
+    return sip
+
+
+def test_unchanged_sip_is_not_hashed_again(tmp_path, monkeypatch):
+    """A second build of the same SIP copies the cached document, byte
+    for byte, without reading any file."""
+    sip = _sip(tmp_path)
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=sip, input_dir=sip,
+                  build_cache=str(tmp_path / 'cache'))
+    first = str(tmp_path / 'first.xml')
+    mdf.build_mets(output=first, **kwargs)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("file was read again")
+    monkeypatch.setattr(mdf.hashlib, 'new', fail)
+    second = io.BytesIO()
+    id_map = {}
+    mdf.build_mets(output=second, id_map=id_map, **kwargs)
+    with open(first, 'rb') as f:
+        assert(f.read() == second.getvalue())
+    assert(id_map['ie1-rep1-file1'] == 'fid1-1')
+    mets = mdf.build_mets(**kwargs)
+    assert(ET.tostring(mets, method='c14n') ==
+           ET.tostring(ET.parse(first), method='c14n'))
+
+
+def test_changes_to_files_or_arguments_are_built_afresh(tmp_path):
+    sip = _sip(tmp_path)
+    cache = BuildCache(str(tmp_path / 'cache'))
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=sip, input_dir=sip, build_cache=cache)
+    first = ET.tostring(mdf.build_mets(**kwargs), method='c14n')
+    assert(ET.tostring(mdf.build_mets(structmap_type='PHYSICAL', **kwargs),
+                       method='c14n') != first)
+
+    with open(os.path.join(sip, 'path', 'to', 'files', 'img1.jpg'),
+              'ab') as f:
+        f.write(b'more')
+    changed = mdf.build_mets(**kwargs)
+    assert(ET.tostring(changed, method='c14n') != first)
+    assert(ET.tostring(changed, method='c14n') == ET.tostring(
+        mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                       pres_master_dir=sip, input_dir=sip), method='c14n'))
+    assert(sum(len(files) for _, _, files in os.walk(cache.directory)) == 3)
+    assert(pickle.loads(pickle.dumps(cache)).directory == cache.directory)
+
+
+def test_build_mets_from_json_with_build_cache(tmp_path):
+    manifest = [{'fileOriginalName': 'img1.jpg',
+                 'fileOriginalPath': 'pm/img1.jpg',
+                 'MD5': '0123456789abcdef0123456789abcdef'}]
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_json=manifest, input_dir='.',
+                  build_cache=str(tmp_path / 'cache'))
+    first = io.BytesIO()
+    mdf.build_mets_from_json(output=first, **kwargs)
+    second = io.BytesIO()
+    mdf.build_mets_from_json(output=second, **kwargs)
+    assert(first.getvalue() == second.getvalue())
+    manifest[0]['MD5'] = 'fedcba9876543210fedcba9876543210'
+    third = io.BytesIO()
+    mdf.build_mets_from_json(output=third, **kwargs)
+    assert(b'fedcba9876543210fedcba9876543210' in third.getvalue())
+
+
+def test_scan_order_does_not_depend_on_listing_order(monkeypatch):
+    """Subfolders are taken in name order, whatever order the file system
+    lists them in."""
+    directory = os.path.join(CURRENT_DIR, 'data', 'test_batch_5')
+    expected = list(mdf.scan_directory(directory))
+    scandir = os.scandir
+
+    class Reversed(object):
+        def __init__(self, path):
+            self._entries = scandir(path)
+
+        def __enter__(self):
+            return reversed(list(self._entries.__enter__()))
+
+        def __exit__(self, *exc_info):
+            return self._entries.__exit__(*exc_info)
+
+    monkeypatch.setattr(mdf.os, 'scandir', Reversed)
+    assert(list(mdf.scan_directory(directory)) == expected)
+
+
+def test_miss_and_hit_return_the_same_kind_of_tree(tmp_path):
+    """Built or cached, the returned document is searched the same way."""
+    sip = _sip(tmp_path)
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=sip, input_dir=sip,
+                  build_cache=str(tmp_path / 'cache'))
+    for _ in ('miss', 'hit'):
+        mets = mdf.build_mets(**kwargs)
+        assert(len(mets.findall(
+            './/{http://www.exlibrisgroup.com/dps/dnx}key'
+            '[@id="fileOriginalPath"]')) == 6)
+
+
+def test_verified_builds_are_not_taken_from_the_cache(tmp_path):
+    sip = _sip(tmp_path)
+    manifest = os.path.join(sip, 'manifest-md5.txt')
+    with open(manifest, 'w') as f:
+        f.write('0123456789abcdef0123456789abcdef  path/to/files/img1.jpg\n')
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=sip, input_dir=sip,
+                  checksum_manifest=manifest,
+                  build_cache=str(tmp_path / 'cache'))
+    mdf.build_mets(**kwargs)
+    with raises(ValueError):
+        mdf.build_mets(verify_manifest='full', **kwargs)
+
+
+def test_time_zone_is_part_of_the_key(tmp_path, monkeypatch):
+    sip = _sip(tmp_path)
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=sip, input_dir=sip,
+                  build_cache=str(tmp_path / 'cache'))
+    dates = []
+    try:
+        for tz in ('UTC0', 'NZST-12'):
+            monkeypatch.setenv('TZ', tz)
+            time.tzset()
+            dates.append(mdf.build_mets(**kwargs).findtext(
+                './/{*}key[@id="fileModificationDate"]'))
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert(dates[0] != dates[1])
+
+
+def test_cached_builds_report_progress(tmp_path):
+    """A build taken from the cache reports every file done, none read."""
+    sip = _sip(tmp_path)
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=sip, input_dir=sip,
+                  build_cache=str(tmp_path / 'cache'))
+    mdf.build_mets(**kwargs)
+    reports = []
+    mdf.build_mets(progress=reports.append, **kwargs)
+    final = reports[-1]
+    assert((final.files_done, final.files_total) == (6, 6))
+    assert(final.bytes_hashed == 0 and final.bytes_total > 0)
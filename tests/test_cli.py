@@ -0,0 +1,230 @@
+import json
+import os
+import shutil
+
+from lxml import etree as ET
+
+from mets_dnx import cli
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+
+def test_dir_command(tmp_path, capsys):
+    """A single SIP with pm and mm subdirectories is picked up
+    automatically."""
+    output = str(tmp_path / 'mets.xml')
+    status = cli.main(['dir', os.path.join(CURRENT_DIR, 'data', 'test_batch_1'),
+                       '-o', output, '--algorithms', 'MD5,SHA256'])
+    summary = json.loads(capsys.readouterr().out)
+    assert(status == 0)
+    assert(summary['files'] == 2)
+    assert(summary['failed'] == 0)
+    mets = ET.parse(output)
+    assert(len(mets.findall('.//{http://www.loc.gov/METS/}fileGrp')) == 2)
+    assert(mets.findtext('.//{http://purl.org/dc/elements/1.1/}title')
+        == 'test_batch_1')
+
+
+def test_batch_command_reports_failures(tmp_path, capsys):
+    """Every SIP folder is built, and failures are listed in the summary
+    and reflected in the exit status."""
+    parent = tmp_path / 'sips'
+    parent.mkdir()
+    for name in ('test_batch_4', 'test_batch_5'):
+        shutil.copytree(os.path.join(CURRENT_DIR, 'data', name),
+                        str(parent / name))
+    with open(str(parent / 'test_batch_4' / 'ie.json'), 'w') as f:
+        json.dump({'ie_dmd_dict': {'dc:title': 'from ie.json'}}, f)
+    json_sip = parent / 'json_sip'
+    json_sip.mkdir()
+    with open(str(json_sip / 'pm.json'), 'w') as f:
+        json.dump([{'fileOriginalPath': 'img1.jpg',
+                    'fileOriginalName': 'img1.jpg',
+                    'fileSizeBytes': '29690',
+                    'MD5': 'aff64bf1391ac627edb3234a422f9a77'}], f)
+    (parent / 'broken' / 'pm').mkdir(parents=True)
+    output_dir = tmp_path / 'out'
+
+    status = cli.main(['batch', str(parent), '--output-dir', str(output_dir),
+                       '--workers', '2',
+                       '--fixity-cache', str(tmp_path / 'fixity.sqlite')])
+    summary = json.loads(capsys.readouterr().out)
+    assert(status == 1)
+    assert(summary['sips'] == 4)
+    assert(summary['failed'] == 1)
+    assert(summary['failures'][0]['input_dir'] == str(parent / 'broken'))
+    assert(summary['files'] == 4 + 6 + 1)
+    assert(summary['bytes'] > 0)
+    assert(summary['files_per_second'] > 0)
+    title = ET.parse(str(output_dir / 'test_batch_4' / 'mets.xml')).findtext(
+        './/{http://purl.org/dc/elements/1.1/}title')
+    assert(title == 'from ie.json')
+    assert(os.path.exists(str(output_dir / 'json_sip' / 'mets.xml')))
+
+
+def test_json_command_reads_json_lines(tmp_path, capsys):
+    """A .jsonl manifest holds one file record per line."""
+    manifest = tmp_path / 'pm.jsonl'
+    with open(str(manifest), 'w') as f:
+        for name, size in (('img1.jpg', '29690'), ('img2.jpg', '100')):
+            f.write(json.dumps({'fileOriginalPath': name,
+                                'fileOriginalName': name,
+                                'fileSizeBytes': size,
+                                'MD5': 'aff64bf1391ac627edb3234a422f9a77'}))
+            f.write('\n')
+    output = str(tmp_path / 'mets.xml')
+    status = cli.main(['json', str(tmp_path), '--pm-json', str(manifest),
+                       '-o', output])
+    summary = json.loads(capsys.readouterr().out)
+    assert(status == 0)
+    assert(summary['files'] == 2)
+    assert(summary['bytes'] == 29790)
+    assert(len(ET.parse(output).findall(
+        './/{http://www.loc.gov/METS/}file')) == 2)
+
+
+def test_dir_command_verifies_a_checksum_manifest(tmp_path, capsys):
+    """The manifest is looked up in the SIP folder, and a SIP whose files
+    do not match it fails."""
+    sip = tmp_path / 'sip'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_2'),
+                    str(sip / 'pm'))
+    with open(str(sip / 'manifest-md5.txt'), 'w') as f:
+        f.write('0123456789abcdef0123456789abcdef  pm/path/to/files/img1.jpg\n')
+    args = ['dir', str(sip), '-o', str(tmp_path / 'mets.xml'),
+            '--checksum-manifest', 'manifest-md5.txt']
+    assert(cli.main(args) == 0)
+    capsys.readouterr()
+    assert(cli.main(args + ['--verify-manifest', 'full']) == 1)
+    assert('checksum manifest' in json.loads(
+        capsys.readouterr().out)['failures'][0]['error'])
+
+
+def test_verify_command(tmp_path, capsys):
+    """fileOriginalPaths are relative to the folder holding the METS unless
+    --input-dir is given."""
+    sip = tmp_path / 'sip'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_2'),
+                    str(sip))
+    output = str(sip / 'mets.xml')
+    assert(cli.main(['dir', str(sip), '-o', output]) == 0)
+    capsys.readouterr()
+    assert(cli.main(['verify', output]) == 0)
+    summary = json.loads(capsys.readouterr().out)
+    assert(summary['files'] == 2)
+    assert(summary['failed'] == 0)
+
+    os.remove(str(sip / 'path' / 'to' / 'files' / 'img2.jpg'))
+    assert(cli.main(['verify', output, '--input-dir', str(sip)]) == 1)
+    summary = json.loads(capsys.readouterr().out)
+    assert([failure['status'] for failure in summary['failures']]
+        == ['missing'])
+
+
+def test_dir_command_writes_a_profile(tmp_path, capsys):
+    import pstats
+    profile = str(tmp_path / 'build.prof')
+    assert(cli.main(['dir', os.path.join(CURRENT_DIR, 'data', 'test_batch_2'),
+                     '-o', str(tmp_path / 'mets.xml'),
+                     '--profile', profile]) == 0)
+    stats = pstats.Stats(profile)
+    assert(any(function == 'build_mets'
+               for _, _, function in stats.stats))
+
+
+def test_dir_command_out_of_core(tmp_path, capsys):
+    sip = os.path.join(CURRENT_DIR, 'data', 'test_batch_4')
+    spill_dir = tmp_path / 'spill'
+    spill_dir.mkdir()
+    assert(cli.main(['dir', sip, '-o', str(tmp_path / 'spilled.xml'),
+                     '--memory-limit', '1',
+                     '--spill-dir', str(spill_dir)]) == 0)
+    assert(json.loads(capsys.readouterr().out)['files'] == 4)
+    assert(os.listdir(str(spill_dir)) == [])
+    assert(cli.main(['dir', sip, '-o', str(tmp_path / 'mets.xml')]) == 0)
+    assert(ET.tostring(ET.parse(str(tmp_path / 'spilled.xml')),
+                       method='c14n') ==
+           ET.tostring(ET.parse(str(tmp_path / 'mets.xml')), method='c14n'))
+
+
+def test_dir_command_uses_a_build_cache(tmp_path, capsys):
+    sip = os.path.join(CURRENT_DIR, 'data', 'test_batch_2')
+    outputs = [str(tmp_path / name) for name in ('first.xml', 'second.xml')]
+    for output in outputs:
+        assert(cli.main(['dir', sip, '-o', output,
+                         '--build-cache', str(tmp_path / 'cache')]) == 0)
+    with open(outputs[0], 'rb') as first, open(outputs[1], 'rb') as second:
+        assert(first.read() == second.read())
+
+
+def _hrefs(output):
+    return sorted(flocat.get('{http://www.w3.org/1999/xlink}href')
+                  for flocat in ET.parse(output).iter(
+                      '{http://www.loc.gov/METS/}FLocat'))
+
+
+def test_batch_leaves_metadata_out_of_a_flat_sip(tmp_path, capsys):
+    """A SIP folder that is its own preservation master does not package
+    its ie.json as content."""
+    parent = tmp_path / 'sips'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+                    str(parent / 'flat'))
+    with open(str(parent / 'flat' / 'ie.json'), 'w') as f:
+        json.dump({'ie_dmd_dict': {'dc:title': 'flat'}}, f)
+    output_dir = tmp_path / 'out'
+    for memory_limit in ([], ['--memory-limit', '16']):
+        assert(cli.main(['batch', str(parent), '--output-dir',
+                         str(output_dir), '--workers', '1'] + memory_limit)
+               == 0)
+        assert(json.loads(capsys.readouterr().out)['files'] == 6)
+        assert(_hrefs(str(output_dir / 'flat' / 'mets.xml')) == [
+            'path/to/files/img1.jpg', 'path/to/files/img2.jpg',
+            'path/to/other/files/img3.jpg', 'path/to/other/files/img4.jpg',
+            'path/to/yet/more/files/img5.jpg',
+            'path/to/yet/more/files/img6.jpg'])
+
+
+def test_batch_reports_a_sip_with_a_malformed_ie_json(tmp_path, capsys):
+    """A SIP whose job cannot be made is a failure like any other."""
+    parent = tmp_path / 'sips'
+    for name in ('a', 'b'):
+        shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+                        str(parent / name / 'pm'))
+    with open(str(parent / 'a' / 'ie.json'), 'w') as f:
+        f.write('{bad json')
+    output_dir = tmp_path / 'out'
+    status = cli.main(['batch', str(parent), '--output-dir', str(output_dir),
+                       '--workers', '2'])
+    summary = json.loads(capsys.readouterr().out)
+    assert(status == 1)
+    assert((summary['sips'], summary['succeeded'], summary['failed']) ==
+           (2, 1, 1))
+    assert(summary['failures'][0]['input_dir'] == str(parent / 'a'))
+    assert('JSONDecodeError' in summary['failures'][0]['error'])
+    assert(os.path.exists(str(output_dir / 'b' / 'mets.xml')))
+
+
+def test_dir_command_builds_a_bag_from_its_payload(tmp_path, capsys):
+    """Only a bag's data folder is content, and its manifest's paths,
+    which are relative to the bag, still match the files."""
+    import hashlib
+    bag = tmp_path / 'bag'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_2'),
+                    str(bag / 'data'))
+    with open(str(bag / 'bagit.txt'), 'w') as f:
+        f.write('BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n')
+    with open(str(bag / 'bag-info.txt'), 'w') as f:
+        f.write('Bagging-Date: 2026-10-18\n')
+    hrefs = ['data/path/to/files/img1.jpg', 'data/path/to/files/img2.jpg']
+    with open(str(bag / 'manifest-md5.txt'), 'w') as f:
+        for href in hrefs:
+            with open(str(bag / href), 'rb') as content:
+                f.write('{}  {}\n'.format(
+                    hashlib.md5(content.read()).hexdigest(), href))
+    output = str(tmp_path / 'mets.xml')
+    for manifest in ([], ['--checksum-manifest', 'manifest-md5.txt',
+                          '--verify-manifest', 'full']):
+        assert(cli.main(['dir', str(bag), '-o', output] + manifest) == 0)
+        assert(json.loads(capsys.readouterr().out)['files'] == 2)
+        assert(_hrefs(output) == hrefs)
@@ -0,0 +1,67 @@
+import os
+import pickle
+import shutil
+
+from lxml import etree as ET
+
+from mets_dnx import factory as mdf
+from mets_dnx.fixity_cache import FixityCache
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+
+def test_cached_checksum_is_reused(tmp_path, monkeypatch):
+    """A second lookup of an unchanged file should not read the file."""
+    filepath = str(tmp_path / 'img1.jpg')
+    shutil.copy(os.path.join(CURRENT_DIR, 'data', 'test_batch_3', 'img1.jpg'),
+                filepath)
+    cache = FixityCache(str(tmp_path / 'fixity.sqlite'))
+    md5 = mdf.generate_md5(filepath, cache=cache)
+    assert(md5 == mdf.generate_md5(filepath))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("file was read again")
+    monkeypatch.setattr(mdf.hashlib, 'new', fail)
+    assert(mdf.generate_md5(filepath, cache=cache) == md5)
+
+
+def test_changed_file_is_hashed_again(tmp_path):
+    """Changing the size or mtime of a file invalidates its cached digest."""
+    filepath = str(tmp_path / 'file.txt')
+    with open(filepath, 'wb') as f:
+        f.write(b'first')
+    cache = FixityCache(str(tmp_path / 'fixity.sqlite'))
+    first = mdf.generate_checksums(filepath, ('MD5', 'SHA1'), cache=cache)
+    with open(filepath, 'wb') as f:
+        f.write(b'second version')
+    second = mdf.generate_checksums(filepath, ('MD5', 'SHA1'), cache=cache)
+    assert(first != second)
+    assert(second == mdf.generate_checksums(filepath, ('MD5', 'SHA1')))
+    # an algorithm that was never cached forces a fresh read
+    checksums, st = cache.lookup(filepath, ('SHA256',))
+    assert(checksums is None)
+
+
+def test_cache_survives_pickling(tmp_path):
+    """Caches are handed to worker processes by pickling."""
+    cache = FixityCache(str(tmp_path / 'fixity.sqlite'))
+    filepath = os.path.join(CURRENT_DIR, 'data', 'test_batch_3', 'img2.jpg')
+    md5 = mdf.generate_md5(filepath, cache=cache)
+    clone = pickle.loads(pickle.dumps(cache))
+    checksums, st = clone.lookup(filepath, ('MD5',))
+    assert(checksums == {'MD5': md5})
+
+
+def test_build_mets_with_fixity_cache_path(tmp_path):
+    """build_mets accepts the path to a cache database."""
+    cache_path = str(tmp_path / 'fixity.sqlite')
+    kwargs = dict(
+        ie_dmd_dict={"dc:title": "test title"},
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'))
+    uncached = mdf.build_mets(**kwargs)
+    first = mdf.build_mets(fixity_cache=cache_path, **kwargs)
+    second = mdf.build_mets(fixity_cache=cache_path, fixity_workers=2,
+                            **kwargs)
+    assert(ET.tostring(uncached) == ET.tostring(first) == ET.tostring(second))
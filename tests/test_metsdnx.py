@@ -1,3 +1,4 @@
+import io
 import json
 import os
 
@@ -1383,3 +1384,532 @@ def test_mets_dnx_with_pm_and_ad_for_phys_structmap_labels():
             '{http://www.loc.gov/METS/}div').attrib['LABEL']
     print(mm_structmap_label)
     assert(mm_structmap_label == "Modified Master")
+
+
+def test_fixity_workers_output_matches_serial():
+    """Hashing files with a worker pool should produce exactly the same
+    METS as hashing them one at a time."""
+    ie_dc_dict = {"dc:title": "test title"}
+    kwargs = dict(
+        ie_dmd_dict=ie_dc_dict,
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_4', 'pm'),
+        modified_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_4', 'mm'),
+        access_derivative_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_4', 'ad'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_4'),
+        generalIECharacteristics=[{
+            'submissionReason': 'bornDigitalContent',
+            'IEEntityType': 'periodicIE'}])
+    serial = mdf.build_mets(**kwargs)
+    parallel = mdf.build_mets(fixity_workers=4, **kwargs)
+    assert(ET.tostring(serial) == ET.tostring(parallel))
+
+
+def test_generate_md5s():
+    """Checksums from the worker pool are keyed by filepath."""
+    filepaths = [os.path.join(CURRENT_DIR, 'data', 'test_batch_3', fl)
+                 for fl in ('img1.jpg', 'img2.jpg', 'img3.jpg')]
+    checksums = mdf.generate_md5s(filepaths, workers=3)
+    assert(sorted(checksums.keys()) == sorted(filepaths))
+    for filepath in filepaths:
+        assert(checksums[filepath] == mdf.generate_md5(filepath))
+
+
+def test_generate_checksums_multiple_algorithms():
+    """Several digests are generated from one read, and match hashlib."""
+    import hashlib
+    filepath = os.path.join(CURRENT_DIR, 'data', 'test_batch_3', 'img1.jpg')
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    checksums = mdf.generate_checksums(filepath, ('md5', 'SHA-1', 'SHA256'))
+    assert(checksums == {
+        'MD5': hashlib.md5(data).hexdigest(),
+        'SHA1': hashlib.sha1(data).hexdigest(),
+        'SHA256': hashlib.sha256(data).hexdigest()})
+    with raises(ValueError):
+        mdf.generate_checksums(filepath, ('CRC64',))
+
+
+def test_mets_dnx_with_multiple_fixity_algorithms():
+    """One fileFixity record is written per requested algorithm."""
+    ie_dc_dict = {"dc:title": "test title"}
+    mets = mdf.build_mets(
+        ie_dmd_dict=ie_dc_dict,
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_1', 'pm'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_1'),
+        algorithms=('MD5', 'SHA256'))
+    fixity_types = [el.text for el in mets.findall(
+        './/section[@id="fileFixity"]/record/key[@id="fixityType"]')]
+    assert(fixity_types == ['MD5', 'SHA256'])
+    mets = mdf.build_single_file_mets(
+        ie_dmd_dict=ie_dc_dict,
+        filepath=os.path.join(
+            CURRENT_DIR, 'data', 'test_batch_1', 'pm', 'presmaster.jpg'),
+        algorithms=('SHA1', 'MD5'))
+    fixity_types = [el.text for el in mets.findall(
+        './/section[@id="fileFixity"]/record/key[@id="fixityType"]')]
+    assert(fixity_types == ['SHA1', 'MD5'])
+
+
+def test_generate_checksums_engines_agree():
+    """The buffered and memory mapped engines give the same digests,
+    including for block sizes that do not divide the file size."""
+    filepath = os.path.join(CURRENT_DIR, 'data', 'test_batch_3', 'img1.jpg')
+    expected = mdf.generate_checksums(filepath, ('MD5', 'SHA1'))
+    for block_size in (1000, 4096, 2**20):
+        assert(mdf.generate_checksums(filepath, ('MD5', 'SHA1'),
+            block_size=block_size, mmap_threshold=None) == expected)
+        assert(mdf.generate_checksums(filepath, ('MD5', 'SHA1'),
+            block_size=block_size, mmap_threshold=1) == expected)
+
+
+def test_id_map_correlates_pymets_and_rosetta_ids():
+    """The id_map passed to build_mets is filled with the pymets ID for
+    every rep and file, mapped to the ID used in the finished document."""
+    id_map = {}
+    mets = mdf.build_mets(
+        ie_dmd_dict={"dc:title": "test title"},
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_4', 'pm'),
+        access_derivative_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_4', 'ad'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_4'),
+        id_map=id_map)
+    assert(id_map['ie1-rep1'] == 'rep1')
+    assert(id_map['ie1-rep2-1'] == 'rep2-1')
+    assert(id_map['ie1-rep2-file2'] == 'fid2-2')
+    assert(id_map['ie1-rep2-file2-amd'] == 'fid2-2-amd')
+    ids = set(mets.xpath('.//@ID | .//@ADMID | .//@FILEID'))
+    assert(not [value for value in ids if value.startswith('ie1-')])
+    assert(set(id_map.values()) <= ids)
+
+
+def test_streamed_mets_matches_in_memory_mets(tmp_path):
+    """Streaming a document to a file or stream gives the same XML (after
+    canonicalisation, as top-level sections repeat the METS namespace
+    declaration) as building it in memory."""
+    import io
+    kwargs = dict(
+        ie_dmd_dict={"dc:title": "test title"},
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+        structmap_type='BOTH',
+        generalIECharacteristics=[{
+            'submissionReason': 'bornDigitalContent',
+            'IEEntityType': 'periodicIE'}])
+    expected = ET.tostring(mdf.build_mets(**kwargs), method='c14n')
+
+    output = str(tmp_path / 'mets.xml')
+    assert(mdf.build_mets(output=output, **kwargs) is None)
+    assert(ET.tostring(ET.parse(output), method='c14n') == expected)
+    assert(os.listdir(str(tmp_path)) == ['mets.xml'])
+
+    stream = io.BytesIO()
+    mdf.build_mets(output=stream, fixity_workers=2, **kwargs)
+    assert(ET.tostring(ET.fromstring(stream.getvalue()), method='c14n')
+        == expected)
+
+
+def test_threads_can_stream_to_the_same_output(tmp_path):
+    """Each thread writes its own temporary file before replacing the
+    output with it."""
+    import threading
+    output = str(tmp_path / 'mets.xml')
+    barrier = threading.Barrier(2)
+    written = []
+    errors = []
+
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write(b'<mets/>')
+        written.append(path)
+        # both temporary files exist before either replaces the output
+        barrier.wait(timeout=10)
+
+    def run():
+        try:
+            mdf._write_atomically(output, write)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(errors == [])
+    assert(len(set(written)) == 2)
+    assert(os.listdir(str(tmp_path)) == ['mets.xml'])
+
+
+def test_streamed_json_mets_matches_in_memory_mets():
+    """build_mets_from_json and build_single_file_mets can also stream."""
+    import io
+    pm_json = """[
+        {"fileOriginalName": "img1.jpg",
+         "fileOriginalPath": "path/to/files/img1.jpg",
+         "MD5": "aff64bf1391ac627edb3234a422f9a77",
+         "label": "Image One"},
+        {"fileOriginalName": "img2.jpg",
+         "fileOriginalPath": "path/to/other/img2.jpg",
+         "MD5": "9d09f20ab8e37e5d32cdd1508b49f0a9",
+         "label": "Image Two"}
+    ]"""
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_json=pm_json,
+                  input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_2'))
+    expected = ET.tostring(mdf.build_mets_from_json(**kwargs), method='c14n')
+    stream = io.BytesIO()
+    mdf.build_mets_from_json(output=stream, **kwargs)
+    assert(ET.tostring(ET.fromstring(stream.getvalue()), method='c14n')
+        == expected)
+
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  filepath=os.path.join(
+                      CURRENT_DIR, 'data', 'test_batch_1', 'pm',
+                      'presmaster.jpg'))
+    expected = ET.tostring(mdf.build_single_file_mets(**kwargs),
+                           method='c14n')
+    stream = io.BytesIO()
+    mdf.build_single_file_mets(output=stream, **kwargs)
+    assert(ET.tostring(ET.fromstring(stream.getvalue()), method='c14n')
+        == expected)
+
+
+def test_json_mets_accepts_decoded_manifests():
+    """Rep manifests can also be passed already decoded, as a list of file
+    dicts or (for a rep of one file) a single dict."""
+    pm = [{"fileOriginalName": "img1.jpg",
+           "fileOriginalPath": "path/to/files/img1.jpg",
+           "MD5": "aff64bf1391ac627edb3234a422f9a77",
+           "label": "Image One"},
+          {"fileOriginalName": "img2.jpg",
+           "fileOriginalPath": "path/to/other/img2.jpg",
+           "MD5": "9d09f20ab8e37e5d32cdd1508b49f0a9",
+           "label": "Image Two"}]
+    ad = {"fileOriginalName": "deriv.jpg",
+          "fileOriginalPath": "ad/deriv.jpg",
+          "MD5": "9d09f20ab8e37e5d32cdd1508b49f0a9"}
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_2'))
+    expected = ET.tostring(mdf.build_mets_from_json(
+        pres_master_json=json.dumps(pm),
+        access_derivative_json=json.dumps([ad]), **kwargs), method='c14n')
+    mets = mdf.build_mets_from_json(pres_master_json=pm,
+                                    access_derivative_json=ad, **kwargs)
+    assert(ET.tostring(mets, method='c14n') == expected)
+
+
+def test_json_mets_accepts_json_lines_and_iterators(tmp_path):
+    """Rep manifests can be JSON Lines files, given as a path or an open
+    file, or iterators of file dicts, and give the same METS as a JSON
+    string."""
+    import io
+    from pathlib import Path
+    pm = [{"fileOriginalName": "img1.jpg",
+           "fileOriginalPath": "path/to/files/img1.jpg",
+           "MD5": "aff64bf1391ac627edb3234a422f9a77",
+           "label": "Image One"},
+          {"fileOriginalName": "img2.jpg",
+           "fileOriginalPath": "path/to/other/img2.jpg",
+           "MD5": "9d09f20ab8e37e5d32cdd1508b49f0a9",
+           "label": "Image Two"}]
+    lines = ''.join(json.dumps(item) + '\n' for item in pm) + '\n'
+    jsonl = tmp_path / 'pm.jsonl'
+    jsonl.write_text(lines)
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_2'))
+    expected = ET.tostring(mdf.build_mets_from_json(
+        pres_master_json=json.dumps(pm), **kwargs), method='c14n')
+    for manifest in (jsonl, str(jsonl), io.StringIO(lines), iter(pm),
+                     (item for item in pm)):
+        mets = mdf.build_mets_from_json(pres_master_json=manifest, **kwargs)
+        assert(ET.tostring(mets, method='c14n') == expected)
+
+
+def test_json_structmap_folders_with_quotes():
+    """Folder names containing quotes are nested correctly, and files in
+    the same folder share its div."""
+    pm = [{"fileOriginalName": "img{}.jpg".format(i),
+           "fileOriginalPath": "it's a \"folder\"/img{}.jpg".format(i),
+           "MD5": "aff64bf1391ac627edb3234a422f9a77"} for i in range(3)]
+    mets = mdf.build_mets_from_json(
+        ie_dmd_dict={"dc:title": "test title"},
+        pres_master_json=pm,
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_2'))
+    toc = mets.find('./{http://www.loc.gov/METS/}structMap/'
+                    '{http://www.loc.gov/METS/}div/'
+                    '{http://www.loc.gov/METS/}div')
+    assert(len(toc) == 1)
+    assert(toc[0].attrib['LABEL'] == "it's a \"folder\"")
+    assert([div.attrib['LABEL'] for div in toc[0]]
+        == ['img0', 'img1', 'img2'])
+    assert([div[0].attrib['FILEID'] for div in toc[0]]
+        == ['fid1-1', 'fid2-1', 'fid3-1'])
+
+
+def test_amdsec_templates_are_copied():
+    """The cached DNX fragments are copied into each amdSec, never shared
+    between them."""
+    first = ET.Element('{http://www.loc.gov/METS/}amdSec', ID='rep1-amd')
+    second = ET.Element('{http://www.loc.gov/METS/}amdSec', ID='rep2-amd')
+    mdf.build_amdsec(first, tech_sec=mdf._rep_amd_tech('PRESERVATION_MASTER', True))
+    mdf.build_amdsec(second, tech_sec=mdf._rep_amd_tech('PRESERVATION_MASTER', True))
+    assert([el.attrib['ID'] for el in first]
+        == ['rep1-amd-tech', 'rep1-amd-rights', 'rep1-amd-source',
+            'rep1-amd-digiprov'])
+    for first_el, second_el in zip(first.iter(), second.iter()):
+        assert(first_el is not second_el)
+    assert(ET.tostring(first).replace(b'rep1', b'rep2')
+        == ET.tostring(second))
+    assert(ET.fromstring(ET.tostring(first)).findtext(
+        './/{http://www.exlibrisgroup.com/dps/dnx}key[@id="DigitalOriginal"]')
+        == 'true')
+
+
+def test_scan_directory_order_and_stat(tmp_path):
+    """Files are listed folder by folder, named files before numbered ones
+    (which are in numeric order, then name order), with their stat
+    details."""
+    for name in ('10.tif', '2.tif', '02.tif', 'b.tif', 'a.tif', 'sub/1.tif'):
+        path = tmp_path.joinpath(*name.split('/'))
+        if not path.parent.exists():
+            path.parent.mkdir()
+        path.write_bytes(b'x' * len(name))
+    scanned = list(mdf.scan_directory(str(tmp_path)))
+    assert([(f.folders, f.name) for f in scanned]
+        == [((), 'a.tif'), ((), 'b.tif'), ((), '02.tif'), ((), '2.tif'),
+            ((), '10.tif'), (('sub',), '1.tif')])
+    assert(mdf._ordered_names(['2.tif', '02.tif'])
+        == mdf._ordered_names(['02.tif', '2.tif']))
+    st = os.stat(str(tmp_path / 'sub' / '1.tif'))
+    assert(scanned[-1].path == os.path.join(str(tmp_path), 'sub', '1.tif'))
+    assert(scanned[-1].size == 9)
+    assert(scanned[-1].mtime_ns == st.st_mtime_ns)
+    assert(scanned[-1].ctime_ns == st.st_ctime_ns)
+
+
+def test_file_amdsecs_use_scanned_stat(monkeypatch):
+    """The file amdSecs are built from the directory scan, without stat
+    calls of their own."""
+    def fail(path):
+        raise AssertionError("unexpected stat of {}".format(path))
+    for name in ('getsize', 'getmtime', 'getctime'):
+        monkeypatch.setattr(os.path, name, fail)
+    mets = mdf.build_mets(
+        ie_dmd_dict={"dc:title": "test title"},
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'))
+    mets = ET.fromstring(ET.tostring(mets))
+    sizes = mets.findall('.//{http://www.exlibrisgroup.com/dps/dnx}key'
+                         '[@id="fileSizeBytes"]')
+    assert(len(sizes) == 6)
+    assert(all(int(size.text) > 0 for size in sizes))
+
+
+def test_both_structmaps_list_every_file():
+    """With structmap_type 'BOTH', the flat PHYSICAL map lists the same
+    file divs, in the same order, as the nested LOGICAL map."""
+    mets = mdf.build_mets(
+        ie_dmd_dict={"dc:title": "test title"},
+        pres_master_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+        input_dir=os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+        structmap_type='BOTH')
+    logical, physical = mets.findall('./{http://www.loc.gov/METS/}structMap')
+    assert(logical.attrib['TYPE'] == 'LOGICAL')
+    assert(physical.attrib['TYPE'] == 'PHYSICAL')
+    file_divs = './/{http://www.loc.gov/METS/}div[@TYPE="FILE"]'
+    toc = physical.find('./{http://www.loc.gov/METS/}div/'
+                        '{http://www.loc.gov/METS/}div')
+    assert(len(toc) == 6)
+    assert([ET.tostring(div) for div in toc]
+        == [ET.tostring(div) for div in logical.findall(file_divs)])
+
+
+def test_update_mets_matches_a_fresh_build(tmp_path, monkeypatch):
+    """Updating a METS for added, removed and changed files gives the same
+    document as building it again, reading only the added and changed
+    files."""
+    import shutil
+    sip = tmp_path / 'sip'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+                    str(sip))
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=str(sip), input_dir=str(sip),
+                  structmap_type='BOTH')
+    mets = mdf.build_mets(**kwargs)
+
+    files = sip / 'path' / 'to' / 'files'
+    shutil.copy(str(files / 'img1.jpg'), str(files / 'img0.jpg'))
+    os.remove(str(sip / 'path' / 'to' / 'other' / 'files' / 'img3.jpg'))
+    with open(str(files / 'img2.jpg'), 'ab') as f:
+        f.write(b'changed')
+    read = []
+    generate_checksums = mdf.generate_checksums
+    monkeypatch.setattr(mdf, 'generate_checksums',
+        lambda filepath, *args, **kw: read.append(filepath)
+            or generate_checksums(filepath, *args, **kw))
+    id_map = {}
+    updated = mdf.update_mets(
+        mets, pres_master_dir=str(sip), input_dir=str(sip),
+        added=[str(files / 'img0.jpg')],
+        removed=[str(sip / 'path' / 'to' / 'other' / 'files' / 'img3.jpg')],
+        changed=[str(files / 'img2.jpg')],
+        id_map=id_map)
+    assert(sorted(read) == [str(files / 'img0.jpg'), str(files / 'img2.jpg')])
+    assert(id_map['fid1-1'] == 'fid2-1')
+    assert(id_map['fid4-1'] == 'fid4-1')
+    assert('fid2-1' not in id_map and 'fid3-1' not in id_map)
+    assert(ET.tostring(updated, method='c14n')
+        == ET.tostring(mdf.build_mets(**kwargs), method='c14n'))
+
+
+def test_update_mets_adds_a_rep_and_a_folder(tmp_path):
+    """A rep can be added to a METS written to a file, and files in new
+    folders go after the existing folders."""
+    import shutil
+    sip = tmp_path / 'sip'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_1'),
+                    str(sip))
+    output = str(tmp_path / 'mets.xml')
+    mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                   pres_master_dir=str(sip / 'pm'), input_dir=str(sip),
+                   output=output)
+    (sip / 'pm' / 'new').mkdir()
+    shutil.copy(str(sip / 'pm' / 'presmaster.jpg'),
+                str(sip / 'pm' / 'new' / 'copy.jpg'))
+    mdf.update_mets(output, pres_master_dir=str(sip / 'pm'),
+                    modified_master_dir=str(sip / 'mm'), input_dir=str(sip),
+                    added=[str(sip / 'pm' / 'new' / 'copy.jpg')],
+                    output=output)
+    expected = mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                              pres_master_dir=str(sip / 'pm'),
+                              modified_master_dir=str(sip / 'mm'),
+                              input_dir=str(sip))
+    assert(ET.tostring(ET.parse(output), method='c14n')
+        == ET.tostring(expected, method='c14n'))
+
+
+
+def test_update_mets_puts_a_new_folder_in_name_order(tmp_path):
+    """A file in a new folder goes where a fresh scan, which takes
+    subfolders in name order, would put it."""
+    import shutil
+    sip = tmp_path / 'sip'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+                    str(sip))
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=str(sip), input_dir=str(sip))
+    mets = mdf.build_mets(**kwargs)
+    (sip / 'path' / 'to' / 'more').mkdir()
+    shutil.copy(str(sip / 'path' / 'to' / 'files' / 'img1.jpg'),
+                str(sip / 'path' / 'to' / 'more' / 'img7.jpg'))
+    mets = mdf.update_mets(mets, pres_master_dir=str(sip),
+                           input_dir=str(sip), added=[
+                               str(sip / 'path' / 'to' / 'more' / 'img7.jpg')])
+    assert(ET.tostring(mets, method='c14n')
+        == ET.tostring(mdf.build_mets(**kwargs), method='c14n'))
+
+def _bag(tmp_path):
+    import shutil
+    bag = tmp_path / 'bag'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_2'),
+                    str(bag / 'data'))
+    with open(str(bag / 'manifest-md5.txt'), 'w') as f:
+        # img1.jpg's digest is wrong, so it shows whether the file was read
+        f.write('0123456789abcdef0123456789abcdef  data/path/to/files/img1.jpg\n')
+    return bag
+
+
+def test_build_mets_takes_checksums_from_a_bagit_manifest(tmp_path,
+                                                          monkeypatch):
+    """Files in the manifest are not hashed; the others are."""
+    bag = _bag(tmp_path)
+    read = []
+    generate_checksums = mdf.generate_checksums
+    monkeypatch.setattr(mdf, 'generate_checksums',
+        lambda filepath, *args, **kw: read.append(filepath)
+            or generate_checksums(filepath, *args, **kw))
+    mets = mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                          pres_master_dir=str(bag / 'data'),
+                          input_dir=str(bag / 'data'),
+                          checksum_manifest=str(bag))
+    assert(read == [str(bag / 'data' / 'path' / 'to' / 'files' / 'img2.jpg')])
+    fixity = [key.text for key in mets.findall('.//{*}key[@id="fixityValue"]')]
+    assert(fixity[0] == '0123456789abcdef0123456789abcdef')
+
+
+def test_build_mets_verifies_a_checksum_manifest(tmp_path):
+    bag = _bag(tmp_path)
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=str(bag / 'data'),
+                  input_dir=str(bag / 'data'),
+                  checksum_manifest=str(bag / 'manifest-md5.txt'))
+    for verify_manifest in ('full', 1):
+        with raises(ValueError):
+            mdf.build_mets(verify_manifest=verify_manifest, **kwargs)
+
+
+def test_build_mets_takes_checksums_from_a_mapping():
+    """Relative paths are relative to input_dir, and bare digests are
+    matched to their algorithm by length. A file missing one of the
+    algorithms is hashed."""
+    input_dir = os.path.join(CURRENT_DIR, 'data', 'test_batch_2')
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=input_dir, input_dir=input_dir,
+                  algorithms=('MD5', 'SHA1'))
+    expected = mdf.build_mets(**kwargs)
+    checksums = mdf.generate_checksums_for_files(
+        [os.path.join(input_dir, 'path', 'to', 'files', name)
+            for name in ('img1.jpg', 'img2.jpg')], ('MD5', 'SHA1'))
+    img1, img2 = sorted(checksums)
+    manifest = {os.path.relpath(img1, input_dir): checksums[img1]['SHA1'],
+                img1: {'md5': checksums[img1]['MD5']},
+                img2: checksums[img2]['MD5']}
+    mets = mdf.build_mets(checksum_manifest=manifest, verify_manifest='full',
+                          **kwargs)
+    assert(ET.tostring(mets, method='c14n')
+        == ET.tostring(expected, method='c14n'))
+
+
+def test_builders_report_phases_to_hooks():
+    input_dir = os.path.join(CURRENT_DIR, 'data', 'test_batch_5')
+    timings = mdf.PhaseTimings()
+    mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                   pres_master_dir=input_dir, input_dir=input_dir,
+                   structmap_type='PHYSICAL', hooks=timings)
+    assert(sorted(timings.phases) == ['assemble', 'hash', 'ie', 'populate',
+                                      'scan', 'structmaps'])
+    assert(len(timings.hash_latencies) == 6)
+    assert(all(seconds >= 0 for _, seconds in timings.hash_latencies))
+
+    timings = mdf.PhaseTimings()
+    mdf.build_single_file_mets(
+        ie_dmd_dict={"dc:title": "test title"},
+        filepath=os.path.join(input_dir, 'path', 'to', 'files', 'img1.jpg'),
+        output=io.BytesIO(), hooks=timings)
+    assert(sorted(timings.phases) == ['assemble', 'hash', 'ie', 'populate',
+                                      'serialize'])
+    assert(len(timings.hash_latencies) == 1)
+
+
+def test_build_mets_reports_progress():
+    """Reports are rate limited, and the final one covers every file,
+    whether the files are hashed one at a time or by a pool."""
+    input_dir = os.path.join(CURRENT_DIR, 'data', 'test_batch_5')
+    total = sum(scanned.size for scanned in mdf.scan_directory(input_dir))
+    for fixity_workers in (None, 3):
+        reports = []
+        mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                       pres_master_dir=input_dir, input_dir=input_dir,
+                       fixity_workers=fixity_workers,
+                       progress=mdf.ProgressTracker(reports.append,
+                                                    interval=0))
+        assert(len(reports) > 6)
+        assert([report.bytes_hashed for report in reports]
+            == sorted(report.bytes_hashed for report in reports))
+        final = reports[-1]
+        assert((final.files_done, final.files_total) == (6, 6))
+        assert(final.bytes_hashed == final.bytes_total == total)
+
+    reports = []
+    mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                   pres_master_dir=input_dir, input_dir=input_dir,
+                   progress=reports.append)
+    assert(len(reports) == 1)
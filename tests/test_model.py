@@ -0,0 +1,75 @@
+import os
+
+from lxml import etree as ET
+
+from mets_dnx import factory as mdf
+from mets_dnx.model import FileRecord
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+METS_NS = "{http://www.loc.gov/METS/}"
+
+
+def test_render_directory_inventory_matches_build_mets():
+    sip = os.path.join(CURRENT_DIR, 'data', 'test_batch_4')
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=os.path.join(sip, 'pm'),
+                  modified_master_dir=os.path.join(sip, 'mm'),
+                  input_dir=sip)
+    ie = mdf.directory_inventory(**kwargs)
+    assert([rep.preservation_type for rep in ie.reps] ==
+           ['PRESERVATION_MASTER', 'MODIFIED_MASTER'])
+    assert(all(record.checksums is None and record.size is not None
+               for record in ie.files()))
+    id_map = {}
+    mets = mdf.render_mets(ie, 'PHYSICAL', id_map=id_map)
+    expected_id_map = {}
+    expected = mdf.build_mets(structmap_type='PHYSICAL',
+                              id_map=expected_id_map, **kwargs)
+    assert(ET.tostring(mets, method='c14n') ==
+           ET.tostring(expected, method='c14n'))
+    assert(id_map == expected_id_map)
+
+
+def test_inventory_can_be_altered_before_rendering():
+    sip = os.path.join(CURRENT_DIR, 'data', 'test_batch_5')
+    ie = mdf.directory_inventory(ie_dmd_dict={"dc:title": "test title"},
+                                 pres_master_dir=sip, input_dir=sip)
+    files = ie.reps[0].files
+    dropped = files.pop()
+    files[0].label = 'Front cover'
+    files[0].checksums = {'MD5': 'd41d8cd98f00b204e9800998ecf8427e'}
+    mets = mdf.render_mets(ie)
+
+    hrefs = [flocat.get('{http://www.w3.org/1999/xlink}href')
+             for flocat in mets.iter(METS_NS + 'FLocat')]
+    assert(hrefs == [record.href for record in files])
+    assert(dropped.href not in hrefs)
+    assert(mets.find('.//{0}div[@TYPE="FILE"]'.format(METS_NS)).get('LABEL')
+           == 'Front cover')
+    # the checksum supplied is recorded rather than generated
+    assert(mets.findtext('./{}amdSec[@ID="fid1-1-amd"]//'
+                         '{{*}}key[@id="fixityValue"]'.format(METS_NS)) ==
+           'd41d8cd98f00b204e9800998ecf8427e')
+
+
+def test_render_json_inventory_matches_build_mets_from_json():
+    manifest = [{'fileOriginalName': 'img1.jpg',
+                 'fileOriginalPath': 'pm/img1.jpg',
+                 'MD5': '0123456789abcdef0123456789abcdef',
+                 'fileSizeBytes': '10'},
+                {'fileOriginalName': 'img2.jpg',
+                 'fileOriginalPath': 'pm/sub/img2.jpg',
+                 'md5': 'fedcba9876543210fedcba9876543210',
+                 'label': 'Second'}]
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_json=manifest, input_dir='.')
+    ie = mdf.json_inventory(**kwargs)
+    first, second = ie.reps[0].files
+    assert(isinstance(first, FileRecord))
+    assert(first.checksums == {'MD5': '0123456789abcdef0123456789abcdef'})
+    assert(second.folders == ('pm', 'sub'))
+    assert(second.structmap_label == 'Second')
+    assert(ET.tostring(mdf.render_mets(ie), method='c14n') ==
+           ET.tostring(mdf.build_mets_from_json(**kwargs), method='c14n'))
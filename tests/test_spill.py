@@ -0,0 +1,84 @@
+import io
+import os
+
+from lxml import etree as ET
+
+from mets_dnx import factory as mdf
+from mets_dnx import spill
+from mets_dnx.model import FileRecord, IERecord, RepRecord
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+
+def _c14n(xml):
+    return ET.tostring(ET.fromstring(xml), method='c14n')
+
+
+def test_build_mets_out_of_core_matches_build_mets(tmp_path):
+    """The spilled document is the same as build_mets() writes, whatever
+    the structMap type, and with several batches of records."""
+    sip = os.path.join(CURRENT_DIR, 'data', 'test_batch_4')
+    kwargs = dict(ie_dmd_dict={"dc:title": "test title"},
+                  pres_master_dir=os.path.join(sip, 'pm'),
+                  modified_master_dir=os.path.join(sip, 'mm'),
+                  access_derivative_dir=os.path.join(sip, 'ad'),
+                  input_dir=sip,
+                  algorithms=('MD5', 'SHA256'))
+    for structmap_type in ('DEFAULT', 'PHYSICAL', 'BOTH'):
+        for fixity_workers in (None, 2):
+            expected = io.BytesIO()
+            mdf.build_mets(structmap_type=structmap_type, output=expected,
+                           **kwargs)
+            spilled = io.BytesIO()
+            spill.build_mets_out_of_core(
+                structmap_type=structmap_type, fixity_workers=fixity_workers,
+                output=spilled, memory_limit=4096,
+                spill_dir=str(tmp_path), **kwargs)
+            assert(_c14n(spilled.getvalue()) == _c14n(expected.getvalue()))
+    assert(os.listdir(str(tmp_path)) == [])
+
+
+def test_spilled_files_keep_folders_together_in_the_structmap():
+    """Files added out of folder order get the same nested divs as
+    render_mets() gives them."""
+    paths = [(('a',), 'one.txt'), ((), 'two.txt'), (('a', 'b'), 'three.txt'),
+             (('c',), 'four.txt'), (('a',), 'five.txt')]
+    ie = IERecord(ie_dmd_dict={"dc:title": "test title"}, input_dir='.')
+    with spill.RecordStore(memory_limit=4096) as store:
+        files = store.files()
+        for folders, name in paths:
+            files.append(FileRecord(folders, name, '/'.join(folders + (name,)),
+                                    size=1, mtime_ns=0, ctime_ns=0,
+                                    checksums={'MD5': '0' * 32}))
+        ie.reps.append(RepRecord('PRESERVATION_MASTER', 'Preservation Master',
+                                 'VIEW', files))
+        assert(len(files) == 5 and store.batch_size == 1)
+        assert([record.name for record in files] ==
+               [name for _, name in paths])
+        spilled = io.BytesIO()
+        spill.write_spilled_mets(ie, spilled, 'BOTH')
+
+    ie.reps[0].files = [
+        FileRecord(folders, name, '/'.join(folders + (name,)), size=1,
+                   mtime_ns=0, ctime_ns=0, checksums={'MD5': '0' * 32})
+        for folders, name in paths]
+    expected = ET.tostring(mdf.render_mets(ie, 'BOTH'), method='c14n')
+    assert(_c14n(spilled.getvalue()) == expected)
+
+
+def test_store_scans_directories_in_scan_directory_order(tmp_path):
+    """The listings sorted in the store give the same order as
+    scan_directory(), a batch of entries at a time."""
+    names = ['b.txt', 'a.txt', 'é.txt', 'z', '10.tif', '2.tif', '02.tif',
+             '2.jpg', '-1.tif', '-20.tif', '0.tif', '99999999999999999999.tif',
+             'sub/1.tif', 'sub/deeper/x.txt', 'Sub/y.txt', 'other/3.tif']
+    sip = tmp_path / 'sip'
+    for name in names:
+        path = sip.joinpath(*name.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * len(name))
+    os.symlink(str(sip / 'sub'), str(sip / 'link'))
+    with spill.RecordStore(str(tmp_path), memory_limit=4096) as store:
+        assert(list(store.scan_directory(str(sip))) ==
+               list(mdf.scan_directory(str(sip))))
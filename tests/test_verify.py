@@ -0,0 +1,76 @@
+import io
+import os
+import shutil
+
+from lxml import etree as ET
+
+from mets_dnx import factory as mdf
+from mets_dnx import verify
+
+
+CURRENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)))
+
+
+def _sip(tmp_path):
+    sip = tmp_path / 'sip'
+    shutil.copytree(os.path.join(CURRENT_DIR, 'data', 'test_batch_5'),
+                    str(sip))
+    return sip
+
+
+def test_verify_mets_finds_every_kind_of_problem(tmp_path):
+    """A streamed METS is checked file by file, in document order."""
+    sip = _sip(tmp_path)
+    output = str(tmp_path / 'mets.xml')
+    mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                   pres_master_dir=str(sip), input_dir=str(sip),
+                   algorithms=('MD5', 'SHA256'), output=output)
+    files = sip / 'path' / 'to' / 'files'
+    os.remove(str(files / 'img1.jpg'))
+    with open(str(files / 'img2.jpg'), 'ab') as f:
+        f.write(b'grown')
+    with open(str(sip / 'path' / 'to' / 'other' / 'files' / 'img3.jpg'),
+              'r+b') as f:
+        f.write(b'\0')
+
+    checks = list(verify.verify_mets(output, str(sip), workers=2))
+    assert([check.file_id for check in checks]
+        == ['fid{}-1'.format(n) for n in range(1, 7)])
+    statuses = dict((os.path.basename(check.path), check.status)
+                    for check in checks)
+    assert(statuses.pop('img1.jpg') == 'missing')
+    assert(statuses.pop('img2.jpg') == 'size')
+    assert(statuses.pop('img3.jpg') == 'fixity')
+    assert(set(statuses.values()) == {'ok'})
+    fixity = [check for check in checks if check.status == 'fixity'][0]
+    assert(sorted(fixity.expected) == ['MD5', 'SHA256'])
+    assert(fixity.expected['MD5'] != fixity.actual['MD5'])
+
+
+def test_verify_mets_reads_in_memory_and_json_documents():
+    """DNX keys without a namespace (a document built in memory) are read
+    as well as namespaced ones (a document parsed from a file), and a
+    record without fileSizeBytes is only hashed."""
+    input_dir = os.path.join(CURRENT_DIR, 'data', 'test_batch_3')
+    mets = mdf.build_mets_from_json(
+        ie_dmd_dict={"dc:title": "test title"},
+        pres_master_json=[{'fileOriginalPath': 'img1.jpg',
+                           'fileOriginalName': 'img1.jpg',
+                           'MD5': 'aff64bf1391ac627edb3234a422f9a77'}],
+        input_dir=input_dir)
+    for document in (mets, io.BytesIO(ET.tostring(mets))):
+        checks = list(verify.verify_mets(document, input_dir))
+        assert([(check.file_id, check.status) for check in checks]
+            == [('fid1-1', 'ok')])
+
+
+def test_verify_mets_reports_an_unsupported_fixity_type(tmp_path):
+    """A file whose fixityType cannot be generated is reported, and the
+    other files are still checked."""
+    sip = _sip(tmp_path)
+    mets = mdf.build_mets(ie_dmd_dict={"dc:title": "test title"},
+                          pres_master_dir=str(sip), input_dir=str(sip))
+    mets.find('.//{*}key[@id="fixityType"]').text = 'CRC32'
+    checks = list(verify.verify_mets(mets, str(sip), workers=2))
+    assert([check.status for check in checks] == ['error'] + ['ok'] * 5)
+    assert('CRC32' in checks[0].actual)